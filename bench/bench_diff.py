@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark configuration.diff_configs and merge_configs.
+
+    python bench/bench_diff.py [LINES] [CHANGE_RATE]
+
+Generates a base lts.conf of LINES (default 100000) option lines and two
+revisions of it, each with CHANGE_RATE (default 0.05) of the values
+changed, a few of them only respelled (e.g. 'True' as 'yes'), and with
+sections shuffled.  Reports the time to diff base against a revision,
+with and without the typed comparison of values, and to merge the two
+revisions.
+"""
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import configuration
+import data_validation
+from bench_validation import synthetic_lines
+
+# equivalent spellings, to check respelled values don't count as changes
+RESPELLINGS = {'True': 'yes', 'False': 'no', '90': '090'}
+
+
+def generate(vars_meta, lines, change_rate, seed):
+    rand = random.Random(seed)
+    sections = []
+    for index, (option, value) in enumerate(synthetic_lines(vars_meta,
+                                                            lines)):
+        if index % 20 == 0:
+            sections.append(['[client%d]' % (index // 20)])
+        if seed and rand.random() < change_rate:
+            value = RESPELLINGS.get(value, value + str(seed))
+        sections[-1].append('%s = %s' % (option, value))
+    if seed:
+        rand.shuffle(sections)
+    document = configuration.LTSConfDocument()
+    document._parse('\n'.join('\n'.join(section) for section in sections))
+    return document
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main(args):
+    lines = int(args[0]) if args else 100000
+    change_rate = float(args[1]) if len(args) > 1 else 0.05
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    validator = data_validation.LTSPValidator(vars_meta)
+    base = generate(vars_meta, lines, change_rate, 0)
+    ours = generate(vars_meta, lines, change_rate, 1)
+    theirs = generate(vars_meta, lines, change_rate, 2)
+    print "%d option lines, %.0f%% changed per revision" % (
+        lines, change_rate * 100)
+    seconds, changes = timed(configuration.diff_configs, base, ours)
+    print "  diff, raw values    %7.3f s  %6d changes" % (seconds,
+                                                         len(changes))
+    seconds, changes = timed(configuration.diff_configs, base, ours,
+                             validator)
+    print "  diff, typed values  %7.3f s  %6d changes" % (seconds,
+                                                         len(changes))
+    seconds, (changes, conflicts) = timed(configuration.merge_configs, base,
+                                          ours, theirs, validator)
+    print "  three-way merge     %7.3f s  %6d changes, %d conflicts" % (
+        seconds, len(changes), len(conflicts))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Report the memory used per option line by a loaded LTSConfDocument.
+
+    python bench/bench_memory.py [LINES] [OPTIONS_PER_SECTION]
+
+Generates an lts.conf with LINES (default 1000000) option lines, in client
+sections of OPTIONS_PER_SECTION (default 20) options each, using the
+variable names in lts_vars.conf and typical values for their data types.
+It is loaded into an LTSConfDocument and, for comparison, into a
+ConfigParser.RawConfigParser, and for each the bytes per option line are
+reported: of the parsed model alone (every object reachable from it, counted
+once, not counting the text of the file kept by LTSConfDocument), and of
+the growth of the process' resident set while loading.
+"""
+
+import ConfigParser
+import gc
+import os
+import sys
+import time
+import types
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import configuration
+from bench_validation import synthetic_lines
+
+_SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def deep_size(root, exclude=()):
+    """Total sys.getsizeof of every object reachable from root, each counted
+    once, leaving out the objects in exclude."""
+    seen = set(id(obj) for obj in exclude)
+    pending = [root]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SKIP):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def generate(lines, per_section):
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    out = []
+    for index, (option, value) in enumerate(synthetic_lines(vars_meta,
+                                                            lines)):
+        if index % per_section == 0:
+            out.append('[10.%d.%d.%d]\n' % (index >> 16 & 255,
+                                            index >> 8 & 255, index & 255))
+        out.append('%s = %s\n' % (option, value))
+    return ''.join(out)
+
+
+def measure(label, lines, load):
+    gc.collect()
+    before = resident_bytes()
+    start = time.time()
+    model = load()
+    seconds = time.time() - start
+    gc.collect()
+    grown = resident_bytes() - before
+    size = deep_size(model, exclude=(getattr(model, '_text', None),))
+    print "  %-16s model %6.1f bytes/line   rss +%6.1f bytes/line   " \
+          "load %.2f s" % (label, float(size) / lines, float(grown) / lines,
+                           seconds)
+    return model
+
+
+def main(args):
+    lines = int(args[0]) if args else 1000000
+    per_section = int(args[1]) if len(args) > 1 else 20
+    text = generate(lines, per_section)
+    print "%d option lines, %d per section, %d bytes of text" % (
+        lines, per_section, len(text))
+
+    def load_document():
+        document = configuration.LTSConfDocument()
+        document._parse(text)
+        return document
+
+    def load_configparser():
+        parser = ConfigParser.RawConfigParser()
+        parser.optionxform = str
+        parser.readfp(StringIO(text))
+        return parser
+
+    document = measure('LTSConfDocument', lines, load_document)
+    del document
+    measure('RawConfigParser', lines, load_configparser)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
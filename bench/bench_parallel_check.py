@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark `--check` throughput over many files with 1..N worker processes.
+
+    python bench/bench_parallel_check.py [FILES] [LINES] [MAX_JOBS]
+
+Writes FILES (default 200) synthetic lts.conf files of LINES (default 2000)
+option lines each to a scratch directory, checks the directory with
+cli.check_files for every job count from 1 up to MAX_JOBS (default: the
+number of CPUs), and reports the time taken and the speedup over one job.
+The output of every run is compared with that of the single process run.
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import cli
+import configuration
+import data_validation
+from bench_validation import synthetic_lines
+
+
+def write_conf_files(directory, vars_meta, files, lines):
+    for number in xrange(files):
+        fname = os.path.join(directory, 'site%04d.conf' % number)
+        with open(fname, 'w') as conf:
+            for index, (option, value) in enumerate(
+                    synthetic_lines(vars_meta, lines, seed=number)):
+                if index % 50 == 0:
+                    conf.write('[client%d]\n' % index)
+                conf.write('%s = %s\n' % (option, value))
+
+
+def main(args):
+    files = int(args[0]) if args else 200
+    lines = int(args[1]) if len(args) > 1 else 2000
+    max_jobs = int(args[2]) if len(args) > 2 else multiprocessing.cpu_count()
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    scratch = tempfile.mkdtemp()
+    try:
+        write_conf_files(scratch, vars_meta, files, lines)
+        fnames = cli.find_conf_files([scratch])
+        print "%d files of %d lines, %d CPUs" % (
+            files, lines, multiprocessing.cpu_count())
+        expected = None
+        baseline = None
+        for jobs in xrange(1, max_jobs + 1):
+            validator = data_validation.LTSPValidator(vars_meta)
+            out = StringIO()
+            start = time.time()
+            cli.check_files(fnames, validator, out=out, jobs=jobs)
+            seconds = time.time() - start
+            output = out.getvalue()
+            if expected is None:
+                expected, baseline = output, seconds
+            same = 'same output' if output == expected else 'OUTPUT DIFFERS'
+            print "  %2d jobs %8.3f s  %9.0f lines/s  (%.2fx, %s)" % (
+                jobs, seconds, files * lines / seconds, baseline / seconds,
+                same)
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
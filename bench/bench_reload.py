@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark LTSConfDocument.reload against parsing the file again.
+
+    python bench/bench_reload.py [LINES] [RUNS]
+
+Generates an lts.conf of LINES (default 100000) option lines, then has
+another program's kind of edits made to it: one value changed near the
+start, in the middle and at the end, a section appended, and a section
+removed.  Reports the best of RUNS (default 5) timings of reloading each
+edit, next to a full parse of the edited text.
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import configuration
+from bench_validation import synthetic_lines
+
+
+def generate(vars_meta, lines):
+    out = []
+    for index, (option, value) in enumerate(synthetic_lines(vars_meta,
+                                                            lines)):
+        if index % 20 == 0:
+            out.append('[client%d]' % (index // 20))
+        out.append('%s = %s' % (option, value))
+    return '\n'.join(out) + '\n'
+
+
+def change_value(text, fraction):
+    """text with the value of the option line nearest to fraction of the
+    way through changed."""
+    start = text.find(' = ', int(len(text) * fraction)) + 3
+    end = text.find('\n', start)
+    return text[:start] + 'changed' + text[end:]
+
+
+def remove_section(text, name):
+    start = text.find('[%s]\n' % name)
+    end = text.find('\n[', start + 1) + 1
+    return text[:start] + text[end:]
+
+
+def best_of(runs, func):
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(args):
+    lines = int(args[0]) if args else 100000
+    runs = int(args[1]) if len(args) > 1 else 5
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    text = generate(vars_meta, lines)
+    edits = [
+        ('value near start', change_value(text, 0.01)),
+        ('value in middle', change_value(text, 0.5)),
+        ('value near end', change_value(text, 0.99)),
+        ('section appended', text + '[new]\nSCREEN_02 = ldm\n'),
+        ('section removed', remove_section(text, 'client%d' % (
+            lines // 40))),
+    ]
+    print "%d option lines, %d bytes, best of %d runs" % (lines, len(text),
+                                                          runs)
+    for label, edited in edits:
+        timings = []
+        for _ in xrange(runs):
+            document = configuration.LTSConfDocument()
+            document._parse(text)
+            start = time.time()
+            document.reload(edited)
+            timings.append(time.time() - start)
+        full = best_of(runs,
+                       lambda: configuration.LTSConfDocument()._parse(edited))
+        print "  %-18s reload %8.3f ms   full parse %8.3f ms" % (
+            label, min(timings) * 1000, full * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the shell value tokenizer and the lts.conf reader around it.
+
+    python bench/bench_tokenize.py [LINES] [RUNS]
+
+Generates LINES (default 200000) option lines from the variables in
+lts_vars.conf, a fifth of them written the way real files spell the values
+the shell has to untangle: quoted, with variable references and escapes, and
+some going on over several lines.  Reports the best of RUNS (default 5)
+throughputs, in MB of values (or of file) per second, of:
+    uncached    tokenize on every value, with the cache emptied each time
+    first pass  tokenize on every value, starting with an empty cache
+    cached      tokenize on every value again
+    reader      iter_records over the whole file
+"""
+
+import os
+import random
+import sys
+import time
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import configuration
+import data_validation
+from bench_validation import synthetic_lines
+
+# (option, value) pairs spelled like in the wild; %d makes them distinct
+SHELL_VALUES = [
+    ('XKBLAYOUT', '"en-us"'),
+    ('LDM_SSHOPTIONS', '"-o ServerAliveInterval=%d -o Compression=no"'),
+    ('FSTAB_1', '"server:/home /home nfs defaults,nolock 0 %d"'),
+    ('RM_SYSTEM_SERVICES', '"bluetooth cups%d \\\n    avahi-daemon"'),
+    ('LDM_SERVER', '"$SERVER 10.0.%d.1"'),
+    ('RCFILE_01', "'/usr/local/bin/setup-%d'"),
+    ('SCREEN_07', 'ldm # the default, set %d times'),
+    ('LDM_XSESSION', '"/usr/bin/x-session \\"%d\\""'),
+    ('X_RAMPERC', '${PERC:-%d}'),
+    ('LOCAL_APPS_EXTRAMOUNTS', '"/media,/srv/%d,\n/mnt"'),
+]
+
+
+def corpus(vars_meta, lines, shell_rate=0.2, seed=0):
+    rand = random.Random(seed)
+    pairs = synthetic_lines(vars_meta, lines, seed=seed)
+    for index in xrange(len(pairs)):
+        if rand.random() < shell_rate:
+            option, value = rand.choice(SHELL_VALUES)
+            if '%d' in value:
+                value = value % rand.randrange(100)
+            pairs[index] = (option, value)
+    return pairs
+
+
+def throughput(runs, size, func):
+    """Best MB/s of func over runs, processing size bytes each run."""
+    best = None
+    for _ in xrange(runs):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return size / best / 1e6
+
+
+def main(args):
+    lines = int(args[0]) if args else 200000
+    runs = int(args[1]) if len(args) > 1 else 5
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    pairs = corpus(vars_meta, lines)
+    values = [value for option, value in pairs]
+    out = []
+    for index, (option, value) in enumerate(pairs):
+        if index % 20 == 0:
+            out.append('[client%d]' % (index // 20))
+        out.append('%s = %s' % (option, value))
+    text = '\n'.join(out) + '\n'
+    size = sum(len(value) for value in values)
+    tokenize = data_validation.tokenize
+
+    def uncached():
+        for value in values:
+            data_validation._shell_values.clear()
+            tokenize(value)
+
+    def first_pass():
+        data_validation._shell_values.clear()
+        for value in values:
+            tokenize(value)
+
+    def cached():
+        for value in values:
+            tokenize(value)
+
+    def reader():
+        for record in configuration.iter_records(StringIO(text)):
+            pass
+
+    print "%d values (%d distinct), %d bytes; file %d bytes" % (
+        len(values), len(set(values)), size, len(text))
+    for label, func, nbytes in [('uncached', uncached, size),
+                                ('first pass', first_pass, size),
+                                ('cached', cached, size),
+                                ('reader', reader, len(text))]:
+        print "  %-12s %8.1f MB/s" % (label, throughput(runs, nbytes, func))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
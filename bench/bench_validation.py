@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmark for per-value validation cost.
+
+Compares the old validation path -- look the DataType class up by name and
+instantiate it for every value, with exceptions signalling bad values --
+with the compiled per-variable plans used by LTSPValidator.check_data, both
+without and with the validation result cache.
+
+    python bench/bench_validation.py [LINES]
+
+LINES (default 100000) option lines are generated from the variables in
+lts_vars.conf, roughly one in ten of them with an invalid value.
+"""
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import configuration
+import data_validation
+
+
+# (valid, invalid) sample values per data type
+SAMPLES = {
+    'string': (['ldm', 'shell', 'pulse'], []),
+    'integer': (['90', '300', '8'], ['loud', '9x']),
+    'boolean': (['True', 'False', 'yes', '0'], ['maybe']),
+    'ip address': (['192.168.0.254', '10.0.0.1'], ['10.0.0.256']),
+    'port': (['9572', '9100'], ['0', '70000']),
+    'file path': (['/etc/init.d/myrcfile'], []),
+    '24hr time string': (['22:00:00', '7:30:00'], ['25:00:00', 'noon']),
+    'console keymap': (['en'], ['xx-nonexistent']),
+    'password': (['secret'], []),
+    'horizontal sync rate': (['60'], ['fast']),
+    'vertical refresh rate': (['75'], ['slow']),
+    'color depth': (['16', '24'], ['12']),
+}
+
+
+def synthetic_lines(vars_meta, count, invalid_rate=0.1, seed=0):
+    rand = random.Random(seed)
+    variables = list(vars_meta)
+    lines = []
+    for _ in xrange(count):
+        var = rand.choice(variables)
+        valid, invalid = SAMPLES[var.datatype]
+        if invalid and rand.random() < invalid_rate:
+            lines.append((var.name, rand.choice(invalid)))
+        else:
+            lines.append((var.name, rand.choice(valid)))
+    return lines
+
+
+def legacy_check_data(vars_meta, data_types, option, value):
+    """The validation path as it was before plans were compiled."""
+    var_meta = vars_meta[option]
+    try:
+        data_types[var_meta.datatype](value)
+    except ValueError, e:
+        return e.message
+
+
+def timed(func, lines):
+    start = time.time()
+    for option, value in lines:
+        func(option, value)
+    return time.time() - start
+
+
+def main(args):
+    count = int(args[0]) if args else 100000
+    vars_meta = configuration.LTSVarsConfig(os.path.join(ROOT,
+                                                         'lts_vars.conf'))
+    uncached = data_validation.LTSPValidator(vars_meta, cache_size=0)
+    validator = data_validation.LTSPValidator(vars_meta)
+    data_types = data_validation.get_data_type_dict()
+    lines = synthetic_lines(vars_meta, count)
+
+    def legacy(option, value):
+        return legacy_check_data(vars_meta, data_types, option, value)
+
+    results = [('legacy (instantiate per value)', timed(legacy, lines)),
+               ('compiled plans, no cache',
+                timed(uncached.check_data, lines)),
+               ('compiled plans, cold cache',
+                timed(validator.check_data, lines)),
+               ('compiled plans, warm cache',
+                timed(validator.check_data, lines))]
+    print "%d option lines" % count
+    for label, seconds in results:
+        print "  %-32s %8.3f s  %7.3f us/value  (%.1fx)" % (
+            label, seconds, seconds / count * 1e6, results[0][1] / seconds)
+    cache = validator.cache
+    print "  cache: %d entries, %d hits, %d misses" % (len(cache), cache.hits,
+                                                       cache.misses)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
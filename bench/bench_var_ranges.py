@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Show that LTSVarsConfig's load time and size don't grow with the width of
+ranged declarations.
+
+    python bench/bench_var_ranges.py [RUNS]
+
+For a few range widths, writes a vars file declaring 20 ranged families of
+that width and reports the best of RUNS (default 20) parse times, the time
+to look up a name in the middle of a range, and the size of the cache file.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import configuration
+
+WIDTHS = (10, 100, 10000, 1000000)
+FAMILIES = 20
+
+
+def write_vars_file(fname, width):
+    with open(fname, 'w') as out:
+        for family in xrange(FAMILIES):
+            out.write('FAMILY%d_OPTION_1...FAMILY%d_OPTION_%d: string, '
+                      'default unset : family %d\n' % (family, family, width,
+                                                       family))
+
+
+def best_of(runs, func):
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(args):
+    runs = int(args[0]) if args else 20
+    scratch = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(scratch, 'lts_vars.conf')
+        print "%d families per file, best of %d runs" % (FAMILIES, runs)
+        for width in WIDTHS:
+            write_vars_file(fname, width)
+            parse = best_of(runs, lambda: configuration.LTSVarsConfig(fname))
+            conf = configuration.LTSVarsConfig(fname, use_cache=True)
+            name = 'FAMILY%d_OPTION_%d' % (FAMILIES - 1, width // 2)
+            lookup = best_of(runs, lambda: conf[name])
+            print "  width %8d: %9d names  parse %7.3f ms  lookup %6.2f us" \
+                  "  cache %6d bytes" % (
+                      width, len(conf), parse * 1000, lookup * 1e6,
+                      os.path.getsize(conf.cache_fname))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark cold and warm load times of LTSVarsConfig.
+
+    python bench/bench_vars_cache.py [COPIES] [RUNS]
+
+Works on a scratch copy of lts_vars.conf with its entries repeated COPIES
+times under new names (default 1, i.e. the stock file), and reports the
+best of RUNS (default 20) timings for:
+    parse       plain parsing, no cache involved
+    cold        parsing plus writing the cache
+    warm        loading from a valid cache
+    restamped   cache with an old mtime but matching content (hash check)
+"""
+
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import configuration
+
+
+def write_vars_file(fname, copies):
+    lines = open(os.path.join(ROOT, 'lts_vars.conf')).readlines()
+    with open(fname, 'w') as out:
+        for copy in xrange(copies):
+            for line in lines:
+                if copy and line.strip() and not line.startswith('#'):
+                    # prefix every name (both ends of ranges too) so each
+                    # copy declares new variables
+                    name, rest = line.split(':', 1)
+                    prefix = 'C%d_' % copy
+                    name = '...'.join(prefix + part.strip()
+                                      for part in name.split('...'))
+                    line = '%s:%s' % (name, rest)
+                out.write(line)
+
+
+def best_of(runs, func):
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(args):
+    copies = int(args[0]) if args else 1
+    runs = int(args[1]) if len(args) > 1 else 20
+    scratch = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(scratch, 'lts_vars.conf')
+        write_vars_file(fname, copies)
+        cache_fname = fname + '.cache'
+
+        def cold():
+            if os.path.exists(cache_fname):
+                os.remove(cache_fname)
+            configuration.LTSVarsConfig(fname, use_cache=True)
+
+        stamps = itertools.count(1)
+
+        def restamped():
+            stamp = next(stamps)
+            os.utime(fname, (stamp, stamp))
+            configuration.LTSVarsConfig(fname, use_cache=True)
+
+        results = [
+            ('parse', best_of(runs,
+                              lambda: configuration.LTSVarsConfig(fname))),
+            ('cold', best_of(runs, cold)),
+            ('warm', best_of(runs, lambda: configuration.LTSVarsConfig(
+                fname, use_cache=True))),
+            ('restamped', best_of(runs, restamped)),
+        ]
+        entries = len(configuration.LTSVarsConfig(fname).vars)
+        print "%d variables, %d bytes of source, best of %d runs" % (
+            entries, os.path.getsize(fname), runs)
+        for label, seconds in results:
+            print "  %-10s %8.3f ms" % (label, seconds * 1000)
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
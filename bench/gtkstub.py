@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Just enough of pygtk for the benchmarks to drive ltsp-config.py's tree
+and combobox code without a display.
+
+install() puts stand-in pygtk, gtk and gobject modules in sys.modules, where
+the real ones can't be imported.  The models keep their rows in plain Python
+lists, so timings through them measure ltsp-config's own work plus a
+roughly constant per-row cost, not gtk's -- fine for comparing one commit
+with another, not for absolute numbers.  Widgets accept and ignore any
+method call.
+"""
+
+import sys
+import types
+
+
+def _ignore(*args, **kwargs):
+    return None
+
+
+class Widget(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _ignore
+
+
+class TreeStore(object):
+    """Rows are [values, parent, children] lists, which double as iters."""
+    def __init__(self, *types):
+        self.clear()
+
+    def clear(self):
+        self.root = [None, None, []]
+
+    def append(self, parent, values):
+        parent = parent or self.root
+        row = [list(values), parent, []]
+        parent[2].append(row)
+        return row
+
+    def remove(self, row):
+        row[1][2].remove(row)
+
+    def get_value(self, row, column):
+        return row[0][column]
+
+    def set_value(self, row, column, value):
+        row[0][column] = value
+
+    def iter_parent(self, row):
+        parent = row[1]
+        return None if parent is self.root else parent
+
+    def __len__(self):
+        return len(self.root[2])
+
+
+class ListStore(object):
+    """Iters are row numbers."""
+    def __init__(self, *types):
+        self.rows = []
+
+    def clear(self):
+        del self.rows[:]
+
+    def append(self, values):
+        self.rows.append(list(values))
+        return len(self.rows) - 1
+
+    def insert(self, position, values):
+        self.rows.insert(position, list(values))
+        return position
+
+    def get_iter(self, path):
+        return path[0]
+
+    def remove(self, position):
+        del self.rows[position]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ComboBox(Widget):
+    def __init__(self, model=None):
+        self.model = model
+
+    def get_model(self):
+        return self.model
+
+    def set_model(self, model):
+        self.model = model
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def install(force=False):
+    """Make pygtk, gtk and gobject importable, with the stand-ins unless the
+    real ones are there and force is false.  Returns True if the stand-ins
+    are in use."""
+    if not force:
+        try:
+            import pygtk
+            pygtk.require('2.0')
+            import gtk
+            import gobject
+            return False
+        except (ImportError, RuntimeError, AssertionError):
+            pass
+    gdk = _module('gtk.gdk', threads_init=_ignore)
+    gtk = _module('gtk', gdk=gdk, TreeView=Widget, List=Widget,
+                  Builder=Widget, TreeStore=TreeStore, ListStore=ListStore,
+                  ComboBox=ComboBox, main=_ignore, main_quit=_ignore)
+    sys.modules['pygtk'] = _module('pygtk', require=_ignore)
+    sys.modules['gtk'] = gtk
+    sys.modules['gtk.gdk'] = gdk
+    sys.modules['gobject'] = _module('gobject', threads_init=_ignore,
+                                     idle_add=_ignore)
+    return True
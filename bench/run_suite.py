@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite for the hot paths, one timing per stage.
+
+    python bench/run_suite.py [options]
+
+Generates an lts.conf (and, with --vars-copies, a bigger lts_vars.conf) in a
+scratch directory and times, best of --runs:
+    vars_parse      LTSVarsConfig parsing lts_vars.conf, no cache
+    vars_cache      LTSVarsConfig loading from a warm cache
+    conf_parse      LTSConfDocument.load
+    validate        a new LTSPValidator checking every value
+    tokenize        data_validation.tokenize of every value, cache emptied
+    tree_sections   update_config_treeview adding the section rows
+    tree_fill       _fill_section on every section (expanding them all)
+    combobox        update_option_combobox refilling the option names
+    index_build     LTSConfDocument.index building the inverted index
+    search          ConfIndex.search running each of SEARCH_QUERIES
+    bulk_edit       configuration.bulk_set of LDM_SERVER in every section,
+                    through uiHelpers.apply_edits into a filled tree
+    undo            EditJournal.undo of that edit, through apply_edits
+    expand_all      ExpandedConfig.expand_all of every client section
+    expand_update   ExpandedConfig.update after SERVER is changed in
+                    [Default], and expand_all of every client again
+The tree and combobox stages run ltsp-config.py's own code against the models
+in gtkstub.py when pygtk isn't there (or with --stub), so they run headless.
+
+Results are written as JSON to --output (default stdout).  Given --compare
+with an earlier result file, each stage is also compared with it, and the
+exit status is 1 if any got slower by more than --threshold (default 0.1,
+i.e. 10%) and by at least a millisecond, below which it's mostly noise.
+
+Options:
+    --sections N      sections in the lts.conf (default 2000)
+    --options N       option lines per section (default 20)
+    --duplicates R    rate of option lines repeating a key (default 0.02)
+    --invalid R       rate of invalid values (default 0.1)
+    --vars-copies N   copies of lts_vars.conf's entries (default 1)
+    --runs N          runs per stage (default 5)
+    --seed N          seed of the generated file (default 0)
+    --stub            use the gtk stand-ins even if pygtk is installed
+"""
+
+import getopt
+import imp
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import configuration
+import data_validation
+import gtkstub
+from synthetic import generate_conf, write_vars_file
+
+
+# filter bar queries for the search stage: a value, a typed comparison, a
+# regex on values, and substrings of section names and values
+SEARCH_QUERIES = ['X_COLOR_DEPTH = 16', 'VOLUME > 80', 'SCREEN_07 ~ ^l',
+                  '00:16:3e:00:0f', '/3e:00:0[12]:/', 'ldm',
+                  'X_COLOR_DEPTH = 16 VOLUME > 80']
+
+
+class Quiet(object):
+    """Sends stdout (validation warnings, mostly) to /dev/null while
+    timing."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def time_stage(runs, setup, run):
+    """Timings of run(setup()) -- setup isn't timed."""
+    timings = []
+    for _ in xrange(runs):
+        with Quiet():
+            state = setup()
+            start = time.time()
+            run(state)
+            timings.append(time.time() - start)
+    return timings
+
+
+def load_ui(force_stub):
+    """ltsp-config.py as a module, and whether it runs on the stand-ins."""
+    stubbed = gtkstub.install(force_stub)
+    import gtk
+    cwd = os.getcwd()
+    os.chdir(ROOT)  # it reads lts_vars.conf from the current directory
+    try:
+        ui = imp.load_source('ltsp_config', os.path.join(ROOT,
+                                                         'ltsp-config.py'))
+    finally:
+        os.chdir(cwd)
+    return ui, gtk, stubbed
+
+
+def make_editor(ui, gtk, config, vars_meta):
+    """A uiHelpers with just the widgets the tree and combobox code use."""
+    editor = ui.uiHelpers()
+    editor.config = config
+    editor.config_filename = config.fname
+    editor.loaded = True
+    editor.vars_meta = vars_meta
+    editor.validator = data_validation.LTSPValidator(vars_meta)
+    editor.validation_errors = {}
+    editor.checked_sections = set()
+    editor.option_names = configuration.NameIndex(vars_meta.vars)
+    editor._combobox_names = None
+    editor.config_treeview = ui.uiTreeView(gtk.TreeStore(str, str, str,
+                                                         bool))
+    editor.main_window = gtkstub.Widget()
+    editor.option_combobox = gtkstub.ComboBox(gtk.ListStore(str))
+    return editor
+
+
+def run_stages(params, runs, force_stub):
+    scratch = tempfile.mkdtemp()
+    try:
+        vars_fname = os.path.join(scratch, 'lts_vars.conf')
+        write_vars_file(vars_fname, params['vars_copies'])
+        vars_meta = configuration.LTSVarsConfig(vars_fname, use_cache=True)
+        conf_fname = os.path.join(scratch, 'lts.conf')
+        with open(conf_fname, 'w') as conf:
+            conf.write(generate_conf(vars_meta, params['sections'],
+                                     params['options'],
+                                     params['duplicates'],
+                                     params['invalid'], params['seed']))
+        config = configuration.LTSConfDocument()
+        config.load(conf_fname)
+        items = [item for section in config.sections()
+                 for item in config.items(section)]
+        ui, gtk, stubbed = load_ui(force_stub)
+
+        def editor():
+            return make_editor(ui, gtk, config, vars_meta)
+
+        def filled_editor():
+            state = editor()
+            state.update_config_treeview()
+            return state
+
+        def check_all(validator_class):
+            validator = validator_class(vars_meta)
+            for option, value in items:
+                validator.check_data(option, value)
+
+        def tokenize_all(values):
+            for value in values:
+                data_validation.tokenize(value)
+
+        def uncached_values():
+            data_validation._shell_values.clear()
+            return [value for option, value in items]
+
+        def fill_all(state):
+            for section in config.sections():
+                state._fill_section(section)
+
+        def indexed_config():
+            document = configuration.LTSConfDocument(
+                schema=data_validation.LTSPValidator(vars_meta))
+            document.load(conf_fname)
+            return document
+
+        def search_all(index):
+            for query in SEARCH_QUERIES:
+                index.search(query)
+
+        def bulk_edit(state):
+            changes = configuration.bulk_set(state.config,
+                                             state.config.sections(),
+                                             'LDM_SERVER', '10.0.0.2')
+            state.apply_edits(changes)
+            return changes
+
+        def edited_copy():
+            state = filled_copy()
+            state.journal = configuration.EditJournal()
+            state.journal.record(bulk_edit(state))
+            return state
+
+        def undo(state):
+            state.apply_edits(state.journal.undo(state.config))
+
+        def filled_copy():
+            state = filled_editor()
+            state.config = indexed_config()
+            fill_all(state)
+            return state
+
+        def expanded_config():
+            return configuration.ExpandedConfig(config, vars_meta)
+
+        def expand_all(expanded):
+            for section in expanded.effective.clients():
+                expanded.expand_all(section=section)
+
+        def server_changed():
+            document = indexed_config()
+            expanded = configuration.ExpandedConfig(document, vars_meta)
+            expand_all(expanded)
+            changes = configuration.bulk_set(document, ['Default'], 'SERVER',
+                                             '10.0.0.3')
+            return expanded, changes
+
+        def expand_update(state):
+            expanded, changes = state
+            expanded.update(changes)
+            expand_all(expanded)
+
+        def refill_combobox(state):
+            state.option_names = configuration.NameIndex(
+                list(vars_meta.vars) + [option for option, value in items])
+            return state
+
+        nothing = lambda: None
+        stages = [
+            ('vars_parse', nothing,
+             lambda state: configuration.LTSVarsConfig(vars_fname)),
+            ('vars_cache', nothing,
+             lambda state: configuration.LTSVarsConfig(vars_fname,
+                                                       use_cache=True)),
+            ('conf_parse', nothing,
+             lambda state: configuration.LTSConfDocument().load(conf_fname)),
+            ('validate', lambda: data_validation.LTSPValidator, check_all),
+            ('tokenize', uncached_values, tokenize_all),
+            ('tree_sections', editor,
+             lambda state: state.update_config_treeview()),
+            ('tree_fill', filled_editor, fill_all),
+            ('combobox', lambda: refill_combobox(editor()),
+             lambda state: state.update_option_combobox()),
+            ('index_build', indexed_config, lambda state: state.index()),
+            ('search', lambda: indexed_config().index(), search_all),
+            ('bulk_edit', filled_copy, bulk_edit),
+            ('undo', edited_copy, undo),
+            ('expand_all', expanded_config, expand_all),
+            ('expand_update', server_changed, expand_update),
+        ]
+        results = {}
+        for name, setup, run in stages:
+            timings = time_stage(runs, setup, run)
+            results[name] = {'best': min(timings),
+                             'median': sorted(timings)[len(timings) // 2],
+                             'runs': timings}
+        return results, stubbed, len(items)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def git_revision():
+    """The current commit, marked if the tree has uncommitted changes."""
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short',
+                                            'HEAD'], cwd=ROOT).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+# smallest slowdown, in seconds, counted as a regression
+NOISE_FLOOR = 0.001
+
+
+def compare(old, new, threshold):
+    """Print how each stage moved since old; returns the regressed ones."""
+    if old.get('params') != new['params']:
+        print >> sys.stderr, ("Warning: compared results were made with "
+                              "different parameters: %s" % old.get('params'))
+    regressed = []
+    print >> sys.stderr, "%-14s %10s %10s %8s" % ('stage', 'before', 'after',
+                                                  'change')
+    for name in sorted(new['stages']):
+        after = new['stages'][name]['best']
+        if name not in old.get('stages', {}):
+            print >> sys.stderr, "%-14s %10s %9.1fms" % (name, '-',
+                                                         after * 1000)
+            continue
+        before = old['stages'][name]['best']
+        change = after / before - 1 if before else 0.0
+        mark = ''
+        if change > threshold and after - before >= NOISE_FLOOR:
+            regressed.append(name)
+            mark = '  REGRESSION'
+        print >> sys.stderr, "%-14s %8.1fms %8.1fms %+7.1f%%%s" % (
+            name, before * 1000, after * 1000, change * 100, mark)
+    return regressed
+
+
+def main(args):
+    try:
+        opts, rest = getopt.gnu_getopt(args, 'h', [
+            'sections=', 'options=', 'duplicates=', 'invalid=',
+            'vars-copies=', 'runs=', 'seed=', 'output=', 'compare=',
+            'threshold=', 'stub', 'help'])
+        params = {'sections': 2000, 'options': 20, 'duplicates': 0.02,
+                  'invalid': 0.1, 'vars_copies': 1, 'seed': 0}
+        runs = 5
+        output = None
+        compare_fname = None
+        threshold = 0.1
+        force_stub = False
+        for opt, val in opts:
+            if opt in ('-h', '--help'):
+                print __doc__
+                return 0
+            elif opt in ('--sections', '--options', '--vars-copies',
+                         '--seed'):
+                params[opt[2:].replace('-', '_')] = int(val)
+            elif opt in ('--duplicates', '--invalid'):
+                params[opt[2:]] = float(val)
+            elif opt == '--runs':
+                runs = int(val)
+            elif opt == '--output':
+                output = val
+            elif opt == '--compare':
+                compare_fname = val
+            elif opt == '--threshold':
+                threshold = float(val)
+            elif opt == '--stub':
+                force_stub = True
+    except (getopt.GetoptError, ValueError), e:
+        print >> sys.stderr, "Argument Error: %s!" % e
+        return 2
+
+    stages, stubbed, lines = run_stages(params, runs, force_stub)
+    result = {'revision': git_revision(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'stub_gtk': stubbed,
+              'params': params,
+              'distinct_options': lines,
+              'stages': stages}
+    text = json.dumps(result, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if output:
+        with open(output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print text
+    if compare_fname:
+        with open(compare_fname) as old:
+            if compare(json.load(old), result, threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic lts.conf and lts_vars.conf files for the benchmarks.
+
+generate_conf makes an lts.conf of a given shape out of the variables in an
+LTSVarsConfig; write_vars_file (from bench_vars_cache) makes a bigger
+lts_vars.conf by repeating the stock one under new names.  Both are seeded,
+so the same arguments always give the same file.
+"""
+
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from bench_validation import SAMPLES
+from bench_vars_cache import write_vars_file
+
+
+def generate_conf(vars_meta, sections, options, duplicate_rate=0.0,
+                  invalid_rate=0.0, seed=0):
+    """Text of an lts.conf with a [Default] section and sections - 1 client
+    sections, each of options option lines.  duplicate_rate of the option
+    lines repeat a key already set in their section (and are reported as
+    duplicates when read), and invalid_rate of the values are bad for their
+    variable's data type, where the type has bad values to pick."""
+    rand = random.Random(seed)
+    variables = list(vars_meta)
+    lines = []
+    for index in xrange(sections):
+        if index:
+            lines.append('[00:16:3e:%02x:%02x:%02x]' % (
+                index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff))
+        else:
+            lines.append('[Default]')
+        keys = []
+        for _ in xrange(options):
+            if keys and rand.random() < duplicate_rate:
+                var = vars_meta[rand.choice(keys)]
+            else:
+                var = rand.choice(variables)
+                keys.append(var.name)
+            valid, invalid = SAMPLES[var.datatype]
+            if invalid and rand.random() < invalid_rate:
+                value = rand.choice(invalid)
+            else:
+                value = rand.choice(valid)
+            lines.append('%s = %s' % (var.name, value))
+    return '\n'.join(lines) + '\n'
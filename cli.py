@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+"""Command line (non-GUI) modes for ltsp-config.
+
+These run without pygtk or a DISPLAY, so they can be used from scripts and
+deployment hooks.  ltsp-config.py hands over to main() here when it is
+started with one of the CLI_COMMANDS options:
+
+    ltsp-config.py --check [--vars FILE] [--strict] [--jobs N] FILE|DIR...
+    ltsp-config.py --resolve [--client NAME]... [--canonical] [--expand]
+                   [--vars FILE] FILE
+    ltsp-config.py --diff [--vars FILE] OLD NEW
+    ltsp-config.py --merge [--vars FILE] [--output FILE] BASE OURS THEIRS
+    ltsp-config.py --apply [--output FILE] PATCH FILE
+    ltsp-config.py --edit [--section NAME]... [--where QUERY] [--output FILE]
+                   (--set OPTION=VALUE | --unset OPTION |
+                    --rename OPTION=NEW)... FILE
+
+--check validates one or more lts.conf files against the variable metadata
+in lts_vars.conf and prints one JSON object per problem found, e.g.:
+    {"error": "...", "file": "lts.conf", "line": 12, "option": "VOLUME",
+     "section": "Default", "severity": "error"}
+Unknown options are reported with severity "warning", and only count as
+errors when --strict is given.  The exit status is 0 if no errors were
+found, 1 if there were errors, and 2 on usage or I/O errors.
+Directories are searched for *.conf files.  With --jobs N, files are checked
+by a pool of N worker processes (0 means one per CPU); the output is the same
+as with a single process, in the same order.
+
+--resolve prints the effective settings of every client section in an
+lts.conf file (see configuration.EffectiveConfig), one JSON object per
+client, with the section each value comes from, e.g.:
+    {"client": "00:11:22:33:44:55",
+     "settings": {"VOLUME": {"from": "Default", "value": "50"}, ...}}
+With --client, only the named clients (a MAC, IP or hostname each) are
+printed, whether or not they have a section of their own.  With --canonical,
+valid values are printed in their canonical spelling (e.g. "True" for
+"yes"; see data_validation.DataType.serialize), each parsed only once
+however many clients get it.  With --expand, references to other
+variables are expanded the way the client's shell would (see
+configuration.ExpandedConfig), "$SERVER:8080" becoming "10.0.0.1:8080",
+say; variables that aren't set fall back to their defaults in --vars where
+those are references themselves, and each client gets an "order" list of
+its options in the order a script setting them would need.  References that
+loop back on themselves are left as written and printed to stderr.  Values
+are printed as the shell sees them, without their quotes.  --canonical only
+applies to those that don't reference anything, and its spellings are
+unquoted the same way ("pa\\$s" is printed as pa$s).
+
+--diff compares two lts.conf files by section and option name (so order
+doesn't matter) and by the canonical spelling of values (so "yes" and
+"True" are equal for a boolean), and prints a patch: one JSON object per
+change (see configuration.ConfChange), e.g.:
+    {"kind": "changed", "new": "80", "old": "50", "option": "VOLUME",
+     "section": "Default"}
+"option" is null for whole sections added or removed.  The exit status is
+0 if the files are the same, 1 if they differ.
+--apply makes the changes in such a patch to FILE.
+--merge does a three-way merge: the changes between BASE and THEIRS are
+made to OURS, except where OURS changed the same option differently; those
+keep OURS' value and are printed to stderr as JSON conflicts.  The exit
+status is 1 if there were conflicts.
+--apply and --merge write the result to --output (default: stdout), keeping
+the comments, layout and unchanged lines of FILE or OURS as they were.
+
+--edit sets, unsets or renames options across many sections at once: the
+sections named with --section, plus those matching --where QUERY (a filter
+bar query, see configuration.ConfIndex.search; an empty one matches every
+section).  The edits are made in the order given, e.g.
+    ltsp-config.py --edit --where 'LDM_SERVER = 10.0.0.1' \\
+        --set LDM_SERVER=10.0.0.2 --output lts.conf lts.conf
+New values are validated once each however many sections they go to; if
+any is invalid, the errors are printed and nothing is written (exit status
+1).  The result is written like --apply's, and the number of changes made
+to stderr.
+"""
+
+import ConfigParser
+import getopt
+import json
+import multiprocessing
+import os
+import sys
+
+import configuration
+import data_validation
+
+
+VARS_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'lts_vars.conf')
+
+CLI_COMMANDS = ('--check', '--resolve', '--diff', '--merge', '--apply',
+                '--edit')
+
+USAGE = """\
+Usage: ltsp-config.py --check [--vars FILE] [--strict] [--jobs N] FILE|DIR...
+       ltsp-config.py --resolve [--client NAME]... [--canonical] [--expand]
+                      [--vars FILE] FILE
+       ltsp-config.py --diff [--vars FILE] OLD NEW
+       ltsp-config.py --merge [--vars FILE] [--output FILE] BASE OURS THEIRS
+       ltsp-config.py --apply [--output FILE] PATCH FILE
+       ltsp-config.py --edit [--section NAME]... [--where QUERY]
+                      [--output FILE] (--set OPTION=VALUE | --unset OPTION |
+                      --rename OPTION=NEW)... FILE
+
+  --check        validate lts.conf FILEs, printing problems as JSON lines
+  --vars FILE    variable metadata to validate against (default: %s)
+  --strict       treat unknown options as errors
+  --jobs N       check files in N processes (0: one per CPU)
+  --resolve      print the effective settings of each client in FILE
+  --client NAME  only resolve the client with this MAC, IP or hostname
+  --canonical    print resolved values in their canonical spelling
+  --expand       expand references to other variables in resolved values
+  --diff         print the changes from OLD to NEW as a JSON lines patch
+  --merge        merge the changes from BASE to THEIRS into OURS
+  --apply        make the changes in PATCH to FILE
+  --edit         edit many sections of FILE at once
+  --section NAME edit this section
+  --where QUERY  edit the sections matching this filter query
+  --set OPTION=VALUE, --unset OPTION, --rename OPTION=NEW
+                 the edits to make, in order
+  --output FILE  where --merge, --apply and --edit write to (default: stdout)
+  -h, --help     show this message
+""" % VARS_CONFIG_FILE
+
+
+def is_cli_invocation(args):
+    """True if the command line asks for one of the non-GUI modes."""
+    return any(arg in CLI_COMMANDS for arg in args)
+
+
+def _diagnostic(fname, record, error, severity='error'):
+    return {'file': fname, 'section': record.section, 'option': record.key,
+            'line': record.lineno, 'error': error, 'severity': severity}
+
+
+def check_file(fname, validator):
+    """Yield a diagnostic dict for every problem in the lts.conf file fname.
+    The file is streamed, so its size doesn't matter.  LIKE lines are
+    checked for naming a section of the file once it has all been read, so
+    their diagnostics come last."""
+    plan_for = validator.plan_for
+    sections = set()  # lower-cased, as LIKE matches them
+    likes = []
+    with open(fname, 'rb') as conf:
+        for record in configuration.iter_records(conf):
+            kind = record.kind
+            if kind == configuration.SECTION:
+                sections.add(record.section.lower())
+                continue
+            elif kind == configuration.INVALID:
+                error = "Unparseable line: %s" % record.value
+                yield _diagnostic(fname, record, error)
+                continue
+            elif kind == configuration.ORPHAN:
+                error = "Option outside of any [section]"
+                yield _diagnostic(fname, record, error)
+            elif kind == configuration.DUPLICATE:
+                if record.key is None:
+                    error = "Section [%s] appears more than once"
+                    yield _diagnostic(fname, record, error % record.section,
+                                      'warning')
+                    continue
+                error = "Option '%s' set more than once in [%s]"
+                yield _diagnostic(fname, record,
+                                  error % (record.key, record.section),
+                                  'warning')
+            if record.key == configuration.LIKE_OPTION:
+                likes.append(record)
+                continue
+            check = plan_for(record.key)
+            if check is None:
+                error = "Unknown option '%s'" % record.key
+                yield _diagnostic(fname, record, error, 'warning')
+                continue
+            error = check(record.value)
+            if error:
+                yield _diagnostic(fname, record, error)
+    for record in likes:
+        profile = data_validation.tokenize(record.value).text
+        if profile.lower() not in sections:
+            error = "LIKE refers to missing section [%s]" % profile
+            yield _diagnostic(fname, record, error)
+
+
+def find_conf_files(paths):
+    """paths, with directories replaced by the *.conf files below them, in
+    sorted order."""
+    fnames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            fnames.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            fnames.extend(os.path.join(dirpath, filename)
+                          for filename in sorted(filenames)
+                          if filename.endswith('.conf'))
+    return fnames
+
+
+def _check_file_output(fname, validator, strict):
+    """(JSON lines, error count) for the file fname."""
+    lines = []
+    errors = 0
+    for diagnostic in check_file(fname, validator):
+        if strict or diagnostic['severity'] == 'error':
+            errors += 1
+        lines.append(json.dumps(diagnostic, sort_keys=True) + '\n')
+    return ''.join(lines), errors
+
+
+# the validator of a --jobs worker process, set up once by _init_worker
+_worker_validator = None
+
+
+def _init_worker(validator):
+    global _worker_validator
+    _worker_validator = validator
+
+
+def _check_file_task(task):
+    fname, strict = task
+    return _check_file_output(fname, _worker_validator, strict)
+
+
+def check_files(fnames, validator, out=sys.stdout, strict=False, jobs=1):
+    """Check each file in fnames, writing diagnostics to out as JSON lines.
+    Returns the number of errors found (warnings count too if strict).
+    If jobs isn't 1, the files are checked by a pool of that many processes
+    (or one per CPU if jobs is 0 or None).  Each worker gets the validator
+    once, when it starts -- with fork, without copying or re-parsing the
+    variable metadata -- and results are written in the order of fnames, so
+    the output doesn't depend on the number of jobs."""
+    errors = 0
+    if jobs == 1 or len(fnames) < 2:
+        for fname in fnames:
+            text, file_errors = _check_file_output(fname, validator, strict)
+            out.write(text)
+            errors += file_errors
+        return errors
+    pool = multiprocessing.Pool(jobs or None, _init_worker, (validator,))
+    try:
+        tasks = [(fname, strict) for fname in fnames]
+        for text, file_errors in pool.imap(_check_file_task, tasks):
+            out.write(text)
+            errors += file_errors
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return errors
+
+
+def resolve_file(fname, clients=None, out=sys.stdout, schema=None,
+                 expand=False, vars_meta=None):
+    """Write the effective settings of the clients in the lts.conf file
+    fname to out as JSON lines -- of every client section, or of each name
+    in clients.  LIKE problems are printed to stderr.  Given a schema (an
+    LTSPValidator), valid values are written in their canonical spelling.
+    With expand set, the settings are given to expand_file instead."""
+    config = configuration.LTSConfDocument(schema=schema)
+    config.load(fname)
+
+    def canonical(origin, option, value):
+        try:
+            return config.canonical(origin, option)
+        except ValueError:
+            return value
+
+    if expand:
+        expand_file(config, clients, out, canonical if schema else None,
+                    vars_meta)
+        return
+    effective = configuration.EffectiveConfig(config)
+    for section, problem in effective.problems:
+        print >> sys.stderr, "Warning: [%s] %s" % (section, problem)
+    if clients:
+        resolved = ((name, effective.resolve(name, name, name))
+                    for name in clients)
+    else:
+        resolved = effective.resolve_all()
+    for client, settings in resolved:
+        if schema is not None:
+            settings = dict((option, (canonical(origin, option, value),
+                                      origin))
+                            for option, (value, origin)
+                            in settings.iteritems())
+        settings = dict((option, {'value': value, 'from': origin})
+                        for option, (value, origin) in settings.iteritems())
+        out.write(json.dumps({'client': client, 'settings': settings},
+                             sort_keys=True) + '\n')
+
+
+def expand_file(config, clients, out, canonical=None, vars_meta=None):
+    """resolve_file's work for --expand: the settings of the clients of
+    config with their references expanded, each with the 'order' they'd
+    be set in.  canonical(origin, option, value), if given, spells the
+    values that don't reference anything; like the expanded ones, they're
+    written as the shell sees them, without quotes.  LIKE problems and
+    looping references are printed to stderr once every client is
+    written."""
+    expanded = configuration.ExpandedConfig(config, vars_meta)
+    if clients:
+        resolved = ((name, expanded.expand_all(name, name, name))
+                    for name in clients)
+    else:
+        resolved = ((client, expanded.expand_all(section=client))
+                    for client in expanded.effective.clients())
+    for client, settings in resolved:
+        values = {}
+        for option, value, origin in settings:
+            if canonical is not None and origin is not None:
+                written = config.get(origin, option)
+                if not data_validation.tokenize(written).refs:
+                    value = data_validation.tokenize(
+                        canonical(origin, option, written)).text
+            values[option] = {'value': value, 'from': origin}
+        out.write(json.dumps({'client': client, 'settings': values,
+                              'order': [option for option, value, origin
+                                        in settings]},
+                             sort_keys=True) + '\n')
+    for section, problem in expanded.problems:
+        print >> sys.stderr, "Warning: [%s] %s" % (section, problem)
+
+
+def _load_document(fname, schema=None):
+    document = configuration.LTSConfDocument(schema=schema)
+    document.load(fname)
+    return document
+
+
+def _write_document(document, output):
+    if output is None:
+        sys.stdout.write(document.render())
+    else:
+        document.save(output)
+
+
+def diff_files(old_fname, new_fname, schema, out=sys.stdout):
+    """Write the changes from one lts.conf file to another to out as a
+    JSON lines patch.  Returns the number of changes."""
+    changes = configuration.diff_configs(_load_document(old_fname),
+                                         _load_document(new_fname), schema)
+    for change in changes:
+        out.write(json.dumps(change._asdict(), sort_keys=True) + '\n')
+    return len(changes)
+
+
+def merge_files(base_fname, our_fname, their_fname, schema, output=None):
+    """Merge the changes from base to theirs into ours, writing the result
+    to the file output (or stdout) and the conflicts to stderr.  Returns
+    the number of conflicts."""
+    ours = _load_document(our_fname)
+    changes, conflicts = configuration.merge_configs(
+        _load_document(base_fname), ours, _load_document(their_fname),
+        schema)
+    configuration.apply_changes(ours, changes)
+    for conflict in conflicts:
+        print >> sys.stderr, json.dumps(conflict._asdict(), sort_keys=True)
+    _write_document(ours, output)
+    return len(conflicts)
+
+
+def apply_patch(patch_fname, fname, output=None):
+    """Make the changes in a --diff patch to the lts.conf file fname,
+    writing the result to the file output (or stdout)."""
+    changes = []
+    with open(patch_fname) as patch:
+        for line in patch:
+            if not line.strip():
+                continue
+            # json gives unicode; the config is byte strings throughout,
+            # which --diff wrote out as UTF-8
+            fields = dict((str(key), value if value is None
+                           else value.encode('utf-8'))
+                          for key, value in json.loads(line).iteritems())
+            changes.append(configuration.ConfChange(**fields))
+    document = _load_document(fname)
+    configuration.apply_changes(document, changes)
+    _write_document(document, output)
+
+
+def edit_file(fname, edits, sections=(), query=None, schema=None,
+              output=None):
+    """Make edits, a list of ('set', OPTION, VALUE), ('unset', OPTION, None)
+    and ('rename', OPTION, NEW) in the order given, to the named sections of
+    the lts.conf file fname and those matching query (see
+    configuration.ConfIndex.search), and write the result to the file
+    output (or stdout).  Given a schema, the new values are validated, each
+    distinct one once; if any is invalid, the errors are printed to stderr
+    and nothing is written.  Returns the number of invalid values."""
+    document = _load_document(fname, schema)
+    selected = list(sections)
+    if query is not None:
+        matches = document.index().search(query)
+        selected.extend(section for section in document.sections()
+                        if matches is None or section in matches)
+    changes = []
+    for edit, option, argument in edits:
+        if edit == 'set':
+            changes.extend(configuration.bulk_set(document, selected, option,
+                                                  argument))
+        elif edit == 'unset':
+            changes.extend(configuration.bulk_unset(document, selected,
+                                                    option))
+        else:
+            changes.extend(configuration.bulk_rename(document, selected,
+                                                     option, argument))
+    errors = 0
+    if schema is not None:
+        checked = set()
+        for change in changes:
+            key = (change.option, change.new)
+            if change.new is None or key in checked or \
+               schema.type_for(change.option) is None:
+                continue
+            checked.add(key)
+            error = schema.check_data(change.option, change.new)
+            if error:
+                print >> sys.stderr, "Error: bad value %s for %s: %s" % (
+                    change.new, change.option, error.split(': ', 2)[-1])
+                errors += 1
+    if errors:
+        return errors
+    _write_document(document, output)
+    print >> sys.stderr, "%d change(s) in %d section(s)" % (
+        len(changes), len(set(change.section for change in changes)))
+    return 0
+
+
+def main(args):
+    try:
+        opts, fnames = getopt.gnu_getopt(args, 'h', ['check', 'vars=',
+                                                    'strict', 'resolve',
+                                                    'client=', 'jobs=',
+                                                    'canonical', 'expand',
+                                                    'diff',
+                                                    'merge', 'apply',
+                                                    'output=', 'edit',
+                                                    'section=', 'where=',
+                                                    'set=', 'unset=',
+                                                    'rename=', 'help'])
+    except getopt.GetoptError, e:
+        print >> sys.stderr, "Argument Error: %s!" % e
+        print >> sys.stderr, USAGE
+        return 2
+
+    command = '--check'
+    vars_fname = VARS_CONFIG_FILE
+    strict = False
+    clients = []
+    jobs = 1
+    canonical = False
+    expand = False
+    output = None
+    sections = []
+    query = None
+    edits = []
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            print USAGE
+            return 0
+        elif opt in CLI_COMMANDS:
+            command = opt
+        elif opt == '--vars':
+            vars_fname = val
+        elif opt == '--strict':
+            strict = True
+        elif opt == '--client':
+            clients.append(val)
+        elif opt == '--canonical':
+            canonical = True
+        elif opt == '--expand':
+            expand = True
+        elif opt == '--output':
+            output = val
+        elif opt == '--section':
+            sections.append(val)
+        elif opt == '--where':
+            query = val
+        elif opt == '--unset':
+            edits.append(('unset', val, None))
+        elif opt in ('--set', '--rename'):
+            option, equals, argument = val.partition('=')
+            if not equals or not option.strip():
+                print >> sys.stderr, "Argument Error: %s needs OPTION=%s!" % (
+                    opt, 'VALUE' if opt == '--set' else 'NEW')
+                return 2
+            edits.append((opt[2:], option.strip(), argument.strip()))
+        elif opt == '--jobs':
+            try:
+                jobs = int(val)
+            except ValueError:
+                jobs = -1
+            if jobs < 0:
+                print >> sys.stderr, "Argument Error: bad --jobs %s!" % val
+                return 2
+
+    # how many files each command takes (--check takes any number)
+    expected_files = {'--resolve': 1, '--diff': 2, '--merge': 3,
+                      '--apply': 2, '--edit': 1}.get(command)
+    if not fnames or (expected_files and len(fnames) != expected_files):
+        print >> sys.stderr, USAGE
+        return 2
+    if command == '--edit' and not (edits and (sections or
+                                                query is not None)):
+        print >> sys.stderr, ("Argument Error: --edit needs --set, --unset "
+                              "or --rename, and --section or --where!")
+        return 2
+    try:
+        validator = vars_meta = None
+        if command != '--apply' and (command != '--resolve' or canonical or
+                                     expand):
+            vars_meta = configuration.LTSVarsConfig(vars_fname,
+                                                    use_cache=True)
+        if command != '--apply' and (command != '--resolve' or canonical):
+            validator = data_validation.LTSPValidator(vars_meta)
+        if command == '--resolve':
+            resolve_file(fnames[0], clients, schema=validator, expand=expand,
+                         vars_meta=vars_meta)
+            return 0
+        elif command == '--diff':
+            return 1 if diff_files(fnames[0], fnames[1], validator) else 0
+        elif command == '--merge':
+            return 1 if merge_files(fnames[0], fnames[1], fnames[2],
+                                    validator, output) else 0
+        elif command == '--apply':
+            apply_patch(fnames[0], fnames[1], output)
+            return 0
+        elif command == '--edit':
+            return 1 if edit_file(fnames[0], edits, sections, query,
+                                  validator, output) else 0
+        errors = check_files(find_conf_files(fnames), validator,
+                             strict=strict, jobs=jobs)
+    except (IOError, OSError, ConfigParser.NoSectionError,
+            configuration.QueryError), e:
+        print >> sys.stderr, "Error: %s" % e
+        return 2
+    return 1 if errors else 0
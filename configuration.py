@@ -2,8 +2,19 @@
 """This is a module for storing classes and methods relating to parsing
 configuration data from config files and representing it in a useful way."""
 
-from collections import namedtuple
+from collections import deque, namedtuple
+from cStringIO import StringIO
+import bisect
 import ConfigParser
+import hashlib
+import itertools
+import json
+import marshal
+import operator
+import os
+import re
+import tempfile
+import time
 import data_validation
 
 ## To add new permitted data types to the LTSVarsConfig (and consequently to
@@ -17,6 +28,70 @@ VALID_DATATYPES = data_validation.get_data_types()
 VarConfig = namedtuple('LTSVarOptions', 'name datatype default description')
 
 
+class VarRange(namedtuple('VarRange', 'prefix suffix first last width '
+                                      'datatype default description')):
+    """A family of numbered variables declared on one line, such as
+    CRONTAB_01...CRONTAB_10 or PRINTER_0_DEVICE...PRINTER_99_DEVICE: the
+    names prefix + number + suffix for every number from first to last
+    (inclusive), with the number zero-padded to 'width' digits, or not
+    padded at all if width is 0.  Names are checked and their VarConfig
+    made on demand, so a family takes the same space however wide it is.
+    """
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def name(self, number):
+        return '%s%0*d%s' % (self.prefix, self.width, number, self.suffix)
+
+    def names(self):
+        return (self.name(number)
+                for number in xrange(self.first, self.last + 1))
+
+    def number(self, digits):
+        """The number the string digits stands for in this family's names,
+        or None if no name in the family has digits there."""
+        if self.width:
+            if len(digits) != self.width:
+                return None
+        elif len(digits) > 1 and digits.startswith('0'):
+            return None
+        number = int(digits)
+        if self.first <= number <= self.last:
+            return number
+        return None
+
+    def entry(self, name):
+        return VarConfig(name, self.datatype, self.default, self.description)
+
+_DIGITS = re.compile(r'\d+')
+
+# A single record read from an lts.conf file by iter_records.  'kind' is one
+# of the record kinds below, and 'span' holds the (start, end) byte offsets of
+# the line the record was read from, newline included.
+ConfRecord = namedtuple('ConfRecord', 'kind section key value lineno span')
+
+# record kinds
+SECTION = 'section'      # a [section] header
+OPTION = 'option'        # a KEY = value line
+DUPLICATE = 'duplicate'  # an option line for a key already set earlier in
+                         # the section, or a repeated section header (key
+                         # None).  ConfigParser keeps the last value.
+ORPHAN = 'orphan'        # an option line before any section header
+INVALID = 'invalid'      # anything else that isn't a comment or blank; the
+                         # stripped line is the value.  That includes the
+                         # first line of a value left open (see
+                         # iter_records).
+
+# same rules as ConfigParser uses for section headers and option lines
+_SECTION_LINE = re.compile(r'\[(?P<name>[^]]+)\]')
+_OPTION_LINE = re.compile(r'(?P<key>[^:=\s][^:=]*?)\s*[:=]\s*(?P<value>.*)$')
+# most lines a value may go on over before it's taken for a stray quote
+MAX_VALUE_LINES = 100
+
+
 class LTSVarsConfig(object):
     """A container object which parses and represents configuration data for
     the variable options (typically in lts.conf.options) for the ltsp-config
@@ -53,12 +128,48 @@ class LTSVarsConfig(object):
         CRONTAB_01...CRONTAB_10: string, default unset : description here
     ..the above example config would generate 11 entries -- one each for
     CRONTAB_01 through CRONTAB_10, and one for CONFIGURE_FSTAB.
+    Ranged names are kept as a single VarRange per line, and only expanded
+    as they are iterated over or looked up, so wide ranges such as
+    X_OPTION_01...X_OPTION_99 cost no more than narrow ones.  The number may
+    sit anywhere in the name (PRINTER_0_DEVICE...PRINTER_9_DEVICE), and is
+    only zero-padded if the first name is (FOO_01...FOO_10 vs FOO_1...FOO_10).
+    ### Cache ###
+    With use_cache=True, the parsed entries are saved to a marshal file next
+    to the config file (<lts_conf_fname>.cache) and loaded from there on the
+    next run, as long as the config file still has the same mtime and size,
+    or failing that, the same SHA-1.  Otherwise the file is parsed again and
+    the cache rewritten.  A cache that can't be read or written is ignored.
     """
-    def __init__(self, lts_conf_fname):
+    # bump this whenever the layout of the cached data changes
+    CACHE_VERSION = 2
+
+    def __init__(self, lts_conf_fname, use_cache=False):
         self.fname = lts_conf_fname
+        self.cache_fname = lts_conf_fname + '.cache'
+        self._reset()
+        if use_cache and self._load_cache():
+            return
+        self._parse()
+        if use_cache:
+            self._write_cache()
+
+    def _reset(self):
+        self._entries = []    # VarConfig and VarRange records, in file order
+        self._data_dict = {}  # name -> VarConfig of the single variables
+        self._ranges = {}     # (prefix, suffix) -> [VarRange]
+        self._offsets = None  # list index of the first name of each entry
+
+    def _add(self, entry):
+        self._entries.append(entry)
+        self._offsets = None
+        if isinstance(entry, VarRange):
+            self._ranges.setdefault((entry.prefix, entry.suffix),
+                                    []).append(entry)
+        else:
+            self._data_dict[entry.name] = entry
+
+    def _parse(self):
         raw_data = open(self.fname).readlines()
-        self._data_list = []
-        self._data_dict = {}
         lineno = 0
         for line in raw_data:
             lineno += 1
@@ -89,67 +200,168 @@ class LTSVarsConfig(object):
                 self._handle_ranged_names(lineno, name, datatype, default,
                                           description)
             else:
-                item = VarConfig(name, datatype, default, description)
-                self._data_list.append(item)
-                self._data_dict[item.name] = item
+                self._add(VarConfig(name, datatype, default, description))
+
+    def _source_hash(self):
+        with open(self.fname, 'rb') as source:
+            return hashlib.sha1(source.read()).hexdigest()
+
+    def _load_cache(self):
+        """Load entries from the cache file.  Returns False, leaving this
+        object empty, if there's no usable cache for the current file."""
+        try:
+            with open(self.cache_fname, 'rb') as cache:
+                version, mtime, size, digest, entries = marshal.load(cache)
+            stat = os.stat(self.fname)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        if version != self.CACHE_VERSION:
+            return False
+        restamp = (mtime, size) != (stat.st_mtime, stat.st_size)
+        if restamp and digest != self._source_hash():
+            return False
+        for entry in entries:
+            if len(entry) == len(VarRange._fields):
+                self._add(VarRange(*entry))
+            else:
+                self._add(VarConfig(*entry))
+        if restamp:
+            # same content under a new mtime (touched, copied..), so the
+            # entries are good -- just record the new stamp.
+            self._write_cache(digest)
+        return True
+
+    def _write_cache(self, digest=None):
+        try:
+            stat = os.stat(self.fname)
+            data = (self.CACHE_VERSION, stat.st_mtime, stat.st_size,
+                    digest or self._source_hash(),
+                    [tuple(entry) for entry in self._entries])
+            # write to a temporary file first, so a concurrent reader never
+            # sees a half-written cache
+            tmp_fname = '%s.%d.tmp' % (self.cache_fname, os.getpid())
+            with open(tmp_fname, 'wb') as cache:
+                marshal.dump(data, cache)
+            os.rename(tmp_fname, self.cache_fname)
+        except (IOError, OSError):
+            pass
+
+    def _find(self, name):
+        """The VarConfig for name, or None.  Ranged names are found by trying
+        each run of digits in name as the number of a family."""
+        item = self._data_dict.get(name)
+        if item is not None or not self._ranges:
+            return item
+        for match in _DIGITS.finditer(name):
+            families = self._ranges.get((name[:match.start()],
+                                         name[match.end():]))
+            if families:
+                for family in families:
+                    if family.number(match.group()) is not None:
+                        return family.entry(name)
+        return None
 
     def __contains__(self, name):
         """'foo' in conf -> True if conf contains info for a variable foo
         """
-        return name in self._data_dict
+        return self._find(name) is not None
+
+    def _index(self):
+        if self._offsets is None:
+            offsets = []
+            total = 0
+            for entry in self._entries:
+                offsets.append(total)
+                total += entry.size if isinstance(entry, VarRange) else 1
+            self._offsets = offsets
+            self._length = total
+        return self._offsets
+
+    def __len__(self):
+        self._index()
+        return self._length
 
     def __getitem__(self, ref):
         """Allows items to be fetched either by their index or by their name.
         """
         if isinstance(ref, int):
-            return self._data_list[ref]
-        else:
-            return self._data_dict[ref]
+            offsets = self._index()
+            if ref < 0:
+                ref += self._length
+            if not 0 <= ref < self._length:
+                raise IndexError(ref)
+            position = bisect.bisect_right(offsets, ref) - 1
+            entry = self._entries[position]
+            if isinstance(entry, VarRange):
+                return entry.entry(entry.name(entry.first + ref -
+                                              offsets[position]))
+            return entry
+        item = self._find(ref)
+        if item is None:
+            raise KeyError(ref)
+        return item
 
     def __iter__(self):
-        return (entry for entry in self._data_list)
+        for entry in self._entries:
+            if isinstance(entry, VarRange):
+                for name in entry.names():
+                    yield entry.entry(name)
+            else:
+                yield entry
+
+    def single_vars(self):
+        """The VarConfig of every variable declared on its own rather than
+        as part of a range."""
+        return [entry for entry in self._entries
+                if not isinstance(entry, VarRange)]
+
+    def ranges(self):
+        """The VarRange of every ranged declaration."""
+        return [entry for entry in self._entries
+                if isinstance(entry, VarRange)]
 
     def _handle_ranged_names(self, lineno, name, datatype, default,
                              description):
         """Some names contain ellipses, as in:
             X_FOO_01...X_FOO_10
-            ..this method creates a range of names to fulfill this, and makes
-            an entry for each.  For this to work, the names must be identical
-            until the numerical part, and separated by ellipses (...).
+            ..this method adds a VarRange for the family of names.  For this
+            to work, the names must be identical apart from one run of
+            digits, and separated by ellipses (...).
         """
-        left, right = name.split('...')
-        if len(left) != len(right):
+        left, right = [part.strip() for part in name.split('...', 1)]
+        for match in _DIGITS.finditer(left):
+            prefix, suffix = left[:match.start()], left[match.end():]
+            digits = right[len(prefix):len(right) - len(suffix)]
+            if (len(right) > len(prefix) + len(suffix)
+                    and right.startswith(prefix) and right.endswith(suffix)
+                    and digits.isdigit()):
+                break
+        else:
             reason = "invalid names for range value: %s and %s"
             message = "Invalid line (%d) in config -- " + reason
             print message % (lineno, left, right)
             return
-        for needle in xrange(0, len(left)):
-            if left[needle] != right[needle]:
-                break
-        try:
-            num_len = len(left[needle:])
-            # this will end with a string like:
-            # FOO_BASENAME_%02d
-            # ..which will be used to assemble names.
-            base_name = left[:needle] + '%0' + str(num_len) + 'd'
-            left_value = int(left[needle:])
-            right_value = int(right[needle:])
-        except ValueError:
-            reason = "invalid number in names for range value: %s and %s"
+        first = match.group()
+        width = len(first) if first.startswith('0') and len(first) > 1 else 0
+        if width and len(digits) != width:
+            reason = "numbers of different widths in range value: %s and %s"
             message = "Invalid line (%d) in config -- " + reason
             print message % (lineno, left, right)
-        names = [base_name % i for i in xrange(left_value, right_value)]
-        for numbered_name in names:
-            item = VarConfig(numbered_name, datatype, default, description)
-            self._data_list.append(item)
-            self._data_dict[item.name] = item
+            return
+        if int(digits) < int(first):
+            reason = "range value runs backwards: %s and %s"
+            message = "Invalid line (%d) in config -- " + reason
+            print message % (lineno, left, right)
+            return
+        self._add(VarRange(prefix, suffix, int(first), int(digits), width,
+                           datatype, default, description))
 
     def __repr__(self):
         return 'LTSVarsConfig(%s)' % self.fname
 
     @property
     def vars(self):
-        return [v.name for v in self._data_list]
+        return [v.name for v in self]
 
 
 class __Parser(object):
@@ -178,3 +390,1814 @@ class Raw(ConfigParser.RawConfigParser, __Parser):
 
 class Safe(ConfigParser.SafeConfigParser, __Parser):
     pass
+
+
+def iter_records(fileobj, offset=0, lineno=0):
+    """Read an lts.conf file line by line, yielding a ConfRecord for each
+    section header, option line and bad line, in file order.  Comment lines
+    (# or ;) and blank lines are skipped.
+    fileobj should be opened in binary mode, so spans are byte offsets.
+    When reading part of a file, offset and lineno give the byte offset and
+    the number of lines before the part, for spans and line numbers to count
+    from.
+    Nothing is kept around except the keys of the current section (to spot
+    duplicates) and the names of sections seen so far, so memory use doesn't
+    grow with the file.  Unlike ConfigParser, this keeps going after a line
+    without a section, and reports duplicate keys instead of merging them.
+    As lts.conf is sourced by a shell on the client, a value left inside
+    quotes or ending in a backslash goes on in the next line: the record's
+    value is then everything up to where it ends, newlines included, and
+    its span covers all of its lines (lineno is the first one's).  A value
+    still open at a section header, at the end of the file or after
+    MAX_VALUE_LINES lines is more likely a stray quote (as in an unquoted
+    "don't") than a long value, so its first line is yielded as INVALID,
+    and the lines after it are read as usual.
+    """
+    section = None
+    section_keys = set()
+    sections = set()
+    source = iter(fileobj)
+    # started again, with the lines read ahead, after an unterminated value
+    while source is not None:
+        lines, source = source, None
+        for raw in lines:
+            lineno += 1
+            span = (offset, offset + len(raw))
+            offset = span[1]
+            line = raw.strip()
+            if not line or line[0] in '#;':
+                continue
+            match = _SECTION_LINE.match(line)
+            if match:
+                section = match.group('name')
+                section_keys = set()
+                kind = DUPLICATE if section in sections else SECTION
+                sections.add(section)
+                yield ConfRecord(kind, section, None, None, lineno, span)
+                continue
+            match = _OPTION_LINE.match(line)
+            if not match:
+                yield ConfRecord(INVALID, section, None, line, lineno, span)
+                continue
+            key = match.group('key')
+            value = match.group('value')
+            first = lineno
+            if value[-1:] == '\\' or '"' in value or "'" in value:
+                # tokenize only tells for sure; most values don't get this
+                # far
+                start = len(raw) - len(raw.lstrip()) + match.start('value')
+                parts = [raw[start:]]
+                while data_validation.tokenize(
+                        ''.join(parts).rstrip('\r\n')).open:
+                    more = next(lines, None)
+                    if more is None or len(parts) == MAX_VALUE_LINES or \
+                       _SECTION_LINE.match(more.strip()):
+                        # unterminated -- the lines after the first are
+                        # read again
+                        if more is not None:
+                            parts.append(more)
+                        source = itertools.chain(parts[1:], lines)
+                        break
+                    lineno += 1
+                    offset += len(more)
+                    parts.append(more)
+                if source is not None:
+                    lineno = first
+                    offset = span[1]
+                    yield ConfRecord(INVALID, section, None, line, first,
+                                     span)
+                    break
+                if len(parts) > 1:
+                    value = ''.join(parts).rstrip()
+                    span = (span[0], offset)
+            if section is None:
+                kind = ORPHAN
+            elif key in section_keys:
+                kind = DUPLICATE
+            else:
+                kind = OPTION
+                section_keys.add(key)
+            yield ConfRecord(kind, section, key, value, first, span)
+
+
+class NameIndex(object):
+    """A sorted multiset of option names, for completion and pick lists.
+    Each name is counted once per add() -- e.g. once for being a known
+    variable, and once for every section that sets it -- and stays in the
+    index until it has been discard()ed as many times.  add() and discard()
+    return the position at which a name entered or left the sorted list (or
+    None if the list didn't change), so a view of the list can be patched
+    instead of rebuilt.  'generation' increases with every such change.
+    """
+    def __init__(self, names=()):
+        self._counts = {}
+        for name in names:
+            self._counts[name] = self._counts.get(name, 0) + 1
+        self._sorted = sorted(self._counts)
+        self._joined = None
+        self.generation = 0
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def __iter__(self):
+        return iter(self._sorted)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def add(self, name):
+        count = self._counts.get(name, 0)
+        self._counts[name] = count + 1
+        if count:
+            return None
+        position = bisect.bisect_left(self._sorted, name)
+        self._sorted.insert(position, name)
+        self._joined = None
+        self.generation += 1
+        return position
+
+    def discard(self, name):
+        count = self._counts.get(name, 0)
+        if count > 1:
+            self._counts[name] = count - 1
+            return None
+        if not count:
+            return None
+        del self._counts[name]
+        position = bisect.bisect_left(self._sorted, name)
+        del self._sorted[position]
+        self._joined = None
+        self.generation += 1
+        return position
+
+    def prefix_matches(self, prefix, limit=None):
+        """Names starting with prefix, in order."""
+        names = self._sorted
+        matches = []
+        position = bisect.bisect_left(names, prefix)
+        while position < len(names) and names[position].startswith(prefix):
+            if len(matches) == limit:
+                break
+            matches.append(names[position])
+            position += 1
+        return matches
+
+    def substring_matches(self, text, limit=None):
+        """Names containing text, in order.  This searches one newline-joined
+        string of all the names with str.find, rather than testing names one
+        by one in python; the string is rebuilt after the index changes."""
+        if not text:
+            return self._sorted[:limit]
+        if '\n' in text:
+            return []
+        if self._joined is None:
+            self._joined = '\n%s\n' % '\n'.join(self._sorted)
+        joined = self._joined
+        matches = []
+        position = joined.find(text)
+        while position != -1 and len(matches) != limit:
+            start = joined.rfind('\n', 0, position) + 1
+            end = joined.find('\n', position)
+            matches.append(joined[start:end])
+            position = joined.find(text, end)
+        return matches
+
+
+class QueryError(ValueError):
+    """Raised by ConfIndex.search for a query it can't run, such as a bad
+    regular expression or a typed comparison with an invalid value."""
+    pass
+
+
+# one term of a ConfIndex query: OPTION OP VALUE, /regex/, or plain text
+_QUERY_TERM = re.compile(r'''\s*(?:
+    (?P<option>[\w.-]+)\s*(?P<op><=|>=|!=|==?|<|>|~)\s*
+        (?P<value>"[^"]*"|'[^']*'|\S+)
+  | /(?P<regex>(?:[^/\\]|\\.)+)/
+  | (?P<text>"[^"]*"|'[^']*'|\S+)
+)''', re.VERBOSE)
+
+_COMPARISONS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne,
+                '<': operator.lt, '<=': operator.le, '>': operator.gt,
+                '>=': operator.ge}
+
+
+def _unquote_term(text):
+    if len(text) > 1 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+
+class ConfIndex(object):
+    """An inverted index of an LTSConfDocument, option -> value -> the names
+    of the sections setting it, for finding sections by what they set
+    without walking them all.  LTSConfDocument.index() makes one and keeps
+    it up to date through every change to the document.
+    search() takes queries of whitespace separated terms, all of which must
+    match a section:
+        text            in the section name, an option name or a value
+                        (case-insensitive); quote it to include spaces
+        /regex/         searched for in section names and values
+        OPTION ~ regex  searched for in the values of OPTION
+        OPTION = VALUE  (or !=, <, <=, >, >=) comparing the values of OPTION
+                        as their data type (e.g. VOLUME > 80 as integers),
+                        given a schema; otherwise as numbers if both sides
+                        are, else as strings
+    Option names in queries are case-insensitive.  The work is in the number
+    of distinct (option, value) pairs, not the number of sections.
+    """
+    def __init__(self, schema=None):
+        self.schema = schema
+        self._values = {}  # option -> {value: set of section names}
+        self._options = {}  # lowercased option -> set of options
+        self.sections = NameIndex()
+
+    def add_section(self, section, items=()):
+        self.sections.add(section)
+        for option, value in items:
+            self.add(section, option, value)
+
+    def discard_section(self, section, items=()):
+        self.sections.discard(section)
+        for option, value in items:
+            self.discard(section, option, value)
+
+    def add(self, section, option, value):
+        values = self._values.get(option)
+        if values is None:
+            values = self._values[option] = {}
+            self._options.setdefault(option.lower(), set()).add(option)
+        sections = values.get(value)
+        if sections is None:
+            sections = values[value] = set()
+        sections.add(section)
+
+    def discard(self, section, option, value):
+        values = self._values.get(option, {})
+        sections = values.get(value)
+        if sections is None:
+            return
+        sections.discard(section)
+        if not sections:
+            del values[value]
+            if not values:
+                del self._values[option]
+                options = self._options[option.lower()]
+                options.discard(option)
+                if not options:
+                    del self._options[option.lower()]
+
+    def sections_with(self, option, value=None):
+        """Names of the sections setting option (to value, if given)."""
+        values = self._values.get(option, {})
+        if value is not None:
+            return set(values.get(value, ()))
+        found = set()
+        for sections in values.itervalues():
+            found.update(sections)
+        return found
+
+    def search(self, query):
+        """Names of the sections matching every term of query (see the class
+        docstring), or None if query has no terms."""
+        found = None
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            term = _QUERY_TERM.match(query, position)
+            position = term.end()
+            if term.group('option'):
+                matches = self._compare(term.group('option'),
+                                        term.group('op'),
+                                        _unquote_term(term.group('value')))
+            elif term.group('regex'):
+                matches = self._search_regex(term.group('regex'))
+            else:
+                matches = self._search_text(_unquote_term(term.group('text')))
+            found = matches if found is None else found & matches
+            if not found:
+                break
+        return found
+
+    def _values_of(self, option):
+        """(value, sections) pairs of every option spelled like option."""
+        for name in self._options.get(option.lower(), ()):
+            for pair in self._values[name].iteritems():
+                yield name, pair
+
+    def _search_text(self, text):
+        text = text.lower()
+        found = set(section for section in self.sections
+                    if text in section.lower())
+        for option, values in self._values.iteritems():
+            if text in option.lower():
+                for sections in values.itervalues():
+                    found.update(sections)
+                continue
+            for value, sections in values.iteritems():
+                if text in value.lower():
+                    found.update(sections)
+        return found
+
+    def _search_regex(self, pattern):
+        search = self._regex(pattern).search
+        found = set(section for section in self.sections if search(section))
+        for values in self._values.itervalues():
+            for value, sections in values.iteritems():
+                if search(value):
+                    found.update(sections)
+        return found
+
+    def _regex(self, pattern):
+        try:
+            return re.compile(pattern)
+        except re.error, e:
+            raise QueryError('bad regular expression /%s/: %s' % (pattern, e))
+
+    def _compare(self, option, op, value):
+        found = set()
+        if op == '~':
+            search = self._regex(value).search
+            for name, (candidate, sections) in self._values_of(option):
+                if search(candidate):
+                    found.update(sections)
+            return found
+        compare = _COMPARISONS[op]
+        bounds = {}  # option name -> typed value to compare with
+        for name, (candidate, sections) in self._values_of(option):
+            if name not in bounds:
+                bounds[name] = self._typed(name, value)
+            bound = bounds[name]
+            try:
+                if self.schema is not None and self.schema.type_for(name):
+                    candidate = self.schema.parse_value(name, candidate)[0]
+                elif isinstance(bound, float):
+                    candidate = float(candidate)
+                if compare(candidate, bound):
+                    found.update(sections)
+            except (ValueError, TypeError):
+                # values that aren't valid match no comparison
+                pass
+        return found
+
+    def _typed(self, option, value):
+        """The value a query compares the values of option with, as the
+        option's data type, or as a number or string for unknown options.
+        Raises QueryError if value isn't valid for the option."""
+        if self.schema is not None and self.schema.type_for(option):
+            try:
+                return self.schema.parse_value(option, value)[0]
+            except ValueError, e:
+                raise QueryError('%s: %s' % (option, e))
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+class LoadCancelled(Exception):
+    """Raised by LTSConfDocument.load when its progress callback returns
+    False."""
+    pass
+
+
+class _Entangled(Exception):
+    """Raised when part of a document can't be read on its own, because
+    what it holds depends on text outside of it."""
+    pass
+
+
+def _common_prefix_length(a, b):
+    """Length of the longest common prefix of the strings a and b.  Found by
+    bisection, comparing buffers rather than copies, so the work is a
+    couple of memcmp()s over the prefix."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if buffer(a, low, middle - low) == buffer(b, low, middle - low):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _at_line_start(text, offset):
+    return not offset or text[offset - 1] == '\n'
+
+
+def _common_suffix_length(a, b, limit):
+    """Length of the longest common suffix of a and b, up to limit."""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if (buffer(a, len(a) - middle, middle - low) ==
+                buffer(b, len(b) - middle, middle - low)):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _Option(object):
+    """One option of an LTSConfDocument.  'start' is the offset of its line
+    in the document's text, or None for options added since the text was
+    read; the spans of the line and of the value in it are worked out from
+    the text when needed (see LTSConfDocument._line_span).  'original' is
+    the value as read, to tell which values were edited.  'shadowed' holds
+    the starts of earlier lines setting the same key, which the last one
+    overrides.  'parsed' caches the (typed value, canonical string) pair
+    of the value, or the ValueError it raised, once asked for (see
+    LTSConfDocument.typed).
+    There is one of these per option line of a file, so they have slots
+    rather than a __dict__, and keep no more than they must."""
+    __slots__ = ('key', 'value', 'original', 'start', 'shadowed', 'parsed')
+
+    def __init__(self, key, value, start=None):
+        self.key = key
+        self.value = value
+        self.original = value if start is not None else None
+        self.start = start
+        self.shadowed = ()
+        self.parsed = None
+
+
+class _Section(object):
+    """One section of an LTSConfDocument.  'blocks' holds a [start, end]
+    offset pair per header line for the section (there can be several if
+    the header is repeated), running from the header to the end of the last
+    line that belongs to it.  New options are inserted at the end of the
+    last block.  'blocks' is empty for sections added since the text was
+    read.  'options' maps keys to _Options, and 'keys' holds the keys in
+    order."""
+    __slots__ = ('name', 'blocks', 'keys', 'options')
+
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []
+        self.keys = []
+        self.options = {}
+
+    def items(self):
+        options = self.options
+        return [(key, options[key].value) for key in self.keys]
+
+
+class _SectionsView(object):
+    """The sections() and items() of a list of _Sections, for diffing part of
+    an LTSConfDocument, or a document as it was before being reloaded."""
+    def __init__(self, section_list):
+        self._list = section_list
+        self._by_name = dict((section.name, section)
+                             for section in section_list)
+
+    def sections(self):
+        return [section.name for section in self._list]
+
+    def items(self, name):
+        return self._by_name[name].items()
+
+
+class LTSConfDocument(object):
+    """An editable, format-preserving model of an lts.conf file.
+    Supports the parts of the ConfigParser interface the GUI uses (sections,
+    has_section, options, has_option, items, get, set, add_section,
+    remove_section, remove_option, write), with ConfigParser's semantics:
+    keys are case sensitive, and when a key is set more than once in a
+    section the last value wins (the first line keeps its place in the
+    order).
+    Unlike ConfigParser, the original text of the file is kept, along with
+    the offsets of every section and option in it.  Saving patches only the
+    spans of values, options and sections that were changed, added or
+    removed -- comments, blank lines, ordering, quoting and lines the reader
+    didn't understand are written back untouched.
+    To keep large files small in memory, option names and short values are
+    interned as the text is read, so each distinct one is stored once, and
+    sections are kept in a list with a name index rather than an
+    OrderedDict.
+    Given a schema (a data_validation.LTSPValidator), the document also
+    hands out typed values: typed() and canonical() parse a value the first
+    time they're asked for it, and keep the result until the value changes.
+    Example:
+        >>> doc = LTSConfDocument()
+        >>> problems = doc.load('lts.conf')   # see iter_records for these
+        >>> doc.set('Default', 'VOLUME', '80')
+        >>> doc.typed('Default', 'VOLUME')
+        80
+        >>> doc.save()                       # writes lts.conf atomically
+    """
+    def __init__(self, fname=None, schema=None):
+        self.fname = fname
+        self.schema = schema
+        self.modified = False
+        # bumped on every change to the model, so things derived from it
+        # (e.g. an EffectiveConfig) can tell when they are out of date
+        self.changes = 0
+        self._parse('')
+
+    # how many records to parse between calls to a load progress callback
+    PROGRESS_INTERVAL = 5000
+    # values up to this long are interned while parsing; longer ones are
+    # rarely repeated
+    INTERN_VALUE_LENGTH = 32
+
+    def _parse(self, text, progress=None):
+        """Build the model from text, returning the problem records."""
+        self.changes += 1
+        self._text = text
+        self._section_list = []
+        self._sections = {}  # name -> _Section
+        self._deleted = []  # spans to cut out of the text when saving
+        self._index = None  # ConfIndex, made by index()
+        return self._read(text, 0, len(text), self._section_list, progress)
+
+    def _read(self, text, begin, finish, section_list, progress=None):
+        """Read the sections in text[begin:finish] into self._sections,
+        appending them to section_list, and return the problem records.
+        When reading part of the text (begin > 0), raises _Entangled if it
+        doesn't start with a section header, or has a header for a section
+        that is already in self._sections."""
+        problems = []
+        section = None
+        created = {}
+        values = {}
+        intern_length = self.INTERN_VALUE_LENGTH
+        countdown = self.PROGRESS_INTERVAL
+        part = text
+        if begin or finish != len(text):
+            part = text[begin:finish]
+        records = iter_records(StringIO(part), begin,
+                               text.count('\n', 0, begin))
+        for record in records:
+            kind = record.kind
+            start, end = record.span
+            if progress is not None:
+                countdown -= 1
+                if not countdown:
+                    countdown = self.PROGRESS_INTERVAL
+                    if progress(end, len(text)) is False:
+                        self._parse('')
+                        raise LoadCancelled(self.fname)
+            if kind in (SECTION, DUPLICATE) and record.key is None:
+                section = created.get(record.section)
+                if section is None:
+                    if record.section in self._sections:
+                        raise _Entangled(record.section)
+                    section = _Section(record.section)
+                    created[record.section] = section
+                    section_list.append(section)
+                    self._sections[record.section] = section
+                section.blocks.append([start, end])
+            elif section is None and begin:
+                raise _Entangled(record)
+            elif kind in (OPTION, DUPLICATE):
+                # a value can't go on past the part: values are cut short
+                # at section headers, and parts end at one
+                section.blocks[-1][1] = end
+                key = intern(record.key)
+                value = record.value
+                if len(value) <= intern_length:
+                    value = values.setdefault(value, value)
+                option = _Option(key, value, start)
+                previous = section.options.get(key)
+                if previous is None:
+                    section.keys.append(key)
+                else:
+                    option.shadowed = previous.shadowed + (previous.start,)
+                section.options[key] = option
+            elif section is not None:
+                section.blocks[-1][1] = end
+            if kind not in (SECTION, OPTION):
+                problems.append(record)
+        return problems
+
+    @property
+    def source(self):
+        """The text the document was read from, or last saved as."""
+        return self._text
+
+    def set_schema(self, schema):
+        """Switch to another schema (after lts_vars.conf changed, say),
+        forgetting the typed values worked out with the old one."""
+        self.schema = schema
+        for section in self._section_list:
+            for option in section.options.itervalues():
+                option.parsed = None
+        if self._index is not None:
+            self._index.schema = schema
+
+    def index(self):
+        """The ConfIndex of the document, for finding sections by what they
+        set.  It's made on first use, and kept up to date through every
+        change to the document from then on."""
+        if self._index is None:
+            index = ConfIndex(self.schema)
+            for section in self._section_list:
+                index.add_section(section.name, section.items())
+            self._index = index
+        return self._index
+
+    def _line_span(self, start):
+        """(start, end) of the option line starting at start, newline (and
+        any lines its value goes on in) included."""
+        end = self._text.find('\n', start)
+        end = len(self._text) if end == -1 else end + 1
+        line = self._text[start:end]
+        if line.rstrip()[-1:] == '\\' or '"' in line or "'" in line:
+            text = StringIO(self._text)
+            text.seek(start)
+            return next(iter_records(text, start)).span
+        return start, end
+
+    def _value_span(self, option):
+        """(start, end) of the value of option as read.  The value is all
+        that's left of its line(s) after the separator, minus surrounding
+        whitespace."""
+        start, end = self._line_span(option.start)
+        value_end = start + len(self._text[start:end].rstrip())
+        return value_end - len(option.original), value_end
+
+    def reload(self, text):
+        """Bring the document in line with text, a new version of its file
+        (written by another program, say), dropping any unsaved edits.
+        Returns (changes, problems): the [ConfChange] from the document as
+        it was to the new one (see diff_configs), and the problem records of
+        the text that was read again.
+        Only the sections whose lines changed are read again: the changed
+        byte range is found by comparing text with the old text, widened to
+        the blocks of the sections it touches, and just that part of text is
+        parsed; everything after it only has its offsets shifted.  If that
+        part can't be read on its own (say, a section header moved in or
+        out of it) or there were unsaved edits, the whole text is parsed
+        again instead."""
+        if not self.modified:
+            try:
+                return self._reload_part(text)
+            except _Entangled:
+                pass
+        old_sections = list(self._section_list)
+        problems = self._parse(text)
+        self.modified = False
+        return (diff_configs(_SectionsView(old_sections), self), problems)
+
+    def _reload_part(self, text):
+        old = self._text
+        if text == old:
+            return [], []
+        prefix = _common_prefix_length(old, text)
+        suffix = _common_suffix_length(old, text,
+                                       min(len(old), len(text)) - prefix)
+        changed_end = len(old) - suffix
+        delta = len(text) - len(old)
+        blocks = sorted((block[0], block[1], section)
+                        for section in self._section_list
+                        for block in section.blocks)
+        starts = [block[0] for block in blocks]
+        # read again from the start of the last block starting before the
+        # change (it takes whatever lines are added) up to the next block
+        # starting after it, in whole lines of both texts
+        finish = changed_end
+        if not (_at_line_start(old, finish) and
+                _at_line_start(text, finish + delta)):
+            finish = old.find('\n', finish) + 1 or len(old)
+        first = bisect.bisect_left(starts, prefix) - 1
+        last = max(first, bisect.bisect_left(starts, finish) - 1)
+        begin = blocks[first][0] if first >= 0 else 0
+        finish = starts[last + 1] if last + 1 < len(starts) else len(old)
+        affected = []
+        for start, end, section in blocks[max(first, 0):last + 1]:
+            if section not in affected:
+                affected.append(section)
+        for section in affected:
+            if section.blocks[0][0] < begin or section.blocks[-1][1] > finish:
+                raise _Entangled(section.name)
+        for section in affected:
+            del self._sections[section.name]
+        section_list = []
+        try:
+            problems = self._read(text, begin, finish + delta, section_list)
+        except _Entangled:
+            for section in section_list:
+                del self._sections[section.name]
+            for section in affected:
+                self._sections[section.name] = section
+            raise
+        # splice the new sections in where the old ones were, and move the
+        # offsets of everything after them
+        before = [section for section in self._section_list
+                  if section.blocks[0][0] < begin]
+        after = [section for section in self._section_list
+                 if section.blocks[0][0] >= finish]
+        if delta:
+            for section in before + after:
+                if section.blocks[-1][0] < finish:
+                    continue
+                for block in section.blocks:
+                    if block[0] >= finish:
+                        block[0] += delta
+                        block[1] += delta
+                for option in section.options.itervalues():
+                    if option.start >= finish:
+                        option.start += delta
+                    if option.shadowed:
+                        option.shadowed = tuple(
+                            start + delta if start >= finish else start
+                            for start in option.shadowed)
+        self._section_list = before + section_list + after
+        if self._index is not None:
+            for section in affected:
+                self._index.discard_section(section.name, section.items())
+            for section in section_list:
+                self._index.add_section(section.name, section.items())
+        self._text = text
+        self.changes += 1
+        return (diff_configs(_SectionsView(affected),
+                             _SectionsView(section_list)), problems)
+
+    def load(self, fname, progress=None):
+        """Replace the document with the contents of the file fname.  Returns
+        the DUPLICATE, ORPHAN and INVALID records found (see iter_records);
+        orphaned and invalid lines are kept in the text, but not modelled.
+        If given, progress(bytes_done, bytes_total) is called every so often
+        while parsing; if it returns False, loading stops, the document is
+        left empty and LoadCancelled is raised."""
+        with open(fname, 'rb') as conf:
+            text = conf.read()
+        self.fname = fname
+        self.modified = False
+        return self._parse(text, progress)
+
+    def sections(self):
+        return [section.name for section in self._section_list]
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def add_section(self, section):
+        if section in self._sections:
+            raise ConfigParser.DuplicateSectionError(section)
+        self._sections[section] = _Section(section)
+        self._section_list.append(self._sections[section])
+        if self._index is not None:
+            self._index.add_section(section)
+        self.modified = True
+        self.changes += 1
+
+    def remove_section(self, section):
+        """Remove a section and everything in it.  Returns True if it
+        existed."""
+        removed = self._sections.pop(section, None)
+        if removed is None:
+            return False
+        self._section_list.remove(removed)
+        self._deleted.extend(tuple(block) for block in removed.blocks)
+        if self._index is not None:
+            self._index.discard_section(section, removed.items())
+        self.modified = True
+        self.changes += 1
+        return True
+
+    def _section(self, section):
+        try:
+            return self._sections[section]
+        except KeyError:
+            raise ConfigParser.NoSectionError(section)
+
+    def options(self, section):
+        return list(self._section(section).keys)
+
+    def has_option(self, section, option):
+        return (section in self._sections
+                and option in self._sections[section].options)
+
+    def items(self, section):
+        return self._section(section).items()
+
+    def get(self, section, option):
+        try:
+            return self._section(section).options[option].value
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, section)
+
+    def _parsed(self, section, option):
+        try:
+            option = self._section(section).options[option]
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, section)
+        parsed = option.parsed
+        if parsed is None:
+            if self.schema is None:
+                parsed = (option.value, option.value)
+            else:
+                try:
+                    parsed = self.schema.parse_value(option.key, option.value)
+                except ValueError, e:
+                    parsed = e
+            option.parsed = parsed
+        if isinstance(parsed, ValueError):
+            raise parsed
+        return parsed
+
+    def typed(self, section, option):
+        """The typed value of an option (see data_validation.DataType.parse).
+        Raises ValueError if the value isn't valid for the option; values
+        of unknown options, and every value if there's no schema, are
+        strings."""
+        return self._parsed(section, option)[0]
+
+    def canonical(self, section, option):
+        """The value of an option in its canonical spelling, e.g. 'True' for
+        a boolean set to 'yes'.  Raises ValueError like typed()."""
+        return self._parsed(section, option)[1]
+
+    def set(self, section, option, value):
+        name = section
+        section = self._section(section)
+        options = section.options
+        if value is None:
+            value = ''
+        if option in options:
+            if options[option].value == value:
+                return
+            if self._index is not None:
+                self._index.discard(name, option, options[option].value)
+            options[option].value = value
+            options[option].parsed = None
+        else:
+            options[option] = _Option(option, value)
+            section.keys.append(option)
+        if self._index is not None:
+            self._index.add(name, option, value)
+        self.modified = True
+        self.changes += 1
+
+    def remove_option(self, section, option):
+        """Remove every line setting option in section.  Returns True if the
+        option existed."""
+        name = section
+        section = self._section(section)
+        removed = section.options.pop(option, None)
+        if removed is None:
+            return False
+        section.keys.remove(option)
+        if self._index is not None:
+            self._index.discard(name, option, removed.value)
+        if removed.start is not None:
+            self._deleted.append(self._line_span(removed.start))
+        self._deleted.extend(self._line_span(start)
+                             for start in removed.shadowed)
+        self.modified = True
+        self.changes += 1
+        return True
+
+    def _patches(self):
+        """[(start, end, replacement)] turning the original text into the
+        current state of the document, in order."""
+        patches = [(start, end, '') for start, end in self._deleted]
+        appended = []
+        newline_at_eof = self._text.endswith('\n')
+        for section in self._section_list:
+            added = []
+            options = section.options
+            for key in section.keys:
+                option = options[key]
+                if option.start is None:
+                    added.append('%s = %s\n' % (option.key, option.value))
+                elif option.value != option.original:
+                    start, end = self._value_span(option)
+                    patches.append((start, end, option.value))
+            if not section.blocks:
+                appended.append('\n[%s]\n%s' % (section.name, ''.join(added)))
+            elif added:
+                end = section.blocks[-1][1]
+                if self._text[end - 1:end] != '\n':
+                    added.insert(0, '\n')
+                patches.append((end, end, ''.join(added)))
+                if end == len(self._text):
+                    newline_at_eof = True
+        if appended:
+            end = len(self._text)
+            if self._text and not newline_at_eof:
+                appended.insert(0, '\n')
+            elif not self._text:
+                # no blank line in front of the first section of a new file
+                appended[0] = appended[0][1:]
+            patches.append((end, end, ''.join(appended)))
+        # insertions sort ahead of deletions starting at the same offset, so
+        # text added at the end of a section isn't swallowed by the removal
+        # of whatever follows it
+        patches.sort(key=lambda patch: (patch[0], patch[1] != patch[0]))
+        return patches
+
+    def render(self):
+        """The text of the document as it would be saved."""
+        pieces = []
+        position = 0
+        for start, end, replacement in self._patches():
+            pieces.append(self._text[position:start])
+            pieces.append(replacement)
+            position = max(position, end)
+        pieces.append(self._text[position:])
+        return ''.join(pieces)
+
+    def write(self, fileobj):
+        fileobj.write(self.render())
+
+    def save(self, fname=None):
+        """Write the document to fname (by default the file it was loaded
+        from).  The new contents go to a temporary file in the same
+        directory, which is fsync'ed and then renamed over the target, so
+        clients booting off the file never see it half written.  Afterwards
+        the document is re-based on the saved text."""
+        fname = fname or self.fname
+        text = self.render()
+        directory = os.path.dirname(os.path.abspath(fname))
+        fd, tmp_fname = tempfile.mkstemp(prefix='.lts.conf.', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(text)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            try:
+                os.chmod(tmp_fname, os.stat(fname).st_mode & 07777)
+            except OSError:
+                # new file -- mkstemp's 0600 is too strict for a file that
+                # is served to clients
+                os.chmod(tmp_fname, 0644)
+            os.rename(tmp_fname, fname)
+        except:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        self.fname = fname
+        self.modified = False
+        self._parse(text)
+
+
+DEFAULT_SECTION = 'Default'
+LIKE_OPTION = data_validation.LIKE_OPTION
+# a variable reference in a tokenized value, as data_validation.tokenize
+# leaves them
+_REFERENCE = re.compile(r'\$(?:\{([A-Za-z_]\w*)\}|([A-Za-z_]\w*))')
+
+
+class EffectiveConfig(object):
+    """Works out what each client actually gets from an lts.conf.
+    A client's settings are layered, each layer overriding the ones before:
+        [Default]
+        the sections named after the client's MAC address, IP address and
+        hostname, in that order (section names are matched ignoring case)
+    A section with LIKE = PROFILE is preceded by the settings of [PROFILE]
+    (which can itself be LIKE another section), so a client's own settings
+    override those of its profile.  LIKE itself isn't passed on.
+    The chain of layers of every section is worked out once, up front;
+    looking an option up then only checks the few layers in a client's
+    chain, and resolve_all() shares the resolved settings of profiles
+    between all the clients using them.  config can be anything with
+    ConfigParser's sections() and items(); build a new EffectiveConfig
+    after it changes (an LTSConfDocument's 'changes' counter tells when).
+    'problems' lists (section, message) pairs for LIKE references to
+    missing sections and for LIKE cycles, which are ignored.
+    Example:
+        >>> effective = EffectiveConfig(doc)
+        >>> effective.lookup('VOLUME', mac='00:11:22:33:44:55')
+        ('80', 'OLD_MONITOR')
+    """
+    def __init__(self, config):
+        self.problems = []
+        self._options = {}  # section -> {option: value}, without LIKE
+        self._like = {}     # section -> name of the section it is LIKE
+        self._by_name = {}  # lower-cased section name -> section
+        for section in config.sections():
+            options = dict(config.items(section))
+            like = options.pop(LIKE_OPTION, None)
+            if like:
+                self._like[section] = data_validation.tokenize(like).text
+            self._options[section] = options
+            self._by_name[section.lower()] = section
+        self.default = self._by_name.get(DEFAULT_SECTION.lower())
+        self._chains = {}
+        for section in self._options:
+            self._chain(section, set())
+        # sections other clients are LIKE; these aren't clients themselves
+        self.profiles = set()
+        for chain in self._chains.itervalues():
+            self.profiles.update(chain[:-1])
+
+    def _chain(self, section, visiting):
+        """Sections whose settings apply to section, least specific first:
+        its LIKE profiles, then section itself.  [Default] is left out."""
+        chain = self._chains.get(section)
+        if chain is not None:
+            return chain
+        chain = ()
+        like = self._like.get(section)
+        if like is not None:
+            profile = self._by_name.get(like.lower())
+            visiting.add(section)
+            if profile is None:
+                self.problems.append(
+                    (section, "LIKE refers to missing section [%s]" % like))
+            elif profile in visiting:
+                self.problems.append(
+                    (section, "LIKE loops back to [%s]" % profile))
+            elif profile != self.default:
+                chain = self._chain(profile, visiting)
+        chain += (section,)
+        self._chains[section] = chain
+        return chain
+
+    def section_for(self, name):
+        """The section named name (a MAC, IP or hostname), or None."""
+        if not name:
+            return None
+        return self._by_name.get(name.lower())
+
+    def clients(self):
+        """The sections that describe clients rather than profiles."""
+        return [section for section in self._options
+                if section != self.default and section not in self.profiles]
+
+    def layers(self, mac=None, ip=None, hostname=None, section=None):
+        """The sections applying to a client, least specific first.  The
+        client is given either by any of its MAC, IP and hostname, or by
+        the name of its section."""
+        if section is not None:
+            names = (section,)
+        else:
+            names = (mac, ip, hostname)
+        layers = [self.default] if self.default else []
+        for name in names:
+            section = self.section_for(name)
+            if section is not None:
+                layers.extend(self._chains[section])
+        if len(layers) > 1:
+            # a section reached twice (e.g. a shared profile) counts where
+            # it applies last
+            seen = set()
+            layers = [section for section in reversed(layers)
+                      if not (section in seen or seen.add(section))]
+            layers.reverse()
+        return layers
+
+    def lookup(self, option, mac=None, ip=None, hostname=None,
+               section=None):
+        """(value, origin section) of option for a client, or None if
+        nothing sets it."""
+        options = self._options
+        for layer in reversed(self.layers(mac, ip, hostname, section)):
+            value = options[layer].get(option)
+            if value is not None:
+                return value, layer
+        return None
+
+    def overridden(self, section, option):
+        """(value, origin section) of the setting that section's own
+        setting of option overrides, or None."""
+        options = self._options
+        for layer in reversed(self.layers(section=section)[:-1]):
+            value = options[layer].get(option)
+            if value is not None:
+                return value, layer
+        return None
+
+    def resolve(self, mac=None, ip=None, hostname=None, section=None):
+        """{option: (value, origin section)} for everything a client gets."""
+        resolved = {}
+        for layer in self.layers(mac, ip, hostname, section):
+            for option, value in self._options[layer].iteritems():
+                resolved[option] = (value, layer)
+        return resolved
+
+    def resolve_all(self):
+        """Yield (client section, resolved settings as from resolve()) for
+        every client.  Each profile is resolved once, however many clients
+        are LIKE it."""
+        base = {}
+        if self.default:
+            for option, value in self._options[self.default].iteritems():
+                base[option] = (value, self.default)
+        memo = {(): base}
+
+        def resolved(chain):
+            result = memo.get(chain)
+            if result is None:
+                section = chain[-1]
+                result = dict(resolved(chain[:-1]))
+                for option, value in self._options[section].iteritems():
+                    result[option] = (value, section)
+                if section in self.profiles:
+                    memo[chain] = result
+            return result
+
+        for client in self.clients():
+            yield client, resolved(self._chains[client])
+
+    def update(self, changes):
+        """Patch in changes, a [ConfChange] made to the config since this
+        was built.  Returns False, changing nothing, if they add or remove
+        sections or change a LIKE, which changes the layers; build a new
+        EffectiveConfig then."""
+        for change in changes:
+            if change.option is None or change.option == LIKE_OPTION or \
+               change.section not in self._options:
+                return False
+        for change in changes:
+            options = self._options[change.section]
+            if change.kind == REMOVED:
+                options.pop(change.option, None)
+            else:
+                options[change.option] = change.new
+        return True
+
+
+class ExpandedConfig(object):
+    """The values of an lts.conf with their variable references expanded,
+    the way the shell sourcing it on a client would: in a section's
+    "$SERVER:8080", $SERVER is whatever SERVER resolves to for a client of
+    the section (see EffectiveConfig), itself expanded.  A variable that
+    nothing sets falls back to its default from vars_meta (an
+    LTSVarsConfig) when that is itself a reference, as NBD_SWAP_SERVER's
+    $SERVER is; references to variables that are neither set nor have such
+    a default are left as written, as only the client knows them.
+    Expansions are memoized per client layers and option, and each one
+    notes the expansions it used.  update() is given the changes made to
+    the config, and forgets only the expansions of the changed options in
+    the sections they're set in and those that used them, so after an edit
+    only what depends on it is expanded again.  'problems' lists (section,
+    message) pairs for LIKE problems and for the references found so far
+    to loop back on themselves (expand_all() for every client finds them
+    all); references between the variables of a loop are left as written.
+    Example:
+        >>> expanded = ExpandedConfig(doc, vars_meta)
+        >>> expanded.expand('LDM_SERVER', section='00:11:22:33:44:55')
+        ('10.0.0.1 10.0.0.2', 'Default')
+    """
+    def __init__(self, config, vars_meta=None):
+        self.config = config
+        self.vars_meta = vars_meta
+        self.effective = EffectiveConfig(config)
+        # the config's 'changes' count this is up to date with, if it has one
+        self.changes = getattr(config, 'changes', None)
+        self._memo = {}        # (layers, option) -> (text, origin) or None
+        self._uses = {}        # (layers, option) -> options it referenced
+        self._users = {}       # (layers, option) -> keys that referenced it
+        self._by_option = {}   # option -> layers it's memoized for
+        self._defaults = {}    # option -> ShellValue of a reference default
+        self._default_names = None  # options with a reference default
+        self._loops = {}       # (layers, names in the loop) -> problem
+        self._loop_of = {}     # key in a loop -> a key of the same loop
+
+    @property
+    def problems(self):
+        return self.effective.problems + sorted(set(self._loops.itervalues()))
+
+    def _layers(self, mac=None, ip=None, hostname=None, section=None):
+        return tuple(self.effective.layers(mac, ip, hostname, section))
+
+    def expand(self, option, mac=None, ip=None, hostname=None,
+               section=None):
+        """(expanded value, origin section) of option for a client (given
+        as for EffectiveConfig.layers), or None if nothing sets it.  The
+        origin is None for a value from a default."""
+        return self._expand(self._layers(mac, ip, hostname, section),
+                            option, [])
+
+    def _default(self, option):
+        """The ShellValue of option's default if that references other
+        variables, else None."""
+        try:
+            return self._defaults[option]
+        except KeyError:
+            shell = None
+            vars_meta = self.vars_meta
+            if vars_meta is not None and option in vars_meta:
+                shell = data_validation.tokenize(vars_meta[option].default)
+                if not shell.refs:
+                    shell = None
+            self._defaults[option] = shell
+            return shell
+
+    def _expand(self, layers, option, visiting):
+        key = (layers, option)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        options = self.effective._options
+        for layer in reversed(layers):
+            value = options[layer].get(option)
+            if value is not None:
+                shell = data_validation.tokenize(value)
+                origin = layer
+                break
+        else:
+            shell = self._default(option)
+            origin = None
+        if shell is None:
+            result = None
+        elif not shell.refs:
+            result = (shell.text, origin)
+        else:
+            visiting.append(option)
+            expansions = {}
+            for ref in sorted(set(shell.refs)):
+                self._users.setdefault((layers, ref), set()).add(key)
+                if ref in visiting:
+                    self._loop(layers, visiting[visiting.index(ref):])
+                    continue
+                expanded = self._expand(layers, ref, visiting)
+                if expanded is not None and \
+                   not self._in_loop(key, (layers, ref)):
+                    expansions[ref] = expanded[0]
+            visiting.pop()
+            self._uses[key] = shell.refs
+            text = shell.text
+            if expansions:
+                text = _REFERENCE.sub(
+                    lambda match: expansions.get(
+                        match.group(1) or match.group(2), match.group()),
+                    text)
+            result = (text, origin)
+        self._memo[key] = result
+        self._by_option.setdefault(option, set()).add(layers)
+        return result
+
+    def _loop(self, layers, names):
+        """Note a loop through names, in the order they reference each
+        other."""
+        # the same however it was come across
+        first = names.index(min(names))
+        names = names[first:] + names[:first]
+        origin = None
+        for layer in reversed(layers):
+            if names[0] in self.effective._options[layer]:
+                origin = layer
+                break
+        self._loops[(layers, tuple(names))] = (
+            origin, "$%s refers back to itself through %s" % (
+                names[0], ' -> '.join('$' + name
+                                      for name in names + [names[0]])))
+        # loops sharing a variable are one loop
+        root = self._loop_root((layers, names[0]))
+        for name in names[1:]:
+            other = self._loop_root((layers, name))
+            if other != root:
+                self._loop_of[other] = root
+
+    def _loop_root(self, key):
+        loop_of = self._loop_of
+        while loop_of.get(key, key) != key:
+            key = loop_of[key]
+        loop_of.setdefault(key, key)
+        return key
+
+    def _in_loop(self, key, other):
+        """Whether key and other are in the same loop."""
+        return (key in self._loop_of and other in self._loop_of and
+                self._loop_root(key) == self._loop_root(other))
+
+    def expand_all(self, mac=None, ip=None, hostname=None, section=None):
+        """[(option, expanded value, origin section)] of everything a client
+        gets, including defaults referencing other variables that expand
+        to something, in dependency order: each option comes after those
+        it references, as a shell script setting them would need."""
+        layers = self._layers(mac, ip, hostname, section)
+        options = set()
+        for layer in layers:
+            options.update(self.effective._options[layer])
+        if self._default_names is None:
+            self._default_names = [
+                var.name for var in self.vars_meta or ()
+                if self._default(var.name) is not None]
+        options.update(self._default_names)
+        ordered = []
+        placed = set()
+
+        def place(option, visiting):
+            if option in placed or option in visiting:
+                return
+            expanded = self._expand(layers, option, [])
+            if expanded is None:
+                return
+            visiting.add(option)
+            for ref in self._uses.get((layers, option), ()):
+                place(ref, visiting)
+            visiting.discard(option)
+            placed.add(option)
+            ordered.append((option,) + expanded)
+
+        for option in sorted(options):
+            place(option, set())
+        return ordered
+
+    def update(self, changes):
+        """Bring the expansions in line with changes, a [ConfChange] just
+        made to the config, and return the (layers, option) keys of the
+        expansions that were forgotten.  Changes to sections or LIKE start
+        everything over."""
+        if not self.effective.update(changes):
+            self.__init__(self.config, self.vars_meta)
+            return None
+        stale = []
+        for change in changes:
+            for layers in self._by_option.get(change.option, ()):
+                if change.section in layers:
+                    stale.append((layers, change.option))
+        forgotten = set()
+        while stale:
+            key = stale.pop()
+            if key in forgotten:
+                continue
+            forgotten.add(key)
+            if key in self._memo:
+                del self._memo[key]
+                self._by_option[key[1]].discard(key[0])
+            self._uses.pop(key, None)
+            stale.extend(self._users.pop(key, ()))
+        # loops through what was forgotten are found again if they're
+        # still there
+        for loop in [loop for loop in self._loops
+                     if any((loop[0], name) in forgotten
+                            for name in loop[1])]:
+            del self._loops[loop]
+        if self._loop_of:
+            # loops are found again as their variables are expanded
+            self._loop_of = dict(
+                (key, root) for key, root in self._loop_of.iteritems()
+                if key not in forgotten and root not in forgotten)
+        self.changes = getattr(self.config, 'changes', None)
+        return forgotten
+
+
+# kinds of ConfChange
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+# A difference between two configs, as found by diff_configs.  'option' is
+# None for a whole section being added or removed (an added section is
+# followed by the additions of its options); 'old' and 'new' are the values
+# as written on either side, None where there's no such option.
+ConfChange = namedtuple('ConfChange', 'kind section option old new')
+
+# An option that was changed differently on both sides of merge_configs.
+ConfConflict = namedtuple('ConfConflict', 'section option base ours theirs')
+
+
+def _comparable(config, schema, memo):
+    """(sections, {section: (options, {option: (value, key)})}) for a
+    config, where 'key' is what the value is compared by: its canonical
+    spelling if there's a schema and the value is valid, else the value
+    itself.  memo maps (option, value) to key, so each distinct pair is
+    parsed once however often it occurs."""
+    sections = config.sections()
+    table = {}
+    for section in sections:
+        items = config.items(section)
+        values = {}
+        for option, value in items:
+            key = value
+            if schema is not None:
+                key = memo.get((option, value))
+                if key is None:
+                    try:
+                        key = schema.parse_value(option, value)[1]
+                    except ValueError:
+                        key = value
+                    memo[(option, value)] = key
+            values[option] = (value, key)
+        table[section] = ([option for option, value in items], values)
+    return sections, table
+
+
+def _diff_tables(old_sections, old_table, new_sections, new_table):
+    changes = []
+    for section in old_sections:
+        if section not in new_table:
+            changes.append(ConfChange(REMOVED, section, None, None, None))
+            continue
+        old_options, old_values = old_table[section]
+        new_options, new_values = new_table[section]
+        for option in old_options:
+            value, key = old_values[option]
+            other = new_values.get(option)
+            if other is None:
+                changes.append(ConfChange(REMOVED, section, option, value,
+                                          None))
+            elif other[1] != key:
+                changes.append(ConfChange(CHANGED, section, option, value,
+                                          other[0]))
+        for option in new_options:
+            if option not in old_values:
+                changes.append(ConfChange(ADDED, section, option, None,
+                                          new_values[option][0]))
+    for section in new_sections:
+        if section not in old_table:
+            changes.append(ConfChange(ADDED, section, None, None, None))
+            new_options, new_values = new_table[section]
+            changes.extend(ConfChange(ADDED, section, option, None,
+                                      new_values[option][0])
+                           for option in new_options)
+    return changes
+
+
+def diff_configs(old, new, schema=None):
+    """[ConfChange] turning the config old into new, matched by section and
+    option name, so the order of sections and options doesn't matter.
+    Given a schema (a data_validation.LTSPValidator), values are compared
+    by their canonical spelling, so e.g. 'yes' and 'True' are equal for a
+    boolean.  old and new can be anything with ConfigParser's sections()
+    and items(); the work is linear in their size.  Changes come in the
+    order of old, with what only new has after."""
+    memo = {}
+    old_sections, old_table = _comparable(old, schema, memo)
+    new_sections, new_table = _comparable(new, schema, memo)
+    return _diff_tables(old_sections, old_table, new_sections, new_table)
+
+
+def merge_configs(base, ours, theirs, schema=None):
+    """Three-way merge: what changed between base and theirs, applied to
+    ours where ours didn't change it too.  Returns (changes, conflicts):
+    the [ConfChange] to apply to ours (see apply_changes), and a
+    [ConfConflict] for every option that ours and theirs changed in
+    different ways, which keeps our value.  Values are compared as in
+    diff_configs."""
+    memo = {}
+    base_sections, base_table = _comparable(base, schema, memo)
+    our_sections, our_table = _comparable(ours, schema, memo)
+    their_sections, their_table = _comparable(theirs, schema, memo)
+    changes = []
+    conflicts = []
+
+    def our_value(section, option):
+        values = our_table.get(section)
+        return values and values[1].get(option)
+
+    for change in _diff_tables(base_sections, base_table, their_sections,
+                               their_table):
+        section, option = change.section, change.option
+        if option is None:
+            if change.kind == ADDED and section not in our_table:
+                changes.append(change)
+            elif change.kind == REMOVED and section in our_table:
+                # remove what we left alone, keep (and report) what we
+                # changed
+                base_values = base_table[section][1]
+                our_options, our_values = our_table[section]
+                edited = [name for name in our_options
+                          if base_values.get(name, (None, None))[1] !=
+                          our_values[name][1]]
+                if not edited:
+                    changes.append(change)
+                for name in edited:
+                    base_value = base_values.get(name, (None,))[0]
+                    conflicts.append(ConfConflict(section, name, base_value,
+                                                  our_values[name][0], None))
+                changes.extend(ConfChange(REMOVED, section, name,
+                                          base_values[name][0], None)
+                               for name in our_options
+                               if edited and name not in edited)
+            continue
+        ours_now = our_value(section, option)
+        our_key = ours_now and ours_now[1]
+        base_values = base_table.get(section)
+        base_now = base_values and base_values[1].get(option)
+        their_values = their_table.get(section)
+        theirs_now = their_values and their_values[1].get(option)
+        if our_key == (theirs_now and theirs_now[1]):
+            continue
+        if our_key == (base_now and base_now[1]):
+            changes.append(change._replace(old=ours_now and ours_now[0]))
+        else:
+            conflicts.append(ConfConflict(section, option,
+                                          base_now and base_now[0],
+                                          ours_now and ours_now[0],
+                                          theirs_now and theirs_now[0]))
+    return changes, conflicts
+
+
+def apply_changes(config, changes):
+    """Make the changes (from diff_configs or merge_configs) to config, an
+    LTSConfDocument or ConfigParser.  Options added to or changed in a
+    missing section bring the section back; removals of things that are
+    already gone are skipped."""
+    for change in changes:
+        section, option = change.section, change.option
+        if change.kind == REMOVED:
+            if option is None:
+                config.remove_section(section)
+            elif config.has_section(section):
+                config.remove_option(section, option)
+            continue
+        if not config.has_section(section):
+            config.add_section(section)
+        if option is not None:
+            config.set(section, option, change.new)
+
+
+def _options_of(config, sections):
+    """[(section, {option: value})] of each of sections once, in order,
+    checking they all exist before anything is changed."""
+    seen = set()
+    options = []
+    for section in sections:
+        if section in seen:
+            continue
+        if not config.has_section(section):
+            raise ConfigParser.NoSectionError(section)
+        seen.add(section)
+        options.append((section, dict(config.items(section))))
+    return options
+
+
+def bulk_set(config, sections, option, value, replace=True):
+    """Set option to value in every one of sections of config (an
+    LTSConfDocument or ConfigParser), as one edit.  Sections already set to
+    value are left alone, and so are those setting option to anything else
+    unless replace is true.  Returns the [ConfChange] made, which
+    apply_changes can replay.  Raises NoSectionError, changing nothing, if
+    a section is missing."""
+    changes = []
+    for section, values in _options_of(config, sections):
+        old = values.get(option)
+        if old is None:
+            changes.append(ConfChange(ADDED, section, option, None, value))
+        elif old != value and replace:
+            changes.append(ConfChange(CHANGED, section, option, old, value))
+    apply_changes(config, changes)
+    return changes
+
+
+def bulk_unset(config, sections, option):
+    """Remove option from every one of sections that sets it; see
+    bulk_set."""
+    changes = []
+    for section, values in _options_of(config, sections):
+        if option in values:
+            changes.append(ConfChange(REMOVED, section, option,
+                                      values[option], None))
+    apply_changes(config, changes)
+    return changes
+
+
+def bulk_rename(config, sections, option, new_name):
+    """Rename option to new_name, keeping its value, in every one of
+    sections that sets it (replacing new_name where that's set too); see
+    bulk_set.  The renamed option moves to the end of its section."""
+    changes = []
+    if new_name == option:
+        return changes
+    for section, values in _options_of(config, sections):
+        if option not in values:
+            continue
+        value = values[option]
+        changes.append(ConfChange(REMOVED, section, option, value, None))
+        old = values.get(new_name)
+        if old is None:
+            changes.append(ConfChange(ADDED, section, new_name, None, value))
+        elif old != value:
+            changes.append(ConfChange(CHANGED, section, new_name, old,
+                                      value))
+    apply_changes(config, changes)
+    return changes
+
+
+def bulk_remove_sections(config, sections):
+    """Remove every one of sections; see bulk_set.  Each section's options
+    are listed as removed ahead of the section itself, so the changes hold
+    all that's needed to put it back."""
+    changes = []
+    for section, values in _options_of(config, sections):
+        changes.extend(ConfChange(REMOVED, section, option, value, None)
+                       for option, value in config.items(section))
+        changes.append(ConfChange(REMOVED, section, None, None, None))
+    apply_changes(config, changes)
+    return changes
+
+
+def invert_changes(changes):
+    """The [ConfChange] undoing changes (as made, in order, by
+    apply_changes or the bulk_* functions)."""
+    opposite = {ADDED: REMOVED, REMOVED: ADDED, CHANGED: CHANGED}
+    return [ConfChange(opposite[change.kind], change.section, change.option,
+                       change.new, change.old)
+            for change in reversed(changes)]
+
+
+class EditJournal(object):
+    """Undo and redo history of an LTSConfDocument, kept as the ConfChange
+    records of each edit rather than copies of the document, so an entry
+    costs the size of what changed.  record() takes the changes of one edit
+    (a bulk edit is one entry); undo() and redo() patch the document with
+    apply_changes and return the changes they made, for the caller to
+    update its views incrementally.
+    At most 'limit' entries are kept, the oldest being dropped first.  A
+    change of a value recorded within COALESCE_SECONDS of an edit to the
+    same option in the same section is folded into that entry, so typing
+    over a value several times is undone in one step.
+    Given fname, every entry, undo and redo is also appended to that file
+    as a JSON line, after a header holding a hash of the document's text
+    and the history so far.  If the program dies, recover() replays the
+    file onto the document freshly loaded from the same text, so no edit
+    is lost.  rebase() starts the file over once the document is saved.
+    If the file can't be written, the history is just kept in memory.
+    """
+    COALESCE_SECONDS = 5.0
+
+    def __init__(self, limit=1000, fname=None):
+        self.limit = limit
+        self.fname = fname
+        self._undo = deque(maxlen=limit)
+        self._redo = []
+        self._last_edit = None  # when the entry on top was last recorded
+        self._source = None  # hash of the text the file's history starts from
+        self._file = None
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def clear(self):
+        self._undo.clear()
+        self._redo = []
+        self._last_edit = None
+
+    def record(self, changes, now=None):
+        """Add an entry for changes, just made to the document."""
+        changes = list(changes)
+        if not changes:
+            return
+        now = time.time() if now is None else now
+        coalesce = self._coalesces(changes, now)
+        self._log({'do': [list(change) for change in changes],
+                   'coalesce': coalesce})
+        self._push(changes, coalesce)
+        self._last_edit = now
+
+    def _coalesces(self, changes, now):
+        if len(changes) != 1 or changes[0].kind != CHANGED or \
+           not self._undo or len(self._undo[-1]) != 1 or \
+           self._last_edit is None or \
+           now - self._last_edit > self.COALESCE_SECONDS:
+            return False
+        last, change = self._undo[-1][0], changes[0]
+        return (last.kind in (ADDED, CHANGED) and
+                (last.section, last.option) == (change.section,
+                                                change.option))
+
+    def _push(self, changes, coalesce):
+        self._redo = []
+        if not coalesce:
+            self._undo.append(changes)
+            return
+        last = self._undo.pop()[0]
+        merged = last._replace(new=changes[0].new)
+        if merged.kind != CHANGED or merged.old != merged.new:
+            self._undo.append([merged])
+
+    def undo(self, config):
+        """Undo the last entry in config.  Returns the changes made, or None
+        if there was nothing to undo."""
+        if not self._undo:
+            return None
+        self._log({'undo': True})
+        entry = self._undo.pop()
+        self._redo.append(entry)
+        self._last_edit = None
+        changes = invert_changes(entry)
+        apply_changes(config, changes)
+        return changes
+
+    def redo(self, config):
+        """Make the last undone entry again in config.  Returns the changes
+        made, or None if there was nothing to redo."""
+        if not self._redo:
+            return None
+        self._log({'redo': True})
+        entry = self._redo.pop()
+        self._undo.append(entry)
+        self._last_edit = None
+        apply_changes(config, entry)
+        return entry
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text).hexdigest()
+
+    def rebase(self, text):
+        """Start the journal file over from text, the document's text as
+        just loaded or saved.  The file is only written again at the next
+        entry."""
+        self.close(discard=True)
+        self._source = self._hash(text)
+
+    def close(self, discard=False):
+        """Stop writing the file, removing it if discard is set."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if discard and self.fname is not None:
+            try:
+                os.remove(self.fname)
+            except OSError:
+                pass
+
+    def _log(self, event):
+        """Append event to the file, made before the stacks change, so the
+        header (written first) has the history event starts from."""
+        if self.fname is None or self._source is None:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.fname, 'w')
+                header = {'source': self._source,
+                          'undo': [[list(change) for change in entry]
+                                   for entry in self._undo],
+                          'redo': [[list(change) for change in entry]
+                                   for entry in self._redo]}
+                self._file.write(json.dumps(header) + '\n')
+            self._file.write(json.dumps(event) + '\n')
+            # readable by recover() even if we die right after
+            self._file.flush()
+        except IOError, e:
+            print "Warning: can't write %s, not keeping it: %s" % (
+                self.fname, e.strerror)
+            self.close()
+            self.fname = None
+
+    def _read_file(self, text):
+        """The header and the lines of the file (the header's first), if it
+        was kept for text, else None."""
+        if self.fname is None:
+            return None
+        try:
+            with open(self.fname) as journal:
+                lines = journal.readlines()
+            header = json.loads(lines[0])
+        except (IOError, IndexError, ValueError):
+            return None
+        if header.get('source') != self._hash(text):
+            return None
+        return header, lines
+
+    def recoverable(self, text):
+        """Whether the file has edits to recover onto a document loaded
+        from text."""
+        read = self._read_file(text)
+        return read is not None and len(read[1]) > 1
+
+    def recover(self, config):
+        """Replay the journal file onto config, which must have just been
+        loaded from the text the file's history starts from.  Returns the
+        [ConfChange] made to config, or None if there's nothing to recover:
+        no file, or one kept for other contents of the document.  The file
+        is kept, and carries on from where it was."""
+        read = self._read_file(config.source)
+        if read is None:
+            return None
+        header, lines = read
+
+        def entry(changes):
+            # json gives unicode; the config is byte strings throughout
+            return [ConfChange(*[field if field is None
+                                 else field.encode('utf-8')
+                                 for field in change])
+                    for change in changes]
+
+        self.close()
+        self.clear()
+        self._source = None  # not logging what's replayed
+        self._undo.extend(entry(changes) for changes in header['undo'])
+        self._redo = [entry(changes) for changes in header['redo']]
+        made = []
+        for count, line in enumerate(lines[1:]):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # cut short when we died; new events go after the last
+                # whole one
+                lines = lines[:count + 1]
+                with open(self.fname, 'w') as journal:
+                    journal.writelines(lines)
+                break
+            if 'do' in event:
+                changes = entry(event['do'])
+                apply_changes(config, changes)
+                self._push(changes, event['coalesce'])
+                made.extend(changes)
+            elif 'undo' in event:
+                changes = self.undo(config)
+                made.extend(changes or ())
+            else:
+                changes = self.redo(config)
+                made.extend(changes or ())
+        # go on appending to the file as it is
+        self._source = header['source']
+        try:
+            self._file = open(self.fname, 'a')
+        except IOError:
+            self.fname = None
+        return made
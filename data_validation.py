@@ -26,30 +26,256 @@ To create a new data type to use in the config file, create a class here.
 The class should have a member "name", which is the name to use in the config
 file.  The __init__ of the class should take one argument, "value", and
 __init__ should raise a ValueError if the value does not fit the criteria.
+Optionally, also override the 'compile' classmethod to return a function that
+does the same check without instantiating the class -- validators call that
+function once per value, so it should bind anything it needs (regexes, sets
+of allowed values, bounds) ahead of time.  The default 'compile' just wraps
+__init__.  Validation results are memoized per (type name, value); if several
+spellings of a value are equivalent for your type, override 'normalize' so
+they share a cache entry.
+Types also turn valid values into python values and back: 'parse' returns
+the typed value (a bool, an int, ...) of a valid string, and 'serialize'
+writes a typed value out in its canonical spelling.  Override both if your
+type has a more useful typed value than the string itself.
+Values reach types as the shell sourcing lts.conf on the client reads them:
+quotes removed and escapes resolved (see tokenize), so "en-us" and en-us
+are the same value, and canonical spellings are quoted again where needed.
 """
 
 import os
 import re
+import time
+from collections import namedtuple
 from datetime import datetime
-from glob import glob
+
+
+# Where console keymaps (as loaded by loadkeys) live on the various distros.
+KEYMAP_DIRS = ('/usr/share/keymaps', '/usr/share/kbd/keymaps',
+               '/lib/kbd/keymaps', '/usr/lib/kbd/keymaps')
+KEYMAP_EXTENSIONS = ('.kmap.gz', '.kmap', '.map.gz', '.map')
+LOCALE_DIRS = ('/usr/share/locale',)
+
+# the option that makes a section inherit another's settings (see
+# configuration.EffectiveConfig); it isn't a variable, so lts_vars.conf
+# doesn't list it
+LIKE_OPTION = 'LIKE'
 
 
 class DataType(object):
     # 'name' should be one of the valid DATA_TYPES, except for this base class.
     name = None
+    # Whether a Validator should memoize results for this type.  Types whose
+    # check is a single set lookup or isinstance test are cheaper to run than
+    # to look up in the cache, and turn this off.
+    cacheable = True
 
     def __init__(self):
         if self.name is None:
             raise NotImplementedError("'name' class variable not set.")
 
+    @classmethod
+    def normalize(cls, value):
+        """Map a value to the form it is cached (and checked) as.  This must
+        not change whether the value is valid."""
+        return value
+
+    @classmethod
+    def compile(cls):
+        """compile() -> check(value), which returns None if the value is
+        valid and an error message otherwise."""
+        def check(value):
+            try:
+                cls(value)
+            except ValueError, e:
+                return e.message
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        """parse(value) -> the typed value of a valid value.  Raises
+        ValueError if the value isn't valid."""
+        cls(value)
+        return value
+
+    @classmethod
+    def serialize(cls, typed):
+        """serialize(typed value) -> its canonical string."""
+        return str(typed)
+
+
+# characters that make a shell word need quoting
+_SHELL_SPECIAL = re.compile(r'[\s"\'\\$`#;&|<>()*?\[\]~]')
+# characters tokenize() has anything to do for; values without any (nearly
+# all of them) are a single word as they are
+_SHELL_SYNTAX = re.compile(r'[\s"\'\\$#]')
+# what's escaped by a backslash in double quotes (anything else keeps it)
+_DOUBLE_QUOTED_SPECIAL = re.compile(r'([\\"`$])')
+
+# A value as the shell that sources lts.conf on the client reads it.
+# 'words' are its words after quote removal and escapes, with variable
+# references left as written ($VAR or ${VAR}), and 'text' is them joined by
+# spaces.  'refs' are the names of the variables referenced, in order.
+# 'open' is None for a complete value, else the quote character left open,
+# or a backslash for a trailing one -- either way the value goes on in the
+# next line of the file.
+ShellValue = namedtuple('ShellValue', 'text words refs open')
+
+# One token of a value per match, in a single pass: blanks between words,
+# comments, runs of plain characters, quoted strings, escaped characters,
+# variable references, and whatever is left open at the end.
+_SHELL_TOKEN = re.compile(r"""
+    (?P<blank>\s+)
+  | (?<!\S)(?P<comment>\#.*)
+  | (?P<plain>[^\s'"\\$]+)
+  | '(?P<single>[^']*)'
+  | "(?P<double>(?:[^"\\]|\\[\s\S])*)"
+  | \\(?P<escaped>[\s\S])
+  | \$(?:\{(?P<braced>[A-Za-z_]\w*)\}|(?P<name>[A-Za-z_]\w*))
+  | (?P<dollar>\$)
+  | (?P<open>['"\\])
+""", re.VERBOSE | re.DOTALL)
+# a value that is just one quoted word, the commonest kind that needs any
+# work, which is read without going through the tokens
+_QUOTED_WORD = re.compile(r'"([^"\\$`]*)"$|\'([^\']*)\'$')
+# escapes and references within double quotes
+_DOUBLE_QUOTED = re.compile(r'\\([$`"\\\n])|\$(?:\{([A-Za-z_]\w*)\}|'
+                            r'([A-Za-z_]\w*))')
+
+_shell_values = {}
+# most values tokenize() remembers; it forgets them all when it's full
+SHELL_CACHE_SIZE = 16384
+
+
+def tokenize(value):
+    """tokenize(value) -> ShellValue of an lts.conf value as written, e.g.
+    '"en-us" ${SERVER}:8080' -> ShellValue(text='en-us ${SERVER}:8080',
+    words=('en-us', '${SERVER}:8080'), refs=('SERVER',), open=None).
+    A # starting a word comments out the rest of the value, and a backslash
+    before a newline (outside single quotes) joins the lines.  Results are
+    remembered, as most files repeat a few values over and over."""
+    try:
+        return _shell_values[value]
+    except KeyError:
+        pass
+    if not _SHELL_SYNTAX.search(value):
+        shell = ShellValue(value, (value,) if value else (), (), None)
+    else:
+        quoted = _QUOTED_WORD.match(value)
+        if quoted is not None:
+            word = quoted.group(1)
+            if word is None:
+                word = quoted.group(2)
+            shell = ShellValue(word, (word,), (), None)
+        else:
+            shell = _tokenize(value)
+    if len(_shell_values) >= SHELL_CACHE_SIZE:
+        _shell_values.clear()
+    _shell_values[value] = shell
+    return shell
+
+
+def _tokenize(value):
+    words = []
+    refs = []
+    word = None  # pieces of the word being read, if any
+    open = None
+    for token in _SHELL_TOKEN.finditer(value):
+        kind = token.lastgroup
+        if kind == 'blank':
+            if word is not None:
+                words.append(''.join(word))
+                word = None
+            continue
+        if kind == 'comment':
+            break
+        if word is None:
+            word = []
+        if kind in ('plain', 'dollar'):
+            word.append(token.group())
+        elif kind == 'single':
+            word.append(token.group('single'))
+        elif kind == 'double':
+            text = token.group('double')
+            if '\\' in text or '$' in text:
+                text = _DOUBLE_QUOTED.sub(
+                    lambda match: _double_quoted(match, refs), text)
+            word.append(text)
+        elif kind == 'escaped':
+            if token.group('escaped') != '\n':
+                word.append(token.group('escaped'))
+        elif kind == 'open':
+            open = token.group()
+            # the rest is read as if the quote were closed at the end
+            rest = value[token.end():]
+            if open == "'":
+                word.append(rest)
+            elif open == '"':
+                word.append(_DOUBLE_QUOTED.sub(
+                    lambda match: _double_quoted(match, refs), rest))
+            break
+        else:
+            refs.append(token.group('braced') or token.group('name'))
+            word.append(token.group())
+    if word is not None:
+        words.append(''.join(word))
+    return ShellValue(' '.join(words), tuple(words), tuple(refs), open)
+
+
+def _double_quoted(match, refs):
+    escaped = match.group(1)
+    if escaped is not None:
+        return '' if escaped == '\n' else escaped
+    refs.append(match.group(2) or match.group(3))
+    return match.group()
+
+
+def quote(value):
+    """A value, quoted if the shell that reads lts.conf would need it to be.
+    value is taken literally: a $ in it is escaped, like \\, " and `, so
+    the shell doesn't expand it."""
+    if value and not _SHELL_SPECIAL.search(value):
+        return value
+    return '"%s"' % _DOUBLE_QUOTED_SPECIAL.sub(r'\\\1', value)
+
+
+def _evaluated(check, name):
+    """check, taking values as written in lts.conf rather than as the shell
+    reads them.  A value referencing variables can only be checked on the
+    client, where they're set, so it passes."""
+    # looked up in tokenize's cache first, as this runs for every value
+    shell_values = _shell_values
+
+    def evaluated_check(value):
+        shell = shell_values.get(value)
+        if shell is None:
+            if not isinstance(value, basestring):
+                return check(value)
+            shell = tokenize(value)
+        text, words, refs, open = shell
+        if open is None:
+            return None if refs else check(text)
+        if open == '\\':
+            return '"{}" ends in a backslash.'.format(value)
+        return 'Unterminated {} in "{}".'.format(open, value)
+    evaluated_check.__name__ = 'check_%s' % name.replace(' ', '_')
+    return evaluated_check
+
 
 class String(DataType):
     name = 'string'
+    cacheable = False
 
     def __init__(self, value):
         if not isinstance(value, str):
             raise TypeError('"{}" is not a string.'.format(value))
 
+    @classmethod
+    def compile(cls):
+        def check(value):
+            if not isinstance(value, str):
+                raise TypeError('"{}" is not a string.'.format(value))
+        return check
+
 
 class Integer(DataType):
     name = 'integer'
@@ -57,10 +283,24 @@ class Integer(DataType):
     def __init__(self, value):
         int(value)
 
+    @classmethod
+    def compile(cls):
+        def check(value):
+            try:
+                int(value)
+            except ValueError, e:
+                return e.message
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        return int(value)
+
 
 class Boolean(DataType):
     name = 'boolean'
     _valid_values = {'true', 'false', '0', '1', 0, 1, True, False, 'yes', 'no'}
+    cacheable = False
 
     def __init__(self, value):
         if isinstance(value, str):
@@ -69,6 +309,29 @@ class Boolean(DataType):
             msg = '"{}" is not a recognized boolean value.'
             raise ValueError(msg.format(value))
 
+    @classmethod
+    def compile(cls):
+        valid_values = frozenset(cls._valid_values)
+        msg = '"{}" is not a recognized boolean value.'
+
+        def check(value):
+            if isinstance(value, str):
+                value = value.lower()
+            if value not in valid_values:
+                return msg.format(value)
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        cls(value)
+        if isinstance(value, str):
+            return value.lower() in ('true', '1', 'yes')
+        return bool(value)
+
+    @classmethod
+    def serialize(cls, typed):
+        return 'True' if typed else 'False'
+
 
 class IpAddress(DataType):
     name = 'ip address'
@@ -81,6 +344,16 @@ class IpAddress(DataType):
             msg = '"{}" is not recognized as a valid IP address.'
             raise ValueError(msg.format(value))
 
+    @classmethod
+    def compile(cls):
+        match = cls._valid_ip.match
+        msg = '"{}" is not recognized as a valid IP address.'
+
+        def check(value):
+            if not match(value):
+                return msg.format(value)
+        return check
+
 
 class Port(DataType):
     name = 'port'
@@ -89,6 +362,22 @@ class Port(DataType):
         if not 0 < int(value) <= 65535:
             raise ValueError("Port %s is out of range 1-65535" % value)
 
+    @classmethod
+    def compile(cls):
+        def check(value):
+            try:
+                port = int(value)
+            except ValueError, e:
+                return e.message
+            if not 0 < port <= 65535:
+                return "Port %s is out of range 1-65535" % value
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        cls(value)
+        return int(value)
+
 
 class FilePath(DataType):
     """Really, any string will work and be considered a valid file path.
@@ -102,15 +391,28 @@ class FilePath(DataType):
         ..etc.
     """
     name = 'file path'
+    cacheable = False
 
     def __init__(self, value):
         if not isinstance(value, (str, unicode)):
             msg = '"{}" is not a recognized filepath.'
             raise ValueError(msg.format(value))
 
+    @classmethod
+    def compile(cls):
+        msg = '"{}" is not a recognized filepath.'
+
+        def check(value):
+            if not isinstance(value, (str, unicode)):
+                return msg.format(value)
+        return check
+
+
 
 class TimeString24(DataType):
     name = '24hr time string'
+    # accepts what strptime's "%H:%M:%S" does, without the strptime overhead
+    _time = re.compile(r'(\d\d?):(\d\d?):(\d\d?)$')
 
     def __init__(self, value):
         try:
@@ -119,56 +421,206 @@ class TimeString24(DataType):
             msg = '"{}" is not a recognized HH:MM:SS time.'
             raise ValueError(msg.format(value))
 
+    @classmethod
+    def compile(cls):
+        match = cls._time.match
+        msg = '"{}" is not a recognized HH:MM:SS time.'
+
+        def check(value):
+            parts = match(value) if isinstance(value, basestring) else None
+            if parts is None:
+                return msg.format(value)
+            hours, minutes, seconds = [int(p) for p in parts.groups()]
+            if hours > 23 or minutes > 59 or seconds > 61:
+                return msg.format(value)
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        """-> (hours, minutes, seconds)"""
+        cls(value)
+        return tuple(int(part) for part in value.split(':'))
+
+    @classmethod
+    def serialize(cls, typed):
+        return '%02d:%02d:%02d' % typed
+
+
+class KeymapIndex(object):
+    """The set of console keymap and locale names installed on this machine.
+    Nothing is read until the first lookup.  After that, the directories
+    that were scanned are stat'ed again at most every 'recheck_interval'
+    seconds, and everything is rescanned if any of their mtimes changed.
+    Keymap names are the file names under the keymap_dirs without their
+    extension (e.g. 'us', 'de-latin1'); locale names are the directory
+    names under the locale_dirs (e.g. 'en', 'pt_BR').
+    """
+    recheck_interval = 5.0
+
+    def __init__(self, keymap_dirs=KEYMAP_DIRS, locale_dirs=LOCALE_DIRS):
+        self.keymap_dirs = keymap_dirs
+        self.locale_dirs = locale_dirs
+        self._names = None
+        self._mtimes = {}
+        self._checked = 0
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _stale(self):
+        return any(self._mtime(path) != mtime
+                   for path, mtime in self._mtimes.iteritems())
+
+    def _scan(self):
+        names = set()
+        mtimes = {}
+        for root in self.keymap_dirs:
+            mtimes[root] = self._mtime(root)
+            for dirpath, dirnames, filenames in os.walk(root):
+                mtimes[dirpath] = self._mtime(dirpath)
+                for fname in filenames:
+                    for extension in KEYMAP_EXTENSIONS:
+                        if fname.endswith(extension):
+                            names.add(fname[:-len(extension)])
+                            break
+        for root in self.locale_dirs:
+            mtimes[root] = self._mtime(root)
+            if mtimes[root] is not None:
+                names.update(entry for entry in os.listdir(root)
+                             if os.path.isdir(os.path.join(root, entry)))
+        self._names = frozenset(names)
+        self._mtimes = mtimes
+
+    def names(self):
+        now = time.time()
+        if self._names is None:
+            self._scan()
+            self._checked = now
+        elif now - self._checked > self.recheck_interval:
+            # only a check restarts the interval, so frequent lookups
+            # don't put the next one off forever
+            self._checked = now
+            if self._stale():
+                self._scan()
+        return self._names
+
+    def knows(self, name):
+        """True if name is an installed keymap or locale.  If no keymap or
+        locale data is installed at all (e.g. when checking a config on a
+        machine other than the LTSP server), there's nothing to check
+        against, and every name is accepted."""
+        names = self.names()
+        return not names or name in names
+
 
 class ConsoleKeymap(DataType):
-    _locales = {os.path.basename(p) for p in glob('/usr/share/locale/*')[0]}
     name = 'console keymap'
+    # the installed keymaps can change underneath a cached result
+    cacheable = False
+    keymaps = KeymapIndex()
 
     def __init__(self, value):
-        if value not in self._locales:
-            raise ValueError("Unknown locale: {}".format(value))
+        if not self.keymaps.knows(value):
+            raise ValueError("Unknown keymap or locale: {}".format(value))
+
+    @classmethod
+    def compile(cls):
+        knows = cls.keymaps.knows
+
+        def check(value):
+            if not knows(value):
+                return "Unknown keymap or locale: {}".format(value)
+        return check
 
 
 class Password(DataType):
     name = 'password'
+    cacheable = False
 
     def __init__(self, value):
         if not isinstance(value, str):
             msg = '"{}" is not a string (passwords must be strings)'
             raise TypeError(msg.format(value))
 
+    @classmethod
+    def compile(cls):
+        msg = '"{}" is not a string (passwords must be strings)'
 
-class HorizSyncRate(DataType):
-    name = 'horizontal sync rate'
+        def check(value):
+            if not isinstance(value, str):
+                raise TypeError(msg.format(value))
+        return check
 
-    def __init__(self, value):
-        print "HorizSyncRate:"
-        print "   Max/min rates (or whether or not ddcprobe will be installed,"
-        print "   for example) are not known.  What should the angle of"
-        print "   attack be here? --value checked only that it is a number."
-        Integer(value)
 
 
-class VertRefreshRate(DataType):
-    name = 'vertical refresh rate'
+class HorizSyncRate(DataType):
+    """Rates as X.org takes them: a comma separated list of rates and
+    low-high ranges, like '30.0-88.0' or '31.5, 35.1, 50-70'.  The typed
+    value is a tuple of (low, high) float pairs, (rate, rate) for a single
+    rate."""
+    name = 'horizontal sync rate'
 
     def __init__(self, value):
-        print "VertRefreshRate:"
-        print "   Max/min rates (or whether or not ddcprobe will be installed,"
-        print "   for example) are not known.  What should the angle of"
-        print "   attack be here? --value checked only that it is a number."
-        Integer(value)
+        # Max/min rates (or whether or not ddcprobe will be installed, for
+        # example) are not known.  What should the angle of attack be here?
+        # --value checked only that it is a list of rates.
+        self.parse(value)
+
+    @classmethod
+    def parse(cls, value):
+        msg = '"{}" is not a rate or a list of rates.'
+        ranges = []
+        for part in value.split(','):
+            bounds = part.split('-')
+            try:
+                low, high = float(bounds[0]), float(bounds[-1])
+            except ValueError:
+                raise ValueError(msg.format(value))
+            if len(bounds) > 2 or not 0 < low <= high:
+                raise ValueError(msg.format(value))
+            ranges.append((low, high))
+        return tuple(ranges)
+
+    @classmethod
+    def serialize(cls, typed):
+        return ', '.join('%g' % low if low == high else '%g-%g' % (low, high)
+                         for low, high in typed)
+
+
+class VertRefreshRate(HorizSyncRate):
+    name = 'vertical refresh rate'
 
 
 class ColorDepth(DataType):
     _allowed_values = ['8', '16', '24', '32']
     name = 'color depth'
+    cacheable = False
 
     def __init__(self, value):
         if value not in self._allowed_values:
             msg = "Invalid value: {}.  Color depth must be one of: {}"
             raise ValueError(msg.format(value, repr(self._allowed_values)))
 
+    @classmethod
+    def compile(cls):
+        allowed_values = frozenset(cls._allowed_values)
+        msg = "Invalid value: {}.  Color depth must be one of: {}"
+        allowed_repr = repr(cls._allowed_values)
+
+        def check(value):
+            if value not in allowed_values:
+                return msg.format(value, allowed_repr)
+        return check
+
+    @classmethod
+    def parse(cls, value):
+        cls(value)
+        return int(value)
+
 
 def get_data_types():
     globl = globals()
@@ -187,15 +639,114 @@ def get_data_type_dict():
     return dict(pairs)
 
 
+# marks a cache miss, since None is a valid (cached) validation result
+_MISSING = object()
+
+
+class ValidationCache(object):
+    """A bounded memo of validation results, keyed by (data type name,
+    normalized value).  'hits' and 'misses' count lookups.
+    Eviction approximates least-recently-used with two generations of plain
+    dicts: lookups try the current generation, then the previous one
+    (promoting the entry if found there), and when the current generation
+    fills up the previous one is dropped wholesale.  That keeps a lookup at
+    a couple of dict accesses, which matters since most checks are only a
+    few bytecodes long themselves.
+    """
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        # [current generation, previous generation] -- swapped in place so
+        # the checks returned by wrap() can keep a reference to the list.
+        self._generations = [{}, {}]
+        # [hits, misses], for the same reason
+        self._counts = [0, 0]
+
+    def __len__(self):
+        return sum(len(generation) for generation in self._generations)
+
+    @property
+    def hits(self):
+        return self._counts[0]
+
+    @property
+    def misses(self):
+        return self._counts[1]
+
+    def clear(self):
+        for generation in self._generations:
+            generation.clear()
+
+    def invalidate(self, type_name):
+        """Drop every cached result for the given data type name."""
+        for generation in self._generations:
+            for key in [key for key in generation if key[0] == type_name]:
+                del generation[key]
+
+    def store(self, key, result):
+        generations = self._generations
+        if len(generations[0]) >= self.maxsize // 2:
+            generations[1] = generations[0]
+            generations[0] = {}
+        generations[0][key] = result
+
+    def wrap(self, type_name, check, normalize=None):
+        """Return a memoized version of the check function for a type."""
+        generations = self._generations
+        counts = self._counts
+        store = self.store
+
+        def cached_check(value):
+            if normalize is not None:
+                value = normalize(value)
+            key = (type_name, value)
+            result = generations[0].get(key, _MISSING)
+            if result is not _MISSING:
+                counts[0] += 1
+                return result
+            result = generations[1].get(key, _MISSING)
+            if result is _MISSING:
+                counts[1] += 1
+                result = check(value)
+            else:
+                counts[0] += 1
+            store(key, result)
+            return result
+        return cached_check
+
+
 class Validator(object):
     """Instantiate a validator, then use the 'validate' method to check data
     against the expected data type.  These are not python data types, but
-    rather types defined within this module."""
-    def __init__(self):
+    rather types defined within this module.
+    Each data type is compiled (see DataType.compile) the first time it is
+    used, and the resulting check function is reused from then on.  Results
+    are memoized in a ValidationCache of up to cache_size entries ('cache'),
+    unless cache_size is 0."""
+    def __init__(self, cache_size=8192):
         self.data_types = get_data_type_dict()
+        self.cache = ValidationCache(cache_size) if cache_size else None
+        self._checks = {}
 
     def add_data_type(self, data_type):
         self.data_types[data_type.name] = data_type
+        self._checks.pop(data_type.name, None)
+        if self.cache is not None:
+            self.cache.invalidate(data_type.name)
+
+    def compiled(self, expected_data_type):
+        """compiled(typename) -> check(value) function for that type."""
+        try:
+            return self._checks[expected_data_type]
+        except KeyError:
+            data_type = self.data_types[expected_data_type]
+            check = _evaluated(data_type.compile(), expected_data_type)
+            if self.cache is not None and data_type.cacheable:
+                normalize = data_type.normalize
+                if normalize.im_func is DataType.normalize.im_func:
+                    normalize = None
+                check = self.cache.wrap(expected_data_type, check, normalize)
+            self._checks[expected_data_type] = check
+            return check
 
     def validate(self, expected_data_type, value):
         """validate(typename, value) -> None if valid, Error message otherwise.
@@ -205,26 +756,84 @@ class Validator(object):
             import data_validation
             data_validation.get_data_types()
         """
-        try:
-            self.data_types[expected_data_type](value)
-        except ValueError, e:
-            return e.message
+        return self.compiled(expected_data_type)(value)
+
 
 class LTSPValidator(Validator):
-    def __init__(self, lts_vars_config_obj):
-        super(LTSPValidator, self).__init__()
+    """A Validator that knows the data type of each LTSP variable.  Every
+    variable in the LTSVarsConfig is compiled into a plan -- the check
+    function for its data type -- up front, so checking a value is a single
+    dict lookup and function call."""
+    def __init__(self, lts_vars_config_obj, cache_size=8192):
+        super(LTSPValidator, self).__init__(cache_size)
         self.vars_meta = lts_vars_config_obj
+        self._plans = self.compile_plans()
+        self._types = {}
+
+    def add_data_type(self, data_type):
+        super(LTSPValidator, self).add_data_type(data_type)
+        self._plans = self.compile_plans()
+        self._types = {}
+
+    def compile_plans(self):
+        """compile_plans() -> dict of variable name: check(value) function"""
+        # ranged variables are compiled as plan_for meets them, so plans
+        # don't grow with the width of the ranges
+        return dict((var.name, self.compiled(var.datatype))
+                    for var in self.vars_meta.single_vars())
+
+    def type_for(self, option):
+        """type_for(option) -> DataType class of a known variable, or None."""
+        try:
+            return self._types[option]
+        except KeyError:
+            if option not in self.vars_meta:
+                return None
+            data_type = self.data_types[self.vars_meta[option].datatype]
+            self._types[option] = data_type
+            return data_type
+
+    def parse_value(self, option, value):
+        """parse_value(option, value) -> (typed value, canonical string).
+        Raises ValueError if value isn't valid for option, or references
+        variables (and so is only known on the client).  Values of unknown
+        options are returned as they are, both ways."""
+        data_type = self.type_for(option)
+        if data_type is None:
+            return value, value
+        shell = tokenize(value)
+        if shell.open or shell.refs:
+            raise ValueError(self.plan_for(option)(value) or
+                             '"%s" is set on the client' % value)
+        try:
+            typed = data_type.parse(shell.text)
+        except TypeError, e:
+            raise ValueError(e.message)
+        return typed, quote(data_type.serialize(typed))
+
+    def plan_for(self, option):
+        """plan_for(option) -> check(value) function, or None if the option
+        is not a known variable."""
+        try:
+            return self._plans[option]
+        except KeyError:
+            if option not in self.vars_meta:
+                return None
+            plan = self.compiled(self.vars_meta[option].datatype)
+            self._plans[option] = plan
+            return plan
 
     def check_data(self, option, value):
         """Check an option/value pair to see if it is proper according to the
         data in the LTSVarsConfig object that is passed in at runtime.
         """
-        if option not in self.vars_meta:
-            msg = "Warning: Read unknown option '%s' from LTS config."
-            print msg % option
+        plan = self._plans.get(option) or self.plan_for(option)
+        if plan is None:
+            if option != LIKE_OPTION:
+                msg = "Warning: Read unknown option '%s' from LTS config."
+                print msg % option
         else:
-            var_meta = self.vars_meta[option]
-            error = self.validate(var_meta.datatype, value)
+            error = plan(value)
             if error:
                 msg = "Warning: Bad content (%s) in LTS config for %s: %s"
                 return msg % (value, option, error)
\ No newline at end of file
@@ -33,7 +33,15 @@
 
 import os, sys
 import getopt
+import itertools
 import threading
+import time
+
+import cli
+
+if __name__ == "__main__" and cli.is_cli_invocation(sys.argv[1:]):
+    # headless modes (e.g. --check) must not need gtk or a DISPLAY
+    sys.exit(cli.main(sys.argv[1:]))
 
 try:
     import pygtk
@@ -49,16 +57,18 @@ except:
 
 import configuration
 import data_validation
+import watcher
 
 
 VARS_CONFIG_FILE = "lts_vars.conf"
-LTSVARS_CONFIG = configuration.LTSVarsConfig(VARS_CONFIG_FILE)
+LTSVARS_CONFIG = configuration.LTSVarsConfig(VARS_CONFIG_FILE, use_cache=True)
 
 widget_list = {
     "main_window": ["option_combobox", 'add_option_button',
                     'remove_option_button', 'option_name_entry',
                     'option_value_entry', 'config_hbox',
                     'expand_button', 'collapse_button', 'status1_label',
+                    'filter_entry', 'menu_undo_item', 'menu_redo_item',
                     ],
     'warning_dialog': ["warning_dialog_title_label",
                        'warning_dialog_message_label',
@@ -91,17 +101,45 @@ class uiTreeView(gtk.TreeView):
             self.treestore = gtk.TreeStore(str)
 
         super(uiTreeView, self).__init__(self.treestore)
-        #self.set_has_tooltip(True)
-        self.set_tooltip_column(0)
+        self.set_has_tooltip(True)
         self.connect("query-tooltip", self.tooltip_query)
-        self.last_tooltip = ''  # register changes to the tooltip text
+        self.descriptions = {}  # option name -> tooltip text
+        # called with no arguments for the configuration.EffectiveConfig of
+        # the config shown, to tell where values come from in tooltips
+        self.effective_config = None
+        # likewise for its configuration.ExpandedConfig, to show what values
+        # referring to other variables come to
+        self.expanded_config = None
+        # called with no arguments for {(section, option): change kind} of
+        # the rows to highlight (option None for section rows), or None
+        self.highlights = None
+        # called with no arguments for {(section, option): error message} of
+        # the values that failed validation, which are shown in red
+        self.validation_errors = None
+        # Row index: section name -> TreeIter, and section name -> {option:
+        # TreeIter}.  TreeStore iters persist for as long as their row exists,
+        # so rows are added, updated and removed through the *_row methods
+        # below instead of rebuilding the whole store on every change.
+        # Sections can be added lazily, with a placeholder child row standing
+        # in for their options (section name -> placeholder TreeIter) until
+        # fill_section_rows is called; they have no option_iters entry until
+        # then.
+        self.section_iters = {}
+        self.option_iters = {}
+        self.placeholder_iters = {}
+        # While a filter is set (see set_filter), the view shows a
+        # gtk.TreeModelFilter of the treestore, so paths and iters the view
+        # hands out have to go through store_path before they're used with
+        # the treestore.
+        self.filter = None
+        self.visible_sections = None
 
     def add_columns(self,columns=[], expander_index = -1, edited_callback = None):
         if columns and isinstance(columns, list):
             self.cells = {}
             for i in range(len(columns)):
                 def col0_edited_cb( cell, path, new_text, model, callback ):
-                    callback(cell, path, new_text, model )
+                    callback(cell, self.store_path(path), new_text, model )
                     #if model[path][2] is not new_text:
                     #    print "Change '%s' to '%s'" % (model[path][2], new_text)
                     #    model[path][2] = new_text
@@ -114,14 +152,18 @@ class uiTreeView(gtk.TreeView):
                     self.cells[ columns[i] ].set_property('foreground', 'white')
                 else:
                     self.cells[ columns[i] ].set_property( 'editable', True )
-                    if i == 1:
-                        self.cells[ columns[i] ].set_property( 'editable', False )
                     if edited_callback:
                         self.cells[ columns[i] ].connect( 'edited', col0_edited_cb, self.treestore, edited_callback )
                 setattr(self, 'tvcolumn' + str(i), getattr(gtk, 'TreeViewColumn')(columns[i], self.cells[ columns[i] ]))
                 curr_column = getattr(self, 'tvcolumn' + str(i) )
+                # fixed sizing is required for fixed-height-mode
+                curr_column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+                curr_column.set_fixed_width(200)
+                curr_column.set_resizable(True)
                 #curr_column.pack_start(self.cell, True)
                 curr_column.set_attributes(self.cells[ columns[i] ], text=i, cell_background_set=3)
+                curr_column.set_cell_data_func(self.cells[ columns[i] ],
+                                               self.highlight_cell, i)
                 self.append_column(curr_column)
                 if expander_index >= 0 and i == expander_index:
                     self.set_expander_column(curr_column)
@@ -143,6 +185,145 @@ class uiTreeView(gtk.TreeView):
 
         return iters
 
+    def clear_rows(self):
+        self.treestore.clear()
+        self.section_iters.clear()
+        self.option_iters.clear()
+        self.placeholder_iters.clear()
+
+    def set_section_row(self, section, lazy=False):
+        """Return the iter for a section row, appending the row if needed.
+        A lazily appended row only gets a placeholder child, which makes it
+        expandable; its option rows are added by fill_section_rows."""
+        iter = self.section_iters.get(section)
+        if iter is None:
+            iter = self.append_row([section, None, None, True], None)
+            self.section_iters[section] = iter
+            if lazy:
+                self.placeholder_iters[section] = self.append_row(
+                    [None, None, None, False], iter)
+            else:
+                self.option_iters[section] = {}
+        return iter
+
+    def is_filled(self, section):
+        """False for lazily added sections that were never filled."""
+        return section in self.option_iters
+
+    def fill_section_rows(self, section, items):
+        """Replace the placeholder of a lazily added section with rows for
+        items, a list of (option, value) pairs."""
+        section_iter = self.section_iters[section]
+        options = self.option_iters[section] = {}
+        for option, value in items:
+            options[option] = self.append_row([None, option, value, False],
+                                              section_iter)
+        # removed last, so the row doesn't collapse for lack of children
+        placeholder = self.placeholder_iters.pop(section, None)
+        if placeholder is not None:
+            self.treestore.remove(placeholder)
+
+    def set_option_row(self, section, option, value):
+        """Insert or update a single option row.  Returns True if the model
+        was changed.  Sections that haven't been filled yet are left alone,
+        their rows are read when they're filled."""
+        section_iter = self.set_section_row(section)
+        options = self.option_iters.get(section)
+        if options is None:
+            return False
+        iter = options.get(option)
+        if iter is None:
+            options[option] = self.append_row([None, option, value, False],
+                                              section_iter)
+            return True
+        if self.treestore.get_value(iter, 2) != value:
+            self.treestore.set_value(iter, 2, value)
+            return True
+        return False
+
+    def remove_option_row(self, section, option):
+        iter = self.option_iters.get(section, {}).pop(option, None)
+        if iter is not None:
+            self.treestore.remove(iter)
+
+    def remove_section_row(self, section):
+        iter = self.section_iters.pop(section, None)
+        self.option_iters.pop(section, None)
+        self.placeholder_iters.pop(section, None)
+        if iter is not None:
+            self.treestore.remove(iter)
+
+    def section_of(self, iter, model=None):
+        """Name of the section an option (or section) row belongs to.  iter
+        is a row of model, the treestore by default."""
+        if model is None:
+            model = self.treestore
+        parent = model.iter_parent(iter)
+        if parent is not None:
+            iter = parent
+        return model.get_value(iter, 0)
+
+    def set_filter(self, sections):
+        """Show only the rows of the named sections, or every row if sections
+        is None.  Rows added to the treestore later are filtered as they
+        come; call refilter after the set of sections changes in place."""
+        self.visible_sections = sections
+        if sections is None:
+            if self.filter is not None:
+                self.filter = None
+                self.set_model(self.treestore)
+        elif self.filter is None:
+            self.filter = self.treestore.filter_new()
+            self.filter.set_visible_func(self._row_visible)
+            self.set_model(self.filter)
+        else:
+            self.filter.refilter()
+
+    def refilter(self):
+        if self.filter is not None:
+            self.filter.refilter()
+
+    def _row_visible(self, model, iter):
+        parent = model.iter_parent(iter)
+        if parent is not None:
+            iter = parent
+        return model.get_value(iter, 0) in self.visible_sections
+
+    def store_path(self, path):
+        """The treestore path of a row of the view's model."""
+        if self.filter is None:
+            return path
+        return self.filter.convert_path_to_child_path(path)
+
+    def view_path(self, path):
+        """The path in the view's model of a treestore row, or None if it's
+        filtered out."""
+        if self.filter is None:
+            return path
+        return self.filter.convert_child_path_to_path(path)
+
+    def get_view_state(self):
+        """(expanded section names, scroll position) for set_view_state."""
+        expanded = set()
+        self.map_expanded_rows(
+            lambda view, path, *data: expanded.add(
+                self.treestore[self.store_path(path)][0]))
+        adjustment = self.get_parent().get_vadjustment()
+        return expanded, adjustment.get_value()
+
+    def set_view_state(self, state):
+        expanded, scroll = state
+        for section in expanded:
+            iter = self.section_iters.get(section)
+            if iter is not None:
+                path = self.view_path(self.treestore.get_path(iter))
+                if path is not None:
+                    self.expand_row(path, False)
+        adjustment = self.get_parent().get_vadjustment()
+        # the new rows have not been laid out yet, so the adjustment's upper
+        # bound would clamp the value if it was set right away.
+        gobject.idle_add(adjustment.set_value, scroll)
+
     def other(self):
         # add data
         iter = self.treestore.append(None, ['123', 'Widget'])
@@ -184,85 +365,140 @@ class uiTreeView(gtk.TreeView):
         self.treeview.connect("drag_data_received",
                               self.drag_data_received_data)
 
-    def _set_tooltip(self, treepath, tooltip):
-        model = self.get_model()
-        iter = model.get_iter(treepath)
-        text = self.treestore.get_value(iter, 1)
+    def _description(self, option):
+        """Tooltip text for an option, looked up once and then cached."""
         try:
-            text = LTSVARS_CONFIG[text].description
-        except:
-            text = ''
-        if not text:
+            return self.descriptions[option]
+        except KeyError:
+            if option in LTSVARS_CONFIG:
+                text = LTSVARS_CONFIG[option].description
+            else:
+                text = ''
+            self.descriptions[option] = text
+            return text
+
+    # colours of highlighted rows, by configuration.ConfChange kind
+    HIGHLIGHT_COLORS = {configuration.ADDED: '#c0ecc0',
+                        configuration.CHANGED: '#f4e8a0'}
+    # colour of values that failed validation
+    ERROR_COLOR = '#f4c0c0'
+
+    def highlight_cell(self, column, cell, model, iter, index):
+        """Cell data function colouring the rows self.highlights lists, and
+        the values self.validation_errors has.  Section names are white on
+        black, so their text is coloured instead of their background.
+        Renderers are shared by every row, so the colours are set on every
+        call, not only for highlighted rows."""
+        highlights = self.highlights and self.highlights()
+        option = model.get_value(iter, 1)
+        color = None
+        if option is None:
+            if index == 0:
+                kind = highlights and highlights.get(
+                    (model.get_value(iter, 0), None))
+                cell.set_property('foreground',
+                                  self.HIGHLIGHT_COLORS.get(kind, 'white'))
+        else:
+            errors = index == 2 and self.validation_errors and \
+                self.validation_errors()
+            if highlights or errors:
+                key = (self.section_of(iter, model), option)
+                kind = highlights and highlights.get(key)
+                if kind:
+                    color = self.HIGHLIGHT_COLORS[kind]
+                elif errors and key in errors:
+                    color = self.ERROR_COLOR
+        if color:
+            cell.set_property('cell-background', color)
+            cell.set_property('cell-background-set', True)
+        else:
+            # section rows (column 3 set) are black all the way across
+            cell.set_property('cell-background', 'black')
+            cell.set_property('cell-background-set',
+                              bool(model.get_value(iter, 3)))
+
+    # most inherited settings listed in a section's tooltip
+    INHERITED_LIMIT = 40
+
+    def _origin_text(self, section, option):
+        """What a section's setting of option overrides, if anything."""
+        effective = self.effective_config and self.effective_config()
+        if not effective or not section:
+            return ''
+        overridden = effective.overridden(section, option)
+        if overridden is None:
+            return ''
+        return 'Overrides %s from [%s]' % (overridden[0], overridden[1])
+
+    def _expansion_text(self, section, option, value):
+        """What a value referring to other variables expands to."""
+        if not section or not value or \
+           not data_validation.tokenize(value).refs:
+            return ''
+        expanded = self.expanded_config and self.expanded_config()
+        if not expanded:
+            return ''
+        text = expanded.expand(option, section=section)
+        if text is None or text[0] == value:
+            return ''
+        return 'Expands to: %s' % text[0]
+
+    def _error_text(self, section, option):
+        """Why a value failed validation, if it did."""
+        errors = self.validation_errors and self.validation_errors()
+        error = errors and errors.get((section, option))
+        if not error:
+            return ''
+        if error.startswith('Warning: '):
+            error = error[len('Warning: '):]
+        return 'Invalid value: %s' % error
+
+    def _inherited_text(self, section):
+        """The settings a section gets from [Default] and LIKE profiles."""
+        effective = self.effective_config and self.effective_config()
+        if not effective or not section:
+            return ''
+        inherited = sorted((option, value, origin) for option, (value, origin)
+                           in effective.resolve(section=section).iteritems()
+                           if origin != section)
+        if not inherited:
+            return ''
+        lines = ['Inherited settings:']
+        for option, value, origin in inherited[:self.INHERITED_LIMIT]:
+            lines.append('%s = %s  [%s]' % (option, value, origin))
+        if len(inherited) > self.INHERITED_LIMIT:
+            lines.append('... and %d more' % (len(inherited) -
+                                              self.INHERITED_LIMIT))
+        return '\n'.join(lines)
+
+    def tooltip_query(self, treeview, x, y, keyboard_mode, tooltip):
+        """Show the description of the option under the pointer.
+        get_tooltip_context translates the widget coordinates gtk passes in
+        (which include the column headers) into the row under the pointer,
+        so the row is found directly instead of by scanning the model."""
+        context = self.get_tooltip_context(x, y, keyboard_mode)
+        if not context:
             return False
-        if self.last_tooltip and self.last_tooltip != text:
-            self.last_tooltip = ''
+        model, path, iter = context
+        option = model.get_value(iter, 1)
+        if option:
+            text = self._description(option)
+            section = self.section_of(iter, model)
+            for extra in (self._error_text(section, option),
+                          self._origin_text(section, option),
+                          self._expansion_text(section, option,
+                                               model.get_value(iter, 2))):
+                if extra:
+                    text = '%s\n\n%s' % (text, extra) if text else extra
+        else:
+            text = self._inherited_text(model.get_value(iter, 0))
+        if not text:
             return False
-        self.last_tooltip = text
         tooltip.set_text(text)
+        # have gtk ask again once the pointer leaves this row
+        self.set_tooltip_row(tooltip, path)
         return True
 
-    def tooltip_query(self, treeview, x, y, mode, tooltip):
-        """Horrible, bloody, and ugly.
-        ..but in all fairness, it's not my fault."""
-        # Treepath is off by one for some reason.  ..in a bad way.
-        # ..so, we work around it.
-        model = self.get_model()
-        path = self.get_path_at_pos(x, y)
-        if not path:
-            # every part of our TreeView is tooltippable.  However, GTK thinks
-            # the last item is a blank space.  ..so, we correct that.
-            treepath = [0]  # root items
-            try:
-                # get last root item..
-                while model.get_iter(tuple(treepath)):
-                    treepath[0] += 1
-            except ValueError:
-                treepath[0] -= 1
-                if treepath[0] < 0:
-                    print "Bad treepath."
-                    return False
-            try:
-                # get the last item in this root item
-                treepath.append(0)
-                while model.get_iter(tuple(treepath)):
-                    treepath[1] += 1
-            except ValueError:
-                treepath[1] -= 1
-                treepath = tuple(treepath)
-                if treepath[1] < 0:
-                    print "Bad treepath.."
-                    return False
-            return self._set_tooltip(treepath, tooltip)
-        else:
-            treepath = path[0]
-            if len(treepath) == 1:
-                # We are at the last item in a primary category, but gtk
-                # thinks we're in the first item of the next category.  E.g.,
-                # for a category with 13 entries, we're *actually* on
-                # (0, 12) but gtk thinks we're on (1,).  So, we work around it.
-                treepath = [treepath[0] - 1, 0]
-                if treepath[0] < 0:
-                    return False
-                try:
-                    # get the *actual* last number..
-                    while model.get_iter(tuple(treepath)):
-                        treepath[1] += 1
-                except ValueError:
-                    # back up to the last item that didn't cause an error.
-                    treepath[1] -= 1
-                    if treepath[1] < 0:
-                        return False
-                    treepath = tuple(treepath)
-                iter = model.get_iter(tuple(treepath))
-            else:
-                # the normal use case -- still off by one, but much easier to
-                # handle..
-                treepath = (treepath[0], treepath[1] - 1)
-                if treepath[1] < 0:
-                    return False
-            return self._set_tooltip(treepath, tooltip)
-        return False
-
 class uiBuilder(gtk.Builder):
     def __init__(self, *args, **kwargs):
         super(uiBuilder, self).__init__()
@@ -318,12 +554,30 @@ class uiLogic(uiBuilder):
         self.option_combobox.set_model(gtk.ListStore(str))
         self.option_combobox.set_entry_text_column(0)
         self.option_combobox.pack_start(cell, True)
+        # Completion for the combobox's entry.  Its model only ever holds the
+        # matches for the current text (see on_option_entry_changed), so the
+        # match function doesn't need to filter anything.
+        completion = gtk.EntryCompletion()
+        completion.set_model(gtk.ListStore(str))
+        completion.set_text_column(0)
+        completion.set_match_func(lambda *args: True)
+        self.option_combobox.child.set_completion(completion)
+        self.option_combobox.child.connect('changed',
+                                           self.on_option_entry_changed)
 
         self.config_treeview = uiTreeView( gtk.TreeStore(str, str, str, 'gboolean' ) )
         self.config_treeview.connect('button-press-event', self.on_treeview_button_press_event )
         self.config_treeview.add_columns( ['Sections', 'Options','Values'], 0, self.on_column_edited )
+        self.config_treeview.effective_config = self.effective_config
+        self.config_treeview.expanded_config = self.expanded_config
+        self.config_treeview.highlights = self.highlights
+        self.config_treeview.validation_errors = \
+            lambda: self.validation_errors
         #self.config_treeview.set_default_sort_func( sort_func = None )
-        #self.config_treeview.set_property('fixed-height-mode', True)
+        # all rows are one line high, so gtk needn't measure each of them
+        self.config_treeview.set_property('fixed-height-mode', True)
+        self.config_treeview.connect('row-expanded',
+                                     self.on_config_treeview_row_expanded)
         self.config_treeview.set_grid_lines(gtk.TREE_VIEW_GRID_LINES_BOTH)
         self.expand_button.connect_object('clicked', gtk.TreeView.expand_all,
                                self.config_treeview)
@@ -332,10 +586,16 @@ class uiLogic(uiBuilder):
 
         scrolled_window = gtk.ScrolledWindow()
         scrolled_window.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
-        scrolled_window.add_with_viewport(self.config_treeview)
+        # TreeView scrolls natively; inside a viewport it would be given its
+        # full height and lay out every row
+        scrolled_window.add(self.config_treeview)
 
         self.config_hbox.pack_start(scrolled_window)
 
+        self.main_window.connect('key-press-event',
+                                 self.on_main_window_key_press_event)
+        # several rows can be selected, for editing many sections at once
+        self.config_treeview.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
         self.config_treeview.get_selection().connect('changed',
                                                      self.set_selected_section)
         self.config_treeview.connect('cursor-changed',
@@ -365,29 +625,471 @@ class uiData(dict):
 
 
 class uiHelpers(object):
-    def _init(self):
+    # set to cancel the file load in progress, if any
+    _load_cancel = None
+    # whether self.config is the loaded file yet; until it is, it's an
+    # empty stand-in that mustn't be edited or saved over the file
+    loaded = False
+    # how long a chunk of tree rows may take to add, in seconds
+    LOAD_CHUNK_TIME = 0.02
+    # most completions offered for the option entry
+    COMPLETION_LIMIT = 100
+    # the configuration.ExpandedConfig of the config -- see expanded_config
+    _expanded = None
+    # the LTSConfDocument the config is being compared with, if any, and
+    # (config, its change count, highlights) -- see highlights
+    compared = None
+    _highlights = None
+    # the watcher.FileWatcher of the config file and lts_vars.conf
+    _watcher = None
+    # most edits that can be undone
+    UNDO_LIMIT = 1000
+    # the configuration.EditJournal of the config's edits
+    journal = None
+
+    def _init(self, fname=None):
+        self.cancel_load()
         self.vars_meta = LTSVARS_CONFIG
         self.validator = data_validation.LTSPValidator(self.vars_meta)
-        self.config = configuration.Raw()
-        self.config.optionxform = str
-        self.config_filename = sys.path[0] + '/' + 'lts.conf'
+        self.config = configuration.LTSConfDocument(schema=self.validator)
+        self.loaded = False
+        self.config_filename = fname or sys.path[0] + '/' + 'lts.conf'
         self.selected_section = (None, None)
-        self.config_treeview.get_model().clear()
+        # (section, option) -> error message, for values checked so far
+        self.validation_errors = {}
+        self.checked_sections = set()
+        # every known variable, plus every option set in the config
+        self.option_names = configuration.NameIndex(self.vars_meta.vars)
+        self._combobox_names = None
+        self.compared = None
+        if self.journal is not None:
+            # the user chose to drop the unsaved edits of the config being
+            # left, so they mustn't be offered for recovery later
+            self.journal.close(discard=True)
+        # replaced by one kept in a file once the config is loaded
+        self.journal = configuration.EditJournal(self.UNDO_LIMIT)
+        self._toggle_undo_items()
+        self.config_treeview.clear_rows()
         self.status1_label.set_text('')
         self.warning_dialog_message_label.set_text('')
         self.option_combobox.child.set_text('')
+        self.filter_entry.set_text('')
         #self.option_name_entry.set_text('')
         #self.option_value_entry.set_text('')
         self.main_window.set_title('LTSP Configuration')
         self.status1_label.set_text('Editing Config')
         self._toggle_option_buttons()
         self.update_option_combobox()
+        self.load_config_file(self.config_filename)
+        self.watch_files()
+
+    def load_config_file(self, fname):
+        """Read, parse and validate fname on a worker thread, then add its
+        rows to the tree in chunks from the main loop, so the window stays
+        responsive however big the file is.  Progress is shown in the status
+        bar; cancel_load (bound to Escape) stops it.  The worker checks
+        the values with a validator of its own, which replaces
+        self.validator once the load is done, so the two threads never
+        share a validation cache."""
+        self.cancel_load()
+        cancel = self._load_cancel = threading.Event()
+        validator = data_validation.LTSPValidator(self.vars_meta)
+        worker = threading.Thread(target=self._load_worker,
+                                  args=(fname, cancel, validator))
+        worker.daemon = True
+        worker.start()
+
+    def cancel_load(self):
+        """Stop the file load in progress.  Returns True if there was one."""
+        if self._load_cancel is None:
+            return False
+        self._load_cancel.set()
+        self._load_cancel = None
+        return True
+
+    def _load_worker(self, fname, cancel, validator):
+        """Runs on the worker thread.  Nothing in here may touch gtk; results
+        are handed to the main loop through gobject.idle_add."""
+        def progress(done, total):
+            gobject.idle_add(self._load_progress, cancel, 'Reading',
+                             done, total)
+            return not cancel.is_set()
+
+        config = configuration.LTSConfDocument(schema=validator)
+        try:
+            problems = config.load(fname, progress)
+        except configuration.LoadCancelled:
+            return
+        except IOError:
+            # no file yet -- start with an empty config
+            problems = []
+        errors = {}
+        names = list(self.vars_meta.vars)
+        sections = config.sections()
+        for done, section in enumerate(sections):
+            if cancel.is_set():
+                return
+            for option, value in config.items(section):
+                names.append(option)
+                error = validator.check_data(option, value)
+                if error:
+                    errors[(section, option)] = error
+                    # printed from here, not from the main loop
+                    print "Warning for %s: %s" % (option, error)
+            if not done % 200:
+                gobject.idle_add(self._load_progress, cancel, 'Checking',
+                                 done, len(sections))
+        option_names = configuration.NameIndex(names)
+        gobject.idle_add(self._load_finished, cancel, config, problems,
+                         errors, option_names, validator)
+
+    def _load_progress(self, cancel, stage, done, total):
+        if not cancel.is_set():
+            percent = 100 * done / total if total else 100
+            self.status1_label.set_text('%s %s... %d%%' % (
+                stage, os.path.basename(self.config_filename), percent))
+        return False
+
+    def _load_finished(self, cancel, config, problems, errors,
+                       option_names, validator):
+        if cancel.is_set():
+            return False
+        self.config = config
+        self.validator = validator
+        self.loaded = True
+        self.option_names = option_names
+        # option_name_added and option_name_removed patch the combobox by
+        # positions in option_names, so it's refilled along with it, before
+        # anything can be edited
+        self.update_option_combobox()
+        self._report_problems(problems)
+        self.validation_errors = errors
+        for section, problem in self.effective_config().problems:
+            print "Warning: [%s] %s" % (section, problem)
+        # everything has been checked, so sections needn't be checked again
+        # as they're filled in
+        self.checked_sections = set(config.sections())
+        recovered = self._open_journal()
+        self.config_treeview.clear_rows()
+        self.apply_filter()
+        sections = iter(config.sections())
+        gobject.idle_add(self._load_rows, cancel, sections, 0, problems,
+                         recovered)
+        return False
+
+    def journal_filename(self):
+        """Where the undo history of the config file is kept: a hidden
+        file next to it."""
+        directory, name = os.path.split(self.config_filename)
+        return os.path.join(directory, '.%s.journal' % name)
+
+    def _open_journal(self):
+        """Start the undo history of the config just loaded, recovering
+        the edits of a session that ended without saving them if the user
+        wants them back.  Returns how many changes were recovered."""
+        self.journal = configuration.EditJournal(self.UNDO_LIMIT,
+                                                 self.journal_filename())
+        changes = None
+        if self.journal.recoverable(self.config.source):
+            self.warning_dialog_message_label.set_text(
+                '%s has unsaved changes from an earlier session.\n'
+                'Recover them?' % os.path.basename(self.config_filename))
+            if self.warning_dialog.run():
+                changes = self.journal.recover(self.config)
+        if changes is None:
+            self.journal.rebase(self.config.source)
+        else:
+            # the rows are added afterwards, from the recovered config
+            self.apply_edits(changes)
+        self._toggle_undo_items()
+        return len(changes or ())
+
+    def _load_rows(self, cancel, sections, done, problems, recovered=0):
+        """Add section rows until LOAD_CHUNK_TIME is up, then yield to the
+        main loop, which calls this again until all rows are in."""
+        if cancel.is_set():
+            return False
+        treeview = self.config_treeview
+        deadline = time.time() + self.LOAD_CHUNK_TIME
+        while time.time() < deadline:
+            chunk = list(itertools.islice(sections, 100))
+            for section in chunk:
+                treeview.set_section_row(
+                    section, lazy=bool(self.config.options(section)))
+            done += len(chunk)
+            if len(chunk) < 100:
+                self._load_cancel = None
+                status = 'Loaded %d sections' % done
+                if problems:
+                    status += ', %d problem line(s), see console' % len(
+                        problems)
+                if self.validation_errors:
+                    status += ', %d invalid value(s) shown in red' % len(
+                        self.validation_errors)
+                if recovered:
+                    status += ', %d unsaved change(s) recovered' % recovered
+                self.status1_label.set_text(status)
+                self._toggle_option_buttons()
+                return False
+        self._load_progress(cancel, 'Loading', done,
+                            len(self.config.sections()))
+        gobject.idle_add(self._load_rows, cancel, sections, done, problems,
+                         recovered)
+        return False
+
+    def watch_files(self):
+        """(Re)start watching the config file and lts_vars.conf for changes
+        made by other programs."""
+        self.stop_watching()
+        self._watcher = watcher.FileWatcher(
+            [self.config_filename, VARS_CONFIG_FILE],
+            lambda path: gobject.idle_add(self._file_changed, path))
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _file_changed(self, path):
+        if path == os.path.abspath(VARS_CONFIG_FILE):
+            self._reload_vars()
+        if path == os.path.abspath(self.config_filename):
+            self._reload_config()
+        return False
+
+    def _reload_config(self):
+        """Bring the tree in line with the config file after another program
+        changed it.  Only the sections whose lines changed are read again
+        (see LTSConfDocument.reload), and only their changed rows are
+        updated and checked.  Unsaved edits are only dropped if the user
+        says so."""
+        fname = self.config_filename
+        name = os.path.basename(fname)
+        try:
+            with open(fname, 'rb') as conf:
+                text = conf.read()
+        except IOError, e:
+            self.status1_label.set_text('%s changed but could not be read: '
+                                        '%s' % (name, e.strerror))
+            return
+        if self._load_cancel is not None:
+            # still loading -- start over on the new contents
+            self.load_config_file(fname)
+            return
+        if text == self.config.source:
+            # touched, or our own save
+            return
+        if self.config.modified:
+            self.warning_dialog_message_label.set_text(
+                '%s was changed by another program.\n'
+                'Reload it and lose your unsaved changes?' % name)
+            if not self.warning_dialog.run():
+                self.status1_label.set_text(
+                    '%s was changed by another program, not reloaded' % name)
+                return
+        changes, problems = self.config.reload(text)
+        self._report_problems(problems)
+        self._track_edits(changes)
+        # the history was of the old text
+        self.journal.clear()
+        self.journal.rebase(text)
+        self._toggle_undo_items()
+        treeview = self.config_treeview
+        sections = []
+        sections_removed = False
+        for change in changes:
+            section, option = change.section, change.option
+            if section not in sections:
+                sections.append(section)
+            if option is None:
+                sections_removed |= change.kind == configuration.REMOVED
+            elif change.kind == configuration.ADDED:
+                self.option_name_added(option)
+            elif change.kind == configuration.REMOVED:
+                self.option_name_removed(option)
+                self.validation_errors.pop((section, option), None)
+        for section in sections:
+            if not self.config.has_section(section):
+                for key in [key for key in self.validation_errors
+                            if key[0] == section]:
+                    del self.validation_errors[key]
+            elif section not in treeview.section_iters:
+                treeview.set_section_row(
+                    section, lazy=bool(self.config.options(section)))
+            if not treeview.is_filled(section):
+                # checked when it's filled
+                self.checked_sections.discard(section)
+        self.update_rows(sections)
+        if sections_removed:
+            # the options of removed sections aren't listed one by one
+            names = list(self.vars_meta.vars)
+            for section in self.config.sections():
+                names.extend(self.config.options(section))
+            self.option_names = configuration.NameIndex(names)
+            self.update_option_combobox()
+        status = 'Reloaded %s: %d change(s)' % (name, len(changes))
+        if problems:
+            status += ', %d problem line(s), see console' % len(problems)
+        self.status1_label.set_text(status)
+        self._toggle_option_buttons()
+
+    def _reload_vars(self):
+        """Pick up a changed lts_vars.conf, checking again the options whose
+        variable was added, removed or redefined."""
+        global LTSVARS_CONFIG
+        old = self.vars_meta
+        try:
+            new = configuration.LTSVarsConfig(VARS_CONFIG_FILE,
+                                              use_cache=True)
+        except (IOError, OSError), e:
+            self.status1_label.set_text('%s changed but could not be read: '
+                                        '%s' % (VARS_CONFIG_FILE, e))
+            return
+        LTSVARS_CONFIG = self.vars_meta = new
+        self.validator = data_validation.LTSPValidator(new)
+        self.config.set_schema(self.validator)
+        if self._load_cancel is not None:
+            # still loading -- start over, checking against the new
+            # variables
+            self.load_config_file(self.config_filename)
+            return
+        self.config_treeview.descriptions.clear()
+        self._highlights = None
+        self._expanded = None
+        names = list(new.vars)
+        redefined = 0
+        for section in self.config.sections():
+            for option, value in self.config.items(section):
+                names.append(option)
+                if (old[option] if option in old else None) != \
+                   (new[option] if option in new else None):
+                    self._check_option(section, option, value)
+                    redefined += 1
+        self.option_names = configuration.NameIndex(names)
+        self.update_option_combobox()
+        # rows whose value became (in)valid are redrawn in their new colour
+        self.config_treeview.queue_draw()
+        self.status1_label.set_text('Reloaded %s: %d option(s) checked again'
+                                    % (VARS_CONFIG_FILE, redefined))
+
+    def _report_problems(self, problems):
+        """Print the lines of the file that can't be modelled (duplicate
+        keys, options outside a section, garbage).  They are kept as they
+        are when the file is saved."""
+        messages = {
+            configuration.DUPLICATE: '%s appears more than once',
+            configuration.ORPHAN: '%s is outside of any section',
+            configuration.INVALID: 'unparseable line: %s',
+            }
+        for record in problems:
+            if record.kind == configuration.INVALID:
+                subject = record.value
+            else:
+                subject = record.key or '[%s]' % record.section
+            message = messages[record.kind] % subject
+            print "Warning: line %d: %s" % (record.lineno, message)
+
+    def effective_config(self):
+        """The configuration.EffectiveConfig of the current config."""
+        return self.expanded_config().effective
+
+    def expanded_config(self):
+        """The configuration.ExpandedConfig of the current config.  Edits
+        made through the editor are passed to it by _track_edits, which
+        keeps it up to date; it's only rebuilt after changes it wasn't
+        told about."""
+        config = self.config
+        expanded = self._expanded
+        if expanded is None or expanded.config is not config or \
+           expanded.changes != config.changes or \
+           expanded.vars_meta is not self.vars_meta:
+            expanded = configuration.ExpandedConfig(config, self.vars_meta)
+            self._expanded = expanded
+        return expanded
+
+    def _track_edits(self, changes):
+        """Pass changes, just made to self.config, on to its
+        ExpandedConfig, so only the values depending on them are expanded
+        again."""
+        expanded = self._expanded
+        if expanded is not None and expanded.config is self.config:
+            expanded.update(changes)
+
+    def compare_with(self, fname):
+        """Highlight the rows that differ from the lts.conf file fname."""
+        compared = configuration.LTSConfDocument(schema=self.validator)
+        compared.load(fname)
+        self.compared = compared
+        self._highlights = None
+        changes = configuration.diff_configs(compared, self.config,
+                                             self.validator)
+        counts = dict((kind, 0) for kind in (configuration.ADDED,
+                                             configuration.CHANGED,
+                                             configuration.REMOVED))
+        for change in changes:
+            counts[change.kind] += 1
+        self.status1_label.set_text(
+            'Compared with %s: %d added, %d changed, %d removed' % (
+                os.path.basename(fname), counts[configuration.ADDED],
+                counts[configuration.CHANGED], counts[configuration.REMOVED]))
+        self.config_treeview.queue_draw()
+
+    def highlights(self):
+        """{(section, option): change kind} of what was added or changed
+        since the compared file, worked out again only after the config
+        has changed."""
+        if self.compared is None:
+            return None
+        config = self.config
+        cached = self._highlights
+        if cached is None or cached[0] is not config or \
+           cached[1] != config.changes:
+            highlights = dict(
+                ((change.section, change.option), change.kind)
+                for change in configuration.diff_configs(
+                    self.compared, config, self.validator)
+                if change.kind != configuration.REMOVED)
+            cached = (config, config.changes, highlights)
+            self._highlights = cached
+        return cached[2]
+
+    def apply_filter(self):
+        """Show only the sections matching the query in the filter bar (see
+        configuration.ConfIndex.search), or every section if it's empty.
+        Returns a message for the status bar."""
+        query = self.filter_entry.get_text()
         try:
-            self.config.read([self.config_filename])
-        except configuration.ConfigParser.MissingSectionHeaderError:
-            self.config_filename = None
-            self.status1_label.set_text('Error: File Missing Section Header')
-        self.update_config_treeview()
+            sections = self.config.index().search(query)
+        except configuration.QueryError, e:
+            return 'Bad filter: %s' % e
+        self.config_treeview.set_filter(sections)
+        if sections is None:
+            return 'Showing all sections'
+        return 'Showing %d of %d sections' % (len(sections),
+                                              len(self.config.sections()))
+
+    def _toggle_undo_items(self):
+        self.menu_undo_item.set_sensitive(self.journal.can_undo())
+        self.menu_redo_item.set_sensitive(self.journal.can_redo())
+
+    def _check_loaded(self):
+        """True if the config file has been loaded, so the config can be
+        edited and saved.  If not, says why nothing happens."""
+        if self.loaded:
+            return True
+        name = os.path.basename(self.config_filename)
+        if self._load_cancel is not None:
+            self.status1_label.set_text('Still loading %s' % name)
+        else:
+            self.status1_label.set_text('Loading %s was cancelled; open it '
+                                        'again to edit it' % name)
+        return False
+
+    def record_edits(self, changes):
+        """Add changes, just made to self.config, to the undo history as
+        one edit."""
+        self.journal.record(changes)
+        self._toggle_undo_items()
 
     def _toggle_option_buttons(self):
         if self.config.sections() and self.selected_section[0]:
@@ -397,49 +1099,173 @@ class uiHelpers(object):
             self.remove_option_button.set_sensitive(False)
 
     def set_selected_section(self, widget, data = None):
-        treeselection = self.config_treeview.get_selection()
-        treeselection.set_mode(gtk.SELECTION_SINGLE)
-        ( tree_model, tree_iter ) = treeselection.get_selected()
-        try:
-            self.selected_section= ( tree_model.get_value(tree_iter, 0), tree_iter)
-        except TypeError, e:
-            #catch TypeError after removing row
+        rows = self.selected_rows()
+        if rows:
+            self.selected_section = (rows[0][0], None)
+        else:
             self.selected_section = (None, None)
-        finally:
-            self._toggle_option_buttons()
+        self._toggle_option_buttons()
+
+    def selected_rows(self):
+        """(section, option) of every selected row, in tree order; option is
+        None for section rows."""
+        treeview = self.config_treeview
+        model, paths = treeview.get_selection().get_selected_rows()
+        rows = []
+        for path in paths:
+            iter = model.get_iter(path)
+            option = model.get_value(iter, 1)
+            if option is None and model.iter_parent(iter) is not None:
+                # placeholder
+                continue
+            rows.append((treeview.section_of(iter, model), option))
+        return rows
+
+    def selected_sections(self):
+        """Names of the sections with any row selected, in tree order."""
+        sections = []
+        seen = set()
+        for section, option in self.selected_rows():
+            if section not in seen:
+                seen.add(section)
+                sections.append(section)
+        return sections
 
     def update_option_combobox(self):
         """Update the option combobox with all available variables/options,
         including both 'unofficial' ones that are a part of the user's config,
-        and 'official' ones that are a part of the vars_conf metadata."""
+        and 'official' ones that are a part of the vars_conf metadata.
+        Single names are added and removed through option_name_added and
+        option_name_removed, so this only refills the list when the whole
+        index was replaced (e.g. by loading a file)."""
+        if self._combobox_names is self.option_names:
+            return
         model = self.option_combobox.get_model()
+        self.option_combobox.set_model(None)  # don't signal every append
         model.clear()
-        vars = set(self.vars_meta.vars)
-        for section in self.config.sections():
-            vars.update(self.config.items(section))
-        vars = list(vars)
-        for var in sorted(vars):
-            model.append([var])
-
-    def update_config_treeview(self):
-        self.config_treeview.get_model().clear()
+        for name in self.option_names:
+            model.append([name])
+        self.option_combobox.set_model(model)
+        self._combobox_names = self.option_names
+
+    def option_name_added(self, name):
+        """Count one more use of an option name, and show it in the
+        combobox if it's new."""
+        position = self.option_names.add(name)
+        if position is not None:
+            self.option_combobox.get_model().insert(position, [name])
+
+    def option_name_removed(self, name):
+        position = self.option_names.discard(name)
+        if position is not None:
+            model = self.option_combobox.get_model()
+            model.remove(model.get_iter((position,)))
+
+    def _check_option(self, section, option, value):
+        error = self.validator.check_data(option, value)
+        if error:
+            self.validation_errors[(section, option)] = error
+            print "Warning for %s: %s" % (option, error)
+        else:
+            self.validation_errors.pop((section, option), None)
+
+    def update_config_treeview(self, keep_view_state=False):
+        """Rebuild the whole tree from self.config.  Only used when a file is
+        (re)loaded -- single edits go through update_section_rows.
+        Only section rows are added; the options of a section are added (and
+        checked) when it is first expanded.  If keep_view_state is set, the
+        user's expanded sections and scroll position survive the rebuild."""
+        treeview = self.config_treeview
+        if keep_view_state:
+            state = treeview.get_view_state()
+        treeview.clear_rows()
 
         if self.config_filename:
             self.main_window.set_title('LTSP Configuration')
 
+        self.checked_sections = set()
         for section in self.config.sections():
-            row = [section, None, None, True]
-            section_iter = self.config_treeview.add_row(row, None)
-            for option, value in self.config.items(section):
-                error = self.validator.check_data(option, value)
-                if error:
-                    print "Warning for %s: %s" % (option, error)
-                try:
-                    tooltip = self.vars_meta[option].description
-                except:
-                    tooltip = ''
-                self.config_treeview.add_row([ None, option, value, False ], section_iter)
-        self.config_treeview.expand_all()
+            treeview.set_section_row(section,
+                                     lazy=bool(self.config.options(section)))
+        if keep_view_state:
+            treeview.set_view_state(state)
+
+    def _fill_section(self, section):
+        items = self.config.items(section)
+        if section not in self.checked_sections:
+            for option, value in items:
+                self._check_option(section, option, value)
+            self.checked_sections.add(section)
+        self.config_treeview.fill_section_rows(section, items)
+
+    def update_section_rows(self, section):
+        """Bring the rows of a single section in line with self.config,
+        touching (and validating) only the rows that actually changed."""
+        self.update_rows([section])
+
+    def update_rows(self, sections, check=True):
+        """update_section_rows for several sections, refiltering once.  If
+        check is false, changed values aren't validated (the caller has
+        done that)."""
+        treeview = self.config_treeview
+        for section in sections:
+            if not self.config.has_section(section):
+                treeview.remove_section_row(section)
+                continue
+            treeview.set_section_row(section)
+            # if it isn't filled, rows are read (and checked) when the
+            # section is expanded
+            if treeview.is_filled(section):
+                self._update_option_rows(section, check)
+        if treeview.filter is not None:
+            # the change may have moved sections in or out of the filter
+            self.apply_filter()
+
+    def _update_option_rows(self, section, check=True):
+        treeview = self.config_treeview
+        current = dict(self.config.items(section))
+        for option in treeview.option_iters[section].keys():
+            if option not in current:
+                treeview.remove_option_row(section, option)
+        for option, value in self.config.items(section):
+            if treeview.set_option_row(section, option, value) and check:
+                self._check_option(section, option, value)
+
+    def apply_edits(self, changes):
+        """Bring the tree, the option names and the validation errors in
+        line with changes, a [configuration.ConfChange] just made to
+        self.config (by the bulk_* functions, say).  Each distinct new
+        value is validated once, however many sections it went to, and
+        the rows are updated in one go."""
+        errors = {}  # (option, value) -> error message or None
+        sections = []
+        seen = set()
+        for change in changes:
+            section, option = change.section, change.option
+            if section not in seen:
+                seen.add(section)
+                sections.append(section)
+            if option is None:
+                if change.kind == configuration.REMOVED:
+                    self.checked_sections.discard(section)
+                continue
+            if change.kind == configuration.REMOVED:
+                self.option_name_removed(option)
+                self.validation_errors.pop((section, option), None)
+                continue
+            if change.kind == configuration.ADDED:
+                self.option_name_added(option)
+            key = (option, change.new)
+            if key not in errors:
+                errors[key] = self.validator.check_data(option, change.new)
+                if errors[key]:
+                    print "Warning for %s: %s" % (option, errors[key])
+            if errors[key]:
+                self.validation_errors[(section, option)] = errors[key]
+            else:
+                self.validation_errors.pop((section, option), None)
+        self._track_edits(changes)
+        self.update_rows(sections, check=False)
         #for section in self.secopt.keys():
         #    section_iter = self.config_treeview.add_row([section, None, None, False], None)
         #    for n in range(len(self.secopt[ section ]['options'])):
@@ -458,7 +1284,21 @@ class uiSignals(uiHelpers):
         self._init()
 
     def on_column_edited(self, cell, path, new_text, model ):
+        if not self._check_loaded():
+            return
         var = model[path][1]
+        if var is None:
+            # section rows and placeholders have no value to edit
+            return
+        # option rows don't carry their section; it lives on the parent
+        section = self.config_treeview.section_of(model.get_iter(path))
+        # an edit to one of several selected sections goes to all of them
+        sections = self.selected_sections()
+        if section not in sections:
+            sections = [section]
+        if cell is self.config_treeview.cells['Options']:
+            self.rename_option(sections, var, new_text.strip())
+            return
         if var in self.vars_meta:
             var_data = self.vars_meta[var]
             error = self.validator.check_data(var, new_text)
@@ -472,18 +1312,37 @@ class uiSignals(uiHelpers):
         #if model[path][1] != new_text:
         #    self.status1_label.set_text('Changed %s to %s' % (model[path][1], new_text))
 
-        if model[path][2] != new_text:
-            self.status1_label.set_text(status % (model[path][1], new_text))
-            model[path][2] = new_text
-	    self.config.set( model[path][0], model[path][1], model[path][2] )
-        return
+        # one section or many, the edit takes the same way as bulk edits
+        # and undo, so the rows, names and errors are updated alike
+        changes = configuration.bulk_set(self.config, sections, var,
+                                         new_text)
+        if not changes:
+            return
+        self.apply_edits(changes)
+        self.record_edits(changes)
+        if len(sections) > 1:
+            self.status1_label.set_text('Set %s to %s in %d section(s)' % (
+                var, new_text, len(changes)))
+        else:
+            self.status1_label.set_text(status % (var, new_text))
+
+    def rename_option(self, sections, option, new_name):
+        if not new_name or new_name == option:
+            return
+        changes = configuration.bulk_rename(self.config, sections, option,
+                                            new_name)
+        self.apply_edits(changes)
+        self.record_edits(changes)
+        renamed = len(set(change.section for change in changes))
+        self.status1_label.set_text('Renamed %s to %s in %d section(s)' % (
+            option, new_name, renamed))
 
     def gtk_widget_hide(self, w, e):
         w.hide()
         return
 
     def on_menu_new_item_activate(self, w = None, e = None):
-        if self.config.sections():
+        if self.config.modified:
             self.warning_dialog_message_label.set_text('You have some unsaved work.\nAre you sure you want to create a new config file?')
             if self.warning_dialog.run():
                 self._init()
@@ -491,18 +1350,9 @@ class uiSignals(uiHelpers):
     def on_menu_open_item_activate(self, w = None, e = None):
         def run():
             if self.open_dialog.run():
-                self._init()
-                self.status1_label.set_text('Go!')
-                self.config_filename = self.open_dialog.get_filename()
-                try:
-                    self.config.read([self.config_filename])
-                except configuration.ConfigParser.MissingSectionHeaderError:
-                    self.config_filename = None
-                    status = 'Error: File Missing Section Header'
-                    self.status1_label.set_text(status)
-                self.update_config_treeview()
-
-        if self.config.sections():
+                self._init(self.open_dialog.get_filename())
+
+        if self.config.modified:
             warning = ('You have some unsaved work.\n'
                        'Are you sure you want to open another config file?')
             self.warning_dialog_message_label.set_text(warning)
@@ -512,9 +1362,19 @@ class uiSignals(uiHelpers):
             run()
 
     def _save_menu_helper(self):
+        if not self._check_loaded():
+            return False
         if self.config_filename:
-            with open(self.config_filename, 'wb') as c:
-                self.config.write(c)
+            try:
+                self.config.save(self.config_filename)
+            except (IOError, OSError), e:
+                self.status1_label.set_text('Error: %s' % e)
+                return False
+            # the history is kept, but the file starts over from the saved
+            # text (under the new name, after a save as)
+            self.journal.close(discard=True)
+            self.journal.fname = self.journal_filename()
+            self.journal.rebase(self.config.source)
             self.status1_label.set_text('Saved %s' %
                                         (self.config_filename.split('/')[-1]))
             return False
@@ -525,39 +1385,59 @@ class uiSignals(uiHelpers):
             if(self._save_menu_helper()):
                 self.on_menu_save_as_item_activate()
 
+    def on_menu_compare_item_activate(self, w = None, e = None):
+        title = self.open_dialog.get_title()
+        self.open_dialog.set_title('Compare With..')
+        try:
+            if self.open_dialog.run():
+                self.compare_with(self.open_dialog.get_filename())
+        except (IOError, OSError), e:
+            self.status1_label.set_text('Could not compare: %s' % e)
+        finally:
+            self.open_dialog.set_title(title)
+
     def on_menu_save_as_item_activate(self, w = None, e = None):
         #if self.config.sections():
-            if self.save_dialog.run():
+            if self._check_loaded() and self.save_dialog.run():
                 self.config_filename = self.save_dialog.get_filename()
                 self._save_menu_helper()
+                self.watch_files()
 
     def on_remove_secopt_button_cb(self, w, e = None):
-        print dir(self.config_treeview.get_selection()), self.config_treeview.get_selection()
-        treeselection = self.config_treeview.get_selection()
-        (tree_model, tree_iter) = treeselection.get_selected()
-        try:
-            section = tree_model.get_value(tree_iter, 0)
-            option = tree_model.get_value(tree_iter, 1)
-            value = tree_model.get_value(tree_iter, 2)
-        except TypeError, e:
+        """Remove the selected sections and options, all in one go."""
+        rows = self.selected_rows()
+        if not rows or not self._check_loaded():
             return
-
-        tree_model.remove(tree_iter)
-
-        if not option:
-            self.status1_label.set_text('Removed %s' % (section))
-            self.config.remove_section( section )
-        else:
-            self.status1_label.set_text('Removed %s from %s' % (option, section))
-            self.config.remove_option(section, option)
-
+        removed_sections = [section for section, option in rows
+                            if option is None]
+        options = {}  # option -> sections to remove it from
+        for section, option in rows:
+            if option is not None and section not in removed_sections:
+                options.setdefault(option, []).append(section)
+        changes = configuration.bulk_remove_sections(self.config,
+                                                     removed_sections)
+        for option, sections in sorted(options.iteritems()):
+            changes.extend(configuration.bulk_unset(self.config, sections,
+                                                    option))
         self.selected_section = (None, None)
-        self.update_config_treeview()
+        self.apply_edits(changes)
+        self.record_edits(changes)
+        if len(rows) > 1:
+            self.status1_label.set_text(
+                'Removed %d section(s) and %d option(s)' % (
+                    len(removed_sections), len(rows) - len(removed_sections)))
+        elif removed_sections:
+            self.status1_label.set_text('Removed %s' % rows[0][0])
+        else:
+            self.status1_label.set_text('Removed %s from %s' % (rows[0][1],
+                                                                rows[0][0]))
 
     def on_option_name_entry_changed(self, w=None, e=None):
         self._toggle_option_buttons()
 
     def on_add_option_button_cb(self, w, e = None):
+        if not self._check_loaded():
+            return
         section = self.selected_section[0]
         if section is None:
             msg = "Can't add option: Select a section first"
@@ -574,15 +1454,58 @@ class uiSignals(uiHelpers):
             value = ''
             status = "Added unknown option %s to %s   "
 
+        sections = self.selected_sections()
+        if len(sections) > 1:
+            changes = configuration.bulk_set(self.config, sections, var,
+                                             value, replace=False)
+            self.apply_edits(changes)
+            self.record_edits(changes)
+            self.status1_label.set_text('Added %s to %d of %d sections' % (
+                var, len(changes), len(sections)))
+            return
+
         if var and section:
             if var in dict(self.config.items(section)):
                 self.status1_label.set_text("Option %s already present." % var)
                 return
             self.config.set(section, var, value )
+            self.option_name_added(var)
+            changes = [configuration.ConfChange(configuration.ADDED, section,
+                                                var, None, value)]
+            self._track_edits(changes)
+            self.record_edits(changes)
 
         self.status1_label.set_text(status % (var, section))
-        self.update_config_treeview()
-        self.update_option_combobox()
+        self.update_section_rows(section)
+
+    def on_menu_undo_item_activate(self, w=None, e=None):
+        if not self._check_loaded():
+            return
+        changes = self.journal.undo(self.config)
+        if changes is not None:
+            self.apply_edits(changes)
+            self.status1_label.set_text('Undid %d change(s)' % len(changes))
+        self._toggle_undo_items()
+
+    def on_menu_redo_item_activate(self, w=None, e=None):
+        if not self._check_loaded():
+            return
+        changes = self.journal.redo(self.config)
+        if changes is not None:
+            self.apply_edits(changes)
+            self.status1_label.set_text('Redid %d change(s)' % len(changes))
+        self._toggle_undo_items()
+
+    def on_main_window_key_press_event(self, widget, event):
+        if event.keyval == gtk.keysyms.Escape and self.cancel_load():
+            self.status1_label.set_text('Loading cancelled')
+            return True
+        return False
+
+    def on_config_treeview_row_expanded(self, treeview, iter, path):
+        section = treeview.get_model().get_value(iter, 0)
+        if not treeview.is_filled(section):
+            self._fill_section(section)
 
     def on_treeview_button_press_event(self, treeview, event):
         if event.button == 3:
@@ -606,6 +1529,9 @@ class uiSignals(uiHelpers):
 
     # close the window and quit
     def delete_event(self, widget, event=None, data=None):
+        self.stop_watching()
+        # unsaved edits are kept, to be offered back next time
+        self.journal.close(discard=not self.config.modified)
         gtk.main_quit()
         return False
 
@@ -615,9 +1541,31 @@ class uiSignals(uiHelpers):
     def on_warning_dialog_ok_button_clicked(self, w=None, e=None):
         self.warning_dialog.hide()
 
+    def on_filter_entry_changed(self, entry):
+        self.status1_label.set_text(self.apply_filter())
+
     def on_option_combobox_popup(self, w=None, e=None):
         self.update_option_combobox()
 
+    def on_option_entry_changed(self, entry):
+        """Offer the option names starting with the typed text, followed by
+        those containing it elsewhere."""
+        text = entry.get_text().strip()
+        model = entry.get_completion().get_model()
+        model.clear()
+        if not text:
+            return
+        limit = self.COMPLETION_LIMIT
+        matches = self.option_names.prefix_matches(text, limit)
+        if len(matches) < limit:
+            for name in self.option_names.substring_matches(text, limit):
+                if len(matches) == limit:
+                    break
+                if not name.startswith(text):
+                    matches.append(name)
+        for name in matches:
+            model.append([name])
+
     def make_pb(self, tvcolumn, cell, model, iter):
         stock = model.get_value(iter, 1)
         pb = self.treeview.render_icon(stock, gtk.ICON_SIZE_MENU, None)
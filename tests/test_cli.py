@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of the command line modes in cli.py.
+
+    python tests/test_cli.py
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cli
+import configuration
+import data_validation
+
+
+class CheckTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        vars_meta = configuration.LTSVarsConfig(os.path.join(
+            ROOT, 'lts_vars.conf'))
+        cls.validator = data_validation.LTSPValidator(vars_meta)
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def check(self, text, strict=False):
+        """(errors counted, [diagnostic]) of --check on a file of text."""
+        fname = os.path.join(self.scratch, 'lts.conf')
+        with open(fname, 'wb') as conf:
+            conf.write(text)
+        out = StringIO()
+        errors = cli.check_files([fname], self.validator, out, strict)
+        return errors, [json.loads(line)
+                        for line in out.getvalue().splitlines()]
+
+    def test_like(self):
+        errors, diagnostics = self.check(
+            '[Default]\n'
+            'SCREEN_02 = ldm\n'
+            '[00:11:22:33:44:55]\n'
+            'LIKE = "Thin"\n'
+            '[thin]\n'
+            'SCREEN_02 = ldm\n', strict=True)
+        self.assertEqual(errors, 0)
+        self.assertEqual(diagnostics, [])
+
+    def test_like_missing_section(self):
+        errors, diagnostics = self.check(
+            '[Default]\n'
+            'SCREEN_02 = ldm\n'
+            '[00:11:22:33:44:55]\n'
+            'LIKE = nowhere\n'
+            'SCREEN_03 = shell\n')
+        self.assertEqual(errors, 1)
+        self.assertEqual(len(diagnostics), 1)
+        self.assertEqual(diagnostics[0]['line'], 4)
+        self.assertEqual(diagnostics[0]['option'], 'LIKE')
+        self.assertEqual(diagnostics[0]['severity'], 'error')
+        self.assertIn('[nowhere]', diagnostics[0]['error'])
+
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.vars_meta = configuration.LTSVarsConfig(os.path.join(
+            ROOT, 'lts_vars.conf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_expand_canonical_unquoted(self):
+        fname = os.path.join(self.scratch, 'lts.conf')
+        with open(fname, 'wb') as conf:
+            conf.write('[Default]\n'
+                       'SERVER = 10.0.0.1\n'
+                       'LDM_SERVER = "$SERVER:8080"\n'
+                       "LDM_PASSWORD = 'pa$s'\n"
+                       '[c1]\n'
+                       'SCREEN_02 = ldm\n')
+        out = StringIO()
+        cli.resolve_file(fname, out=out,
+                         schema=data_validation.LTSPValidator(self.vars_meta),
+                         expand=True, vars_meta=self.vars_meta)
+        settings = json.loads(out.getvalue())['settings']
+        self.assertEqual(settings['LDM_SERVER']['value'], '10.0.0.1:8080')
+        self.assertEqual(settings['LDM_PASSWORD']['value'], 'pa$s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Watch files for changes made by other programs.
+
+FileWatcher uses inotify (through ctypes, so no extra module is needed) where
+the kernel has it, and falls back to polling the files' stat() otherwise.
+The directories holding the files are watched rather than the files, so an
+editor or package manager replacing a file by renaming a new one over it is
+seen as well.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000  # events were lost; wd is -1
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len -- then len of name
+
+
+def _inotify():
+    """The libc inotify functions, or None if there's no inotify here."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+
+def _stamp(path):
+    """What's compared to tell whether path changed when polling."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_mtime, info.st_size, info.st_ino
+
+
+class FileWatcher(object):
+    """Calls callback(path) on a daemon thread whenever one of paths is
+    written, replaced, created or deleted.  A burst of events for a path
+    (say, a file written in several chunks) is reported once, when nothing
+    more has happened to it for settle seconds.  Callers that need to touch
+    gtk should pass it on with gobject.idle_add.
+    Without inotify, the files are stat()ed every poll_interval seconds
+    instead."""
+    def __init__(self, paths, callback, poll_interval=1.0, settle=0.2):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self._stopped = threading.Event()
+        self._fd = self._add_watches()
+        self.polling = self._fd is None
+        if not self.polling:
+            # written to by stop(), to wake the thread out of select()
+            self._wake_read, self._wake_write = os.pipe()
+        target = self._poll if self.polling else self._read_events
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _add_watches(self):
+        functions = _inotify()
+        if functions is None:
+            return None
+        inotify_init1, inotify_add_watch = functions
+        fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        self._names = {}  # watch descriptor -> {file name: path}
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            wd = inotify_add_watch(fd, directory, WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self._names[wd] = dict(
+                (os.path.basename(path), path) for path in self.paths
+                if os.path.dirname(path) == directory)
+        return fd
+
+    def stop(self):
+        """Stop watching.  No callbacks are made after this returns, which
+        is right away: the thread is woken rather than waited for to time
+        out."""
+        self._stopped.set()
+        if self._fd is not None:
+            os.write(self._wake_write, 'x')
+        self._thread.join()
+        if self._fd is not None:
+            for fd in (self._fd, self._wake_read, self._wake_write):
+                os.close(fd)
+            self._fd = None
+
+    def _notify(self, paths):
+        for path in sorted(paths):
+            if self._stopped.is_set():
+                return
+            self.callback(path)
+
+    def _read_events(self):
+        pending = {}  # path -> time of its last event
+        while not self._stopped.is_set():
+            timeout = self.settle if pending else self.poll_interval
+            try:
+                readable = select.select([self._fd, self._wake_read], [],
+                                         [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            if self._fd in readable:
+                for path in self._events(os.read(self._fd, 65536)):
+                    pending[path] = now
+            settled = [path for path, last in pending.iteritems()
+                       if now - last >= self.settle]
+            for path in settled:
+                del pending[path]
+            self._notify(settled)
+
+    def _events(self, data):
+        """The watched paths named by the inotify events in data.  If the
+        kernel's event queue overflowed, events may have been lost, so
+        every path counts as changed."""
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                for path in self.paths:
+                    yield path
+                continue
+            path = self._names.get(wd, {}).get(name)
+            if path is not None:
+                yield path
+
+    def _poll(self):
+        stamps = dict((path, _stamp(path)) for path in self.paths)
+        while not self._stopped.wait(self.poll_interval):
+            changed = []
+            for path in self.paths:
+                stamp = _stamp(path)
+                if stamp != stamps[path]:
+                    stamps[path] = stamp
+                    changed.append(path)
+            self._notify(changed)